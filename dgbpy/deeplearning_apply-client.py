@@ -21,6 +21,7 @@ from odpy import oscommand
 import dgbpy.keystr as dgbkeys
 import dgbpy.hdf5 as dgbhdf5
 import dgbpy.deeplearning_apply_clientlib as applylib
+import dgbpy.deeplearning_apply_transport as applytransport
 
 sel = selectors.DefaultSelector()
 
@@ -46,6 +47,10 @@ netgrp.add_argument( '--port',
             dest='port', action='store',
             type=int, default=65432,
             help='Port to listen on')
+netgrp.add_argument( '--compression',
+            dest='compression', metavar='CODEC', action='store',
+            choices=applytransport.arraycodecs, default=None,
+            help='Compress the arrays sent to and from the server' )
 loggrp = parser.add_argument_group( 'Logging' )
 loggrp.add_argument( '--log',
             dest='logfile', metavar='file', nargs='?',
@@ -70,12 +75,16 @@ parser.add_argument( '--fakeapply', dest='fakeapply', action='store_true',
 parser.add_argument( '--local', dest='localserv', action='store_true',
                      default=False,
                      help="use a local network socket connection" )
+parser.add_argument( '--sharedmem', dest='sharedmem', action='store_true',
+                     default=False,
+                     help="with --local: pass the arrays in shared memory instead of the socket" )
 
 
 args = vars(parser.parse_args())
 initLogging( args )
 modelfnm = args['modelfile'].name
 local = args['localserv']
+sharedmem = local and args['sharedmem']
 
 servscriptfp =  path.join(path.dirname(__file__),'deeplearning_apply-server.py')
 servercmd = list()
@@ -145,7 +154,7 @@ def create_request(action, value=None):
         content=bytes(action + value, encoding="utf-8"),
     )
 
-def req_connection(host, port, request):
+def req_connection(host, port, request, keepalive=False):
   if local:
     addr = str(port)
     sockfam = socket.AF_UNIX
@@ -156,8 +165,10 @@ def req_connection(host, port, request):
   sock.setblocking(True)
   sock.connect_ex(addr)
   events = selectors.EVENT_READ | selectors.EVENT_WRITE
-  message = applylib.Message(sel, sock, addr, request)
+  message = applylib.Message(sel, sock, addr, request, keepalive=keepalive,
+                             sharedmem=sharedmem, compression=args['compression'])
   sel.register(sock, events, data=message)
+  return message
 
 def isSupervised( args ):
   exfnm = args['examples'].name
@@ -209,8 +220,8 @@ inpdata = inpdata.astype('float32')
 start = time.time()
 
 host,port = args['addr'], args['port']
-req_connection(host, port, create_request('status'))
-req_connection(host, port, create_request('outputs',pars['outputnms']))
+connection = req_connection(host, port, create_request('status'), keepalive=True)
+connection.add_request(create_request('outputs',pars['outputnms']))
 applydict = {
   'arr': inpdata,
   'inp_shape': shape,
@@ -226,9 +237,9 @@ for i in range(nrrepeats):
   applydict['idx'] = i
   for idy in range(0,nrtrcs_in-shape[1]+1,chunk_step):
     applydict['idy'] = idy
-    req_connection(host, port, create_request('data',applydict))
+    connection.add_request(create_request('data',applydict))
 
-req_connection(host, port, create_request('kill'))
+connection.add_request(create_request('kill'))
 
 try:
   while True:
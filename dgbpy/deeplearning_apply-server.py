@@ -15,8 +15,8 @@ parser = argparse.ArgumentParser(
           description='Server application of a trained machine learning model')
 parser.add_argument( '-v', '--version',
             action='version',version='%(prog)s 2.0')
-parser.add_argument( 'modelfile', type=argparse.FileType('r'),
-                     help='The input trained model file' )
+parser.add_argument( 'modelfile', type=argparse.FileType('r'), nargs='?',
+                     help='The input trained model file, optional if the requests give their model' )
 parser.add_argument( '--ppid',
                      dest='parentpid', action='store',
                      type=int, default=-1,
@@ -37,6 +37,34 @@ datagrp.add_argument( '--mldir',
 datagrp.add_argument( '--Order',
             dest='applydir', type=str, default=dgbkeys.inlinestr,
             help='Apply direction for 2D models')
+datagrp.add_argument( '--multimodel', dest='multimodel', action='store_true',
+            default=False,
+            help='Serve the requests giving their model, from the model files of the Machine Learning directory' )
+datagrp.add_argument( '--maxmodels',
+            dest='maxmodels', action='store',
+            type=int, default=4,
+            help='Maximum number of models kept loaded, with --multimodel' )
+datagrp.add_argument( '--modelmemory',
+            dest='modelmemory', action='store',
+            type=float, default=0,
+            help='Memory budget (MB) of the models kept loaded, 0 for no limit' )
+procgrp = parser.add_argument_group( 'Processing' )
+procgrp.add_argument( '--queuesize',
+            dest='queuesize', action='store',
+            type=int, default=0,
+            help='Number of requests queued for an inference worker thread, 0 (default) runs the requests sequentially' )
+procgrp.add_argument( '--batchsamples',
+            dest='batchsamples', action='store',
+            type=int, default=0,
+            help='Target number of samples when combining queued apply requests (with --queuesize), 0 (default) to apply them one by one' )
+procgrp.add_argument( '--maxwait',
+            dest='maxwait', action='store',
+            type=float, default=0,
+            help='Maximum time (ms) to wait for more apply requests to combine' )
+procgrp.add_argument( '--warmup',
+            dest='warmup', action='store',
+            type=int, default=2,
+            help='Number of synthetic batches applied when loading a model, 0 to disable the warm-up' )
 loggrp = parser.add_argument_group( 'Logging' )
 loggrp.add_argument( '--log',
             dest='logfile', metavar='file', nargs='?',
@@ -55,6 +83,8 @@ parser.add_argument( '--local', dest='localserv', action='store_true',
                      help="use a local network socket connection" )
 
 args = vars(parser.parse_args())
+if args['multimodel'] and args['mldir'] == None:
+  parser.error( '--multimodel requires --mldir' )
 from odpy.common import *
 initLogging( args )
 redirect_stdout()
@@ -112,10 +142,10 @@ def timerCB():
   if not parentproc.is_running():
     os.kill( psutil.Process().pid, signal.SIGINT )
 
-def accept_wrapper(sock,applier):
+def accept_wrapper(sock,applier,pipeline,models):
   conn, addr = sock.accept()  # Should be ready to read
   conn.setblocking(True)
-  message = applylib.Message(sel, conn, addr, applier)
+  message = applylib.Message(sel, conn, addr, applier, pipeline, models)
   sel.register(conn, selectors.EVENT_READ, data=message)
 
 timer = Timer(15, timerCB)
@@ -127,16 +157,30 @@ if 'parentpid' in args:
     timer.start()
 
 applier = None
+pipeline = None
+if args['queuesize'] > 0:
+  batcher = None
+  if args['batchsamples'] > 0:
+    batcher = applylib.MicroBatcher( args['batchsamples'], args['maxwait']/1000 )
+  pipeline = applylib.ApplyPipeline( sel, args['queuesize'], batcher )
+models = None
+if args['multimodel']:
+  models = applylib.ModelCache( args['mldir'][0], args['applydir'], args['fakeapply'],
+                                args['maxmodels'], int(args['modelmemory']*1024*1024),
+                                args['warmup'] )
 try:
-  if applier == None:
-    applier = applylib.ModelApplier( args['modelfile'].name, args['applydir'], args['fakeapply'] )
+  if applier == None and args['modelfile'] != None:
+    applier = applylib.ModelApplier( args['modelfile'].name, args['applydir'], args['fakeapply'],
+                                     args['warmup'] )
   lastmessage = False
   cont = True
   while cont:
     events = sel.select(timeout=300)
     for key, mask in events:
       if key.data is None:
-        accept_wrapper(key.fileobj,applier)
+        accept_wrapper(key.fileobj,applier,pipeline,models)
+      elif key.data is pipeline:
+        pipeline.process_events(mask)
       else:
         message = key.data
         try:
@@ -151,12 +195,12 @@ try:
         cont = cont
         if parentproc != None and not parentproc.is_running():
           cont = False
-        if cont:
-          applier = message.applier
 except KeyboardInterrupt:
   std_msg('caught keyboard interrupt, exiting')
 except applylib.ExitCommand:
   std_msg('Found dead parent, exiting')
 finally:
   timer.cancel()
+  if pipeline != None:
+    pipeline.close()
   sel.close()
\ No newline at end of file
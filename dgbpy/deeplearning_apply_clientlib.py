@@ -9,16 +9,19 @@
 
 import sys
 import selectors
+import socket
 import json
 import io
 import numpy as np
 import struct
 
 from odpy.common import *
+from dgbpy import deeplearning_apply_transport as applytransport
 
 
 class Message:
-    def __init__(self, selector, sock, addr, request):
+    def __init__(self, selector, sock, addr, request, keepalive=False, sharedmem=False,
+                 compression=None, model=None):
         self.selector = selector
         self.sock = sock
         self.addr = addr
@@ -32,6 +35,19 @@ class Message:
         self.response = None
         self.request = request
         self._request_queued = False
+        self.keepalive = keepalive
+        self._requests = list()
+        self._nextreqid = 1
+        self.sharedmem = sharedmem
+        self._shm_in = None
+        self._shm_out = None
+        self._shm_outsize = 0
+        self.compression = compression
+        self._server_codecs = list()
+        self.model = model
+        if compression != None:
+            if not compression in applytransport.getArrayCodecs():
+                raise ValueError(f'Compression codec {compression} is not available.')
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -90,14 +106,50 @@ class Message:
           shapes.append( obj.shape )
         return (ret,shapes)
 
-    def _array_decode(self, arrptr, shapes, dtypes):
+    def _array_compress(self, objs):
+        """Compresses the arrays, once the server accepts the codec"""
+        ret = list()
+        shapes = list()
+        for obj in objs:
+          ret.append( applytransport.compressArray(obj,self.compression) )
+          shapes.append( obj.shape )
+        return (b''.join(ret),shapes,[len(buf) for buf in ret])
+
+    def _array_share(self, objs):
+        """Copies the arrays to shared memory, for a server on the same host"""
+        if self._shm_in == None:
+            self._shm_in = applytransport.SharedBuffer()
+            self._shm_out = applytransport.SharedBuffer()
+        shapes = list()
+        nrbytes = 0
+        for obj in objs:
+          nrbytes += obj.nbytes
+          shapes.append( obj.shape )
+        self._shm_in.reserve( nrbytes )
+        self._shm_in.writeArrays( objs )
+        # The server sends the results over the socket if they do not fit
+        self._shm_out.reserve( max(nrbytes,self._shm_outsize) )
+        shmnames = {
+          'input': self._shm_in.name,
+          'output': self._shm_out.name
+        }
+        return (shmnames,shapes)
+
+    def _array_decode(self, arrptr, shapes, dtypes, arrnbytes=None):
         ret = list()
         offset = 0
-        for shape,dtype in zip(shapes,dtypes):
+        for idx,(shape,dtype) in enumerate(zip(shapes,dtypes)):
+          if '+' in dtype:
+            # Compressed: 'dtype+codec', the sizes are in the header
+            (dtype,codec) = dtype.split('+')
+            nrbytes = arrnbytes[idx]
+            ret.append( applytransport.decompressArray(arrptr[offset:offset+nrbytes],codec,dtype,shape) )
+            offset += nrbytes
+            continue
           nrsamples = np.prod(shape,dtype=np.int64)
           arr = np.frombuffer(arrptr,dtype,count=nrsamples,offset=offset)
           arr = arr.reshape( shape )
-          offset += arr.nbytes
+          offset += arr.nbytes if arrnbytes == None else arrnbytes[idx]
           ret.append( arr )
         return {
           'result': 'arrays',
@@ -105,7 +157,8 @@ class Message:
         }
 
     def _create_message(
-        self, *, content_bytes, content_type, content_encoding, arrsize
+        self, *, content_bytes, content_type, content_encoding, arrsize, shmnames=None,
+        arrnbytes=None
     ):
         jsonheader = {
             'byteorder': sys.byteorder,
@@ -115,9 +168,19 @@ class Message:
         }
         if arrsize != None:
           jsonheader.update({ 'array-shape': arrsize })
+        if shmnames != None:
+          jsonheader.update({ 'shared-memory': shmnames })
+        if arrnbytes != None:
+          jsonheader.update({ 'array-nbytes': arrnbytes })
+        if self.compression != None:
+          jsonheader.update({ 'accept-encoding': [self.compression] })
+        if self.model != None:
+          jsonheader.update({ 'model': self.model })
+        if self.keepalive:
+          jsonheader.update({ 'keep-alive': True })
         jsonheader_bytes = self._json_encode(jsonheader, 'utf-8')
         od_hdr =   struct.pack('=i',len(jsonheader_bytes)+len(content_bytes)) \
-                 + struct.pack('=i',1) \
+                 + struct.pack('=i',self._nextreqid) \
                  + struct.pack('=h',-1)
         message = od_hdr + jsonheader_bytes + content_bytes
         return message
@@ -186,6 +249,12 @@ class Message:
             # Delete reference to socket object for garbage collection
             self.sock = None
 
+        if self._shm_in != None:
+            # The arrays of the last response are views on the output block
+            self.response = None
+            self._shm_in.close()
+            self._shm_out.close()
+
     def queue_request(self):
         content = self.request['content']
         content_type = self.request['type']
@@ -197,6 +266,24 @@ class Message:
                 'content_encoding': content_encoding,
                 'arrsize': None,
             }
+        elif content_type == 'binary/array' and self.sharedmem:
+            (shmnames,shapes) = self._array_share(content)
+            req = {
+              'content_bytes': b'',
+              'content_type': content_type,
+              'content_encoding': content_encoding,
+              'arrsize': shapes,
+              'shmnames': shmnames,
+            }
+        elif content_type == 'binary/array' and self.compression in self._server_codecs:
+            (arrsptr,shapes,arrnbytes) = self._array_compress(content)
+            req = {
+              'content_bytes': arrsptr,
+              'content_type': content_type,
+              'content_encoding': [f'{enc}+{self.compression}' for enc in content_encoding],
+              'arrsize': shapes,
+              'arrnbytes': arrnbytes,
+            }
         elif content_type == 'binary/array':
             (arrsptr,shapes) = self._array_encode(content)
             req = {
@@ -239,6 +326,8 @@ class Message:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f'Missing required header "{reqhdr}".')
+            # Codecs the server accepts for compressing the next requests
+            self._server_codecs = self.jsonheader.get('accept-encoding', self._server_codecs)
 
     def process_response(self):
         content_len = self.jsonheader["content-length"]
@@ -253,7 +342,13 @@ class Message:
         elif self.jsonheader["content-type"] == 'binary/array':
             shapes = self.jsonheader['array-shape']
             dtypes = self.jsonheader['content-encoding']
-            self.response = self._array_decode(data,shapes,dtypes)
+            if 'shared-memory' in self.jsonheader:
+                # Views on the output block, valid until the next request
+                data = self._shm_out.buf
+            elif self.sharedmem:
+                self._shm_outsize = max(self._shm_outsize,content_len)
+            arrnbytes = self.jsonheader.get('array-nbytes')
+            self.response = self._array_decode(data,shapes,dtypes,arrnbytes)
             self._process_response_array_content()
         else:
             # Binary or unknown content-type
@@ -263,5 +358,39 @@ class Message:
                 self.addr,
             )
             self._process_response_binary_content()
-        # Close when response has been processed
+        if self.keepalive and self._reqid != self._nextreqid:
+            raise ValueError(f'Unexpected response id {self._reqid}, expected {self._nextreqid}.')
+        if not self._requests:
+            # Close when the last response has been processed
+            self.close()
+        elif self.keepalive and self.jsonheader.get('keep-alive', False):
+            self._next_request()
+        else:
+            # Server does not keep the connection alive: connect again
+            self._reconnect()
+            self._next_request()
+
+    def add_request(self, request):
+        """Queues a request, sent on the same connection after the previous response"""
+        self._requests.append(request)
+
+    def _next_request(self):
+        self._recv_buffer = b""
+        self._payload_len = None
+        self._reqid = None
+        self._subid = None
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self.response = None
+        self.request = self._requests.pop(0)
+        self._request_queued = False
+        self._nextreqid += 1
+        self._set_selector_events_mask("w")
+
+    def _reconnect(self):
+        sockfam = self.sock.family
         self.close()
+        self.sock = socket.socket(sockfam, socket.SOCK_STREAM)
+        self.sock.setblocking(True)
+        self.sock.connect_ex(self.addr)
+        self.selector.register(self.sock, selectors.EVENT_WRITE, data=self)
@@ -7,14 +7,22 @@
 #
 #
 
+import collections
+import contextlib
+import functools
+import gc
 import io
 import json
 import numpy as np
 import os
 import psutil
+import queue
 import selectors
+import socket
 import struct
 import sys
+import threading
+import time
 import traceback as tb
 
 from odpy.common import *
@@ -22,14 +30,146 @@ import dgbpy.keystr as dgbkeys
 from dgbpy import hdf5 as dgbhdf5
 from dgbpy import mlio as dgbmlio
 from dgbpy import mlapply as dgbmlapply
+from dgbpy import deeplearning_apply_transport as applytransport
 from dgbpy import dgbtorch
 from dgbpy import dgbscikit, dgbkeras
 
 class ExitCommand(Exception):
     pass
 
+odheaderlen = 10
+recvblocksize = 16777216
+sendmaxbuffers = 512
+
+class ServerStats:
+    """
+    Performance statistics of the server since its start or the last reset:
+    latency histograms of each processing stage of the requests, number of
+    samples applied, sizes of the batches given to the model, depths of
+    the pipeline queues.
+    Recorded from the selector loop and the inference worker, unless
+    suspended for the calling thread.
+    """
+    stages = ('receive', 'decode', 'preprocess', 'inference', 'postprocess', 'encode', 'send')
+    # Upper bounds of the latency histogram bins, in ms. The last bin is unbounded
+    latencybins = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+    # Upper bounds of the batch size histogram bins, in samples
+    batchbins = tuple([2**i for i in range(17)])
+
+    def __init__(self):
+        self.lock_ = threading.Lock()
+        self.local_ = threading.local()
+        self.reset()
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """Context in which nothing is recorded for the calling thread"""
+        self.local_.suspended = True
+        try:
+            yield
+        finally:
+            self.local_.suspended = False
+
+    def _recording(self):
+        return not getattr(self.local_, 'suspended', False)
+
+    def reset(self):
+        with self.lock_:
+            self.start_ = time.monotonic()
+            self.latencies_ = {stage: [0, 0., 0., [0]*(len(self.latencybins)+1)] \
+                               for stage in self.stages}
+            self.batches_ = [0, 0, 0, 0, [0]*(len(self.batchbins)+1)]
+            self.queues_ = dict()
+
+    def add_latency(self, stage, duration):
+        if not self._recording():
+            return
+        duration *= 1000
+        with self.lock_:
+            latency = self.latencies_[stage]
+            latency[0] += 1
+            latency[1] += duration
+            latency[2] = max(latency[2], duration)
+            latency[3][np.searchsorted(self.latencybins, duration)] += 1
+
+    def add_batch(self, nrsamples, nrrequests=1):
+        if not self._recording():
+            return
+        with self.lock_:
+            self.batches_[0] += 1
+            self.batches_[1] += nrsamples
+            self.batches_[2] = max(self.batches_[2], nrsamples)
+            self.batches_[3] += nrrequests
+            self.batches_[4][np.searchsorted(self.batchbins, nrsamples)] += 1
+
+    def add_queue_depth(self, name, depth):
+        if not self._recording():
+            return
+        with self.lock_:
+            queuestats = self.queues_.setdefault(name, [0, 0, 0, 0])
+            queuestats[0] += 1
+            queuestats[1] += depth
+            queuestats[2] = max(queuestats[2], depth)
+            queuestats[3] = depth
+
+    def report(self):
+        """Returns the statistics, in a JSON serializable dict"""
+        with self.lock_:
+            elapsed = time.monotonic() - self.start_
+            latencies = dict()
+            for stage,(count,total,maxduration,histogram) in self.latencies_.items():
+                latencies[stage] = {
+                    'count': count,
+                    'mean-ms': total/count if count else 0,
+                    'max-ms': maxduration,
+                    'histogram': list(histogram),
+                }
+            (nrbatches,nrsamples,maxsamples,nrrequests,histogram) = self.batches_
+            queues = dict()
+            for name,(count,total,maxdepth,depth) in self.queues_.items():
+                queues[name] = {
+                    'current': depth,
+                    'mean': total/count if count else 0,
+                    'max': maxdepth,
+                }
+        return {
+            'elapsed': elapsed,
+            'samples': nrsamples,
+            'samples-per-second': nrsamples/elapsed if elapsed > 0 else 0,
+            'latency-bins-ms': list(self.latencybins),
+            'latency': latencies,
+            'batches': {
+                'count': nrbatches,
+                'mean-samples': nrsamples/nrbatches if nrbatches else 0,
+                'max-samples': maxsamples,
+                'mean-requests': nrrequests/nrbatches if nrbatches else 0,
+                'bins': list(self.batchbins),
+                'histogram': list(histogram),
+            },
+            'queues': queues,
+            'rss': psutil.Process().memory_info().rss,
+        }
+
+stats = ServerStats()
+
+def timed_stage(stage):
+    """Decorator adding the duration of each call to the statistics of a stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.add_latency(stage, time.perf_counter()-start)
+        return wrapper
+    return decorator
+
 class ModelApplier:
-    def __init__(self, modelfnm, applydir=dgbkeys.inlinestr, isfake=False):
+    # Number of samples of the warm-up batches, when the batch size is not set
+    warmupsamples = 32
+
+    def __init__(self, modelfnm, applydir=dgbkeys.inlinestr, isfake=False, warmup=2):
         self.pars_ = None
         self.fakeapply_ = isfake
         self.scaler_ = None
@@ -41,6 +181,8 @@ class ModelApplier:
         self.batchsize_ = None
         self.debugstr = ''
         self.applydir_ = applydir
+        self.warmup_ = warmup
+        self.warmuptime_ = 0
 
     def _get_info(self,modelfnm):
         info = dgbmlio.getInfo( modelfnm, quick=True )
@@ -74,6 +216,44 @@ class ModelApplier:
         modelfnm = self.info_[dgbkeys.filedictstr]
         (self.model_,self.info_) = dgbmlio.getModel( modelfnm, fortrain=False )
         self._set_transpose()
+        self.warmUp()
+
+    def warmUp(self):
+        """ Applies synthetic batches with the input shape of the model, through
+        the full preprocess/apply/postprocess path. This triggers the one-time
+        initializations of the backend before the first request.
+
+        Returns:
+          * float: duration of the warm-up, in seconds
+        """
+        self.warmuptime_ = 0
+        if self.warmup_ < 1:
+            return self.warmuptime_
+        inpshape = self.info_[dgbkeys.inpshapedictstr]
+        nrattribs = dgbhdf5.getNrAttribs( self.info_ )
+        nrsamples = self.batchsize_ if self.batchsize_ else self.warmupsamples
+        if isinstance(inpshape,int):
+            shape = (nrattribs, inpshape+nrsamples-1)
+        else:
+            shape = (nrattribs,) + tuple(inpshape[:2]) + (inpshape[2]+nrsamples-1,)
+        inp = np.random.default_rng().random( shape, dtype=np.float32 )
+        scaler = self.scaler_
+        start = time.perf_counter()
+        try:
+            # Not part of the statistics of the requests
+            with stats.suspended():
+                for i in range(self.warmup_):
+                    self.doWork( inp )
+        except Exception as e:
+            log_msg( 'Model warm-up failed:', repr(e) )
+            return self.warmuptime_
+        finally:
+            # The apply state must remain as before the warm-up
+            self.info_[dgbkeys.inpshapedictstr] = inpshape
+            self.scaler_ = scaler
+        self.warmuptime_ = time.perf_counter()-start
+        log_msg( f'Model warm-up: {self.warmup_} batches of {nrsamples} samples in {self.warmuptime_:.3f} s' )
+        return self.warmuptime_
 
     def _usePar(self, pars):
         self.pars_ = pars
@@ -135,7 +315,7 @@ class ModelApplier:
 
         return self.scaler_
 
-    def preprocess(self,samples):
+    def setScaler(self,samples):
         if dgbhdf5.applyLocalStd( self.info_ ):
             self.scaler_ = dgbscikit.getScaler( samples, True )
         elif dgbhdf5.applyNormalization( self.info_ ):
@@ -149,6 +329,8 @@ class ModelApplier:
                 self.debugmsg_ = 'Missing scaler for global standardization' 
                 raise TypeError
 
+    def preprocess(self,samples):
+        self.setScaler( samples )
         if self.scaler_ != None:
             samples = dgbscikit.scale( samples, self.scaler_ )
 
@@ -171,23 +353,85 @@ class ModelApplier:
 
         return samples
 
-    def flatModelApply(self, inp, samples, samples_shape):
+    def flatModelApply(self, inp, allsamples, samples_shape):
+        """ Applies a flat model on all slices of the samples, in a single doApply
+
+        Parameters:
+          * inp (numpy.ndarray): input block
+          * allsamples (list): samples to be sliced, one per apply direction
+          * samples_shape (tuple): shape of the samples given to the model for one slice
+
+        Returns:
+          * list: the predictions for each of the samples
+        """
         inpshape = self.info_[dgbkeys.inpshapedictstr]
         nrout = dgbhdf5.getNrOutputs(self.info_)
         outshape = (1, nrout, *inp.shape[1:])
-        outdata = np.zeros(outshape, dtype=inp.dtype)
-        applydata = np.empty(samples_shape, dtype=inp.dtype)
-        for idx in range(max(inpshape[0], inpshape[1])):
-            applydata[:,:,0] = samples[:,:,idx]
-            ret = dgbmlapply.doApply( self.model_, self.info_, applydata, \
-                                    scaler=None, applyinfo=self.applyinfo_, \
-                                    batchsize=self.batchsize_ )
-            if dgbkeys.preddictstr in ret:
-                outdata[0,:,idx] = ret[dgbkeys.preddictstr][:,0]
-
-        return outdata
+        nrslices = max(inpshape[0], inpshape[1])
+        applydata = np.empty((len(allsamples), nrslices, *samples_shape), dtype=inp.dtype)
+        for slicesdata,samples in zip(applydata, allsamples):
+            slicesdata[:,:,:,0] = np.moveaxis( samples[:,:,:nrslices], 2, 0 )
+
+        ret = dgbmlapply.doApply( self.model_, self.info_, \
+                                  applydata.reshape((-1, *samples_shape[1:])), \
+                                  scaler=None, applyinfo=self.applyinfo_, \
+                                  batchsize=self.batchsize_ )
+        outdata = np.zeros((len(allsamples), *outshape), dtype=inp.dtype)
+        if dgbkeys.preddictstr in ret:
+            preds = ret[dgbkeys.preddictstr]
+            preds = preds.reshape( applydata.shape[:3]+preds.shape[1:] )
+            for slicesout,slicespred in zip(outdata, preds):
+                for idx in range(nrslices):
+                    slicesout[0,:,idx] = slicespred[idx][:,0]
+
+        return list(outdata)
 
     def doWork(self,inp):
+        work = self.prepareWork(inp)
+        return self.finishWork(work, self.applyWork(work))
+
+    def windowSamples(self,inp,samples_shape,vertical):
+        """ Sliding-window view of the samples on an input block, without copy
+
+        Returns:
+          * numpy.ndarray: read-only view with shape samples_shape,
+            or None if the samples cannot be extracted as a view
+        """
+        nrz = samples_shape[-1]
+        if nrz == 1 or self.is2dinp_ or self.isflat_inlinemodel_ or self.isflat_xlinemodel_:
+            return None
+        if vertical:
+            if len(inp.shape) != 2:
+                return None
+            windows = np.lib.stride_tricks.sliding_window_view( inp, nrz, axis=-1 )
+            return windows.transpose( 1, 0, 2 )[:,:,np.newaxis,np.newaxis,:]
+        if len(inp.shape) != 4:
+            return None
+        windows = np.lib.stride_tricks.sliding_window_view( inp, nrz, axis=-1 )
+        return np.broadcast_to( np.moveaxis(windows, 3, 0), samples_shape )
+
+    def preprocessWindows(self,inp,samples,samples_shape,vertical):
+        """ Preprocess for samples obtained by windowSamples
+
+        The scaler is computed from the samples, but applied once to the input
+        block before taking the windows again: the samples remain a view.
+        """
+        self.setScaler( samples )
+        if self.scaler_ != None:
+            scaledinp = dgbscikit.scale( np.array(inp)[np.newaxis], self.scaler_ )[0]
+            samples = self.windowSamples( scaledinp, samples_shape, vertical )
+
+        if self.needtranspose_:
+            samples = np.transpose( samples, axes=(0,1,4,3,2) )
+        return samples
+
+    @timed_stage('preprocess')
+    def prepareWork(self,inp):
+        """ Builds and preprocesses the samples of an input block
+
+        Returns:
+          * dict: the samples, and the state needed to apply the model and to finish the work
+        """
         nrattribs = inp.shape[0]
         inpshape = self.info_[dgbkeys.inpshapedictstr]
         nrzin = inp.shape[-1]
@@ -213,46 +457,70 @@ class ModelApplier:
             nrzoutsamps = nrzin - inpshape[2] +1
         samples_shape = dgbhdf5.get_np_shape( inpshape, nrattribs=nrattribs,
                                               nrpts=nrzoutsamps )
-        nrtrcs = samples_shape[-2]
         nrz = samples_shape[-1]
-        allsamples = list()
-        if nrz == 1:
-            inp = np.transpose( inp )
-            allsamples.append( np.resize( np.array(inp), samples_shape ) )
+        samples = self.windowSamples( inp, samples_shape, vertical )
+        if isinstance( samples, np.ndarray ):
+            samples = self.preprocessWindows( inp, samples, samples_shape, vertical )
         else:
-            loc_samples = np.empty( samples_shape, dtype=inp.dtype )
-            if (self.isflat_inlinemodel_ or self.isflat_xlinemodel_) and not self.is2dinp_:
-                loc_samples = np.empty((1,)+inp.shape, dtype=inp.dtype)
-
-            if vertical:
-                for zidz in range(nrzoutsamps):
-                    loc_samples[zidz,:,0,0,:] = inp[:,zidz:zidz+nrz]
-                allsamples.append( loc_samples )
-            elif self.is2dinp_:
-                for ich in range(inp.shape[0]):
+            if nrz == 1:
+                inp = np.transpose( inp )
+                samples = np.resize( np.array(inp), samples_shape )
+            else:
+                samples = np.empty( samples_shape, dtype=inp.dtype )
+                if (self.isflat_inlinemodel_ or self.isflat_xlinemodel_) and not self.is2dinp_:
+                    samples = np.empty((1,)+inp.shape, dtype=inp.dtype)
+
+                if vertical:
                     for zidz in range(nrzoutsamps):
-                        loc_samples[zidz] = inp[ich,:,zidz:zidz+nrz]
-                allsamples.append( loc_samples )
-            else :
-                for zidz in range(nrzoutsamps):
-                    loc_samples[zidz] = inp[:,:,:,zidz:zidz+nrz]
-                allsamples.append( loc_samples )
-
-        samples = np.concatenate(allsamples)
-        if self.swapaxes_:
-            samples = samples.swapaxes(2, 3)
+                        samples[zidz,:,0,0,:] = inp[:,zidz:zidz+nrz]
+                elif self.is2dinp_:
+                    for ich in range(inp.shape[0]):
+                        for zidz in range(nrzoutsamps):
+                            samples[zidz] = inp[ich,:,zidz:zidz+nrz]
+                else:
+                    for zidz in range(nrzoutsamps):
+                        samples[zidz] = inp[:,:,:,zidz:zidz+nrz]
+
+            if self.swapaxes_:
+                samples = samples.swapaxes(2, 3)
+
+            samples = self.preprocess( samples )
+
+        flatapply = self.info_[dgbkeys.learntypedictstr] == dgbkeys.seisimgtoimgtypestr and not self.is2dinp_ and \
+                    (self.isflat_inlinemodel_ or self.isflat_xlinemodel_) and \
+                    self.applydir_ in [dgbkeys.averagestr, dgbkeys.minstr, dgbkeys.maxstr]
+        return {
+            'inp': inp,
+            'samples': samples,
+            'samples_shape': samples_shape,
+            'flatapply': flatapply,
+            'isflat_inlinemodel': self.isflat_inlinemodel_,
+            'isflat_xlinemodel': self.isflat_xlinemodel_,
+            'is2dinp': self.is2dinp_,
+            'swapaxes': self.swapaxes_,
+            'scaler': self.scaler_,
+        }
 
-        samples = self.preprocess( samples )
+    @timed_stage('inference')
+    def applyWork(self,work):
+        """ Applies the model on the samples of a prepared work
 
+        Returns:
+          * dict: the doApply results
+        """
+        samples = work['samples']
+        stats.add_batch(len(samples))
         ret = {}
-        if self.info_[dgbkeys.learntypedictstr] == dgbkeys.seisimgtoimgtypestr and not self.is2dinp_ and \
-            (self.isflat_inlinemodel_ or self.isflat_xlinemodel_) and \
-            self.applydir_ in [dgbkeys.averagestr, dgbkeys.minstr, dgbkeys.maxstr]:
-            ret[dgbkeys.preddictstr] = self.flatModelApply(inp, samples, samples_shape)
+        if work['flatapply']:
+            inp = work['inp']
+            samples_shape = work['samples_shape']
+            allsamples = [samples]
             if self.applydir_ in [dgbkeys.averagestr, dgbkeys.minstr, dgbkeys.maxstr]:
-                samples = samples.swapaxes(2, 3)
-                newret = self.flatModelApply(inp, samples, samples_shape)
-                newret = newret.swapaxes(2, 3)
+                allsamples.append( samples.swapaxes(2, 3) )
+            allret = self.flatModelApply(inp, allsamples, samples_shape)
+            ret[dgbkeys.preddictstr] = allret[0]
+            if len(allret) > 1:
+                newret = allret[1].swapaxes(2, 3)
                 if self.applydir_ == dgbkeys.averagestr:
                     ret[dgbkeys.preddictstr] = (newret + ret[dgbkeys.preddictstr])/2
                 elif self.applydir_ == dgbkeys.minstr:
@@ -263,6 +531,83 @@ class ModelApplier:
             ret = dgbmlapply.doApply( self.model_, self.info_, samples, \
                                       scaler=None, applyinfo=self.applyinfo_, \
                                       batchsize=self.batchsize_ )
+        return ret
+
+    def outputSampleAxes(self):
+        """ Axis of the samples in each output of doApply, from the model info
+        and the requested outputs
+
+        Returns:
+          * dict: axis by output key, None if the outputs of several works
+            cannot be split after a single doApply
+        """
+        platform = self.info_[dgbkeys.plfdictstr]
+        if platform == dgbkeys.numpyvalstr:
+            return {dgbkeys.preddictstr: 0}
+        if self.info_[dgbkeys.learntypedictstr] == dgbkeys.logclustertypestr:
+            return None
+        if platform == dgbkeys.scikitplfnm:
+            # Transposed predictions and probabilities
+            return {dgbkeys.preddictstr: -1, dgbkeys.probadictstr: -1}
+        if not dgbhdf5.isClassification( self.info_ ):
+            return {dgbkeys.preddictstr: 0}
+        # The classes, probabilities and confidence of the other layouts
+        # are selected over all samples at once
+        applyinfo = self.applyinfo_ if self.applyinfo_ != None else {}
+        if dgbhdf5.isImg2Img( self.info_ ) and not dgbkeys.dtypeconf in applyinfo and \
+           len(applyinfo.get(dgbkeys.probadictstr, [])) < 1:
+            return {dgbkeys.preddictstr: 0}
+        return None
+
+    def canApplyTogether(self,works):
+        """ Whether the samples of several works can go through a single doApply """
+        if any([work['flatapply'] for work in works]):
+            return False
+        if self.outputSampleAxes() == None:
+            return False
+        sampleshape = works[0]['samples'].shape[1:]
+        dtype = works[0]['samples'].dtype
+        return all([work['samples'].shape[1:] == sampleshape and \
+                    work['samples'].dtype == dtype for work in works])
+
+    @timed_stage('inference')
+    def applyWorks(self,works):
+        """ Applies the model once on the samples of several works, see canApplyTogether
+
+        Returns:
+          * list: the doApply results of each work
+        """
+        axes = self.outputSampleAxes()
+        counts = [len(work['samples']) for work in works]
+        nrsamples = sum(counts)
+        samples = np.concatenate( [work['samples'] for work in works] )
+        ret = dgbmlapply.doApply( self.model_, self.info_, samples, \
+                                  scaler=None, applyinfo=self.applyinfo_, \
+                                  batchsize=self.batchsize_ )
+        stats.add_batch(nrsamples, len(works))
+        splits = np.cumsum( counts )[:-1]
+        rets = [dict() for work in works]
+        for key in ret:
+            arr = ret[key]
+            if not key in axes or arr.ndim < 1 or arr.shape[axes[key]] != nrsamples:
+                raise ValueError(f'Unexpected layout of the {key} output of a combined apply.')
+            for workret,arrpart in zip(rets, np.split(arr, splits, axis=axes[key])):
+                workret[key] = arrpart
+        return rets
+
+    @timed_stage('postprocess')
+    def finishWork(self,work,ret):
+        """ Postprocesses the results of a work
+
+        Returns:
+          * list: the prediction, probabilities and confidence arrays, when available
+        """
+        self.isflat_inlinemodel_ = work['isflat_inlinemodel']
+        self.isflat_xlinemodel_ = work['isflat_xlinemodel']
+        self.is2dinp_ = work['is2dinp']
+        self.swapaxes_ = work['swapaxes']
+        self.scaler_ = work['scaler']
+        if not work['flatapply']:
             if dgbkeys.preddictstr in ret and not self.is2dinp_ and \
                ((self.isflat_inlinemodel_ and self.applydir_ in [dgbkeys.crosslinestr]) or \
                 (self.isflat_xlinemodel_ and self.applydir_ in [dgbkeys.inlinestr])):
@@ -304,22 +649,268 @@ class ModelApplier:
         return self.debugstr
 
 
+class ApplyPipeline:
+    """
+    Runs the requests of all connections in an inference worker thread, while
+    the selector loop keeps receiving and decoding the next requests, and
+    encoding and sending the responses.
+    The request and response queues are bounded: requests beyond the queue size
+    wait with their connection removed from the selector, and the worker waits
+    while the responses are not picked up.
+    A single worker is used, since the model applier is not thread safe.
+    Apply requests are coalesced by the batcher, if any.
+    """
+    def __init__(self, selector, queuesize=2, batcher=None):
+        self.selector = selector
+        self.batcher = batcher
+        self.requests_ = queue.Queue(maxsize=queuesize)
+        self.responses_ = queue.Queue(maxsize=queuesize)
+        self.waiting_ = collections.deque()
+        (self.wakeup_recv_,self.wakeup_send_) = socket.socketpair()
+        self.wakeup_recv_.setblocking(False)
+        self.selector.register(self.wakeup_recv_, selectors.EVENT_READ, data=self)
+        self.worker_ = threading.Thread(target=self._work, daemon=True)
+        self.worker_.start()
+
+    def submit(self, message):
+        """Queues a received request, its connection is idle until the response is ready"""
+        self.selector.unregister(message.sock)
+        self.waiting_.append(message)
+        self._feed()
+        stats.add_queue_depth('requests', self.requests_.qsize()+len(self.waiting_))
+
+    def _feed(self):
+        while self.waiting_:
+            try:
+                self.requests_.put_nowait(self.waiting_[0])
+            except queue.Full:
+                return
+            self.waiting_.popleft()
+
+    def _work(self):
+        pending = collections.deque()
+        while True:
+            message = pending.popleft() if pending else self.requests_.get()
+            if message is None:
+                break
+            if self.batcher != None and message.is_apply_request():
+                for response in self.batcher.run(message, self._next_request, pending):
+                    self._respond(*response)
+                continue
+            try:
+                response = (message.create_response_content(), None)
+            except Exception:
+                response = (None, tb.format_exc())
+            self._respond(message, *response)
+
+    def _next_request(self, timeout):
+        message = self.requests_.get(timeout=timeout)
+        # Let the I/O thread queue the waiting requests, if any
+        self.wakeup_send_.send(b'\0')
+        return message
+
+    def _respond(self, message, response, error):
+        self.responses_.put((message,response,error))
+        stats.add_queue_depth('responses', self.responses_.qsize())
+        self.wakeup_send_.send(b'\0')
+
+    def process_events(self, mask):
+        try:
+            self.wakeup_recv_.recv(4096)
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                (message,response,error) = self.responses_.get_nowait()
+            except queue.Empty:
+                break
+            if error != None:
+                log_msg( "main: error: exception for", f"{message.addr}:\n{error}" )
+                message.close()
+            else:
+                message.response_ready(response)
+        self._feed()
+
+    def close(self):
+        try:
+            self.requests_.put_nowait(None)
+        except queue.Full:
+            pass
+        self.wakeup_recv_.close()
+        self.wakeup_send_.close()
+
+
+class MicroBatcher:
+    """
+    Coalesces the samples of apply requests waiting for the inference worker:
+    requests are gathered until the target number of samples is reached or the
+    maximum waiting time is elapsed, the model is applied once on all samples,
+    and the results are scattered back to each request.
+    Requests that cannot be combined (other input shape, flat model apply,
+    outputs not split by sample) are applied on their own. A failure of the
+    combined apply is reported to all its requests.
+    """
+    def __init__(self, nrsamples=4096, maxwait=0.005):
+        self.nrsamples = nrsamples
+        self.maxwait = maxwait
+
+    def run(self, message, nextrequest, pending):
+        """
+        Runs an apply request, together with the next ones obtained with
+        nextrequest(timeout), which raises queue.Empty on timeout.
+        Any other request obtained is appended to pending.
+        Returns the (message, response, error) of each request
+        """
+        deadline = time.monotonic() + self.maxwait
+        batch = list()
+        responses = list()
+        nrsamples = 0
+        while True:
+            try:
+                message.resolve_applier()
+                work = message.applier.prepareWork(message.apply_input())
+                batch.append((message,work))
+                nrsamples += len(work['samples'])
+            except Exception as e:
+                responses.append((message,message.create_error_response(e),None))
+            if nrsamples >= self.nrsamples:
+                break
+            try:
+                message = nextrequest(max(deadline-time.monotonic(),0))
+            except queue.Empty:
+                break
+            if message is None or not message.is_apply_request() or \
+               (len(batch) > 0 and message.model != batch[0][0].model):
+                pending.append(message)
+                break
+        return responses + self._apply(batch)
+
+    def _apply(self, batch):
+        if len(batch) < 1:
+            return list()
+        applier = batch[0][0].applier
+        works = [work for (message,work) in batch]
+        rets = None
+        if len(batch) > 1 and applier.canApplyTogether(works):
+            try:
+                rets = applier.applyWorks(works)
+            except Exception as e:
+                # Not retried one by one: the error is reported to every request
+                log_msg( "main: error: combined apply of", len(works), "requests failed:", repr(e) )
+                return [(message,message.create_error_response(e),None) for (message,work) in batch]
+        responses = list()
+        for imsg,(message,work) in enumerate(batch):
+            try:
+                ret = rets[imsg] if rets != None else applier.applyWork(work)
+                res = applier.finishWork(work, ret)
+                responses.append((message,message.create_arrays_response(res),None))
+            except Exception as e:
+                responses.append((message,message.create_error_response(e),None))
+        return responses
+
+
+class ModelCache:
+    """
+    Model appliers of a multi-model server, for the requests giving their model
+    file. Only the model files of the Machine Learning directory are served,
+    given by their path relative to that directory or their absolute path.
+    The least recently used models are unloaded when there are more than
+    maxmodels, or when their estimated memory use exceeds the budget.
+    The outputs set for each model are kept: an unloaded model is loaded
+    again when requested.
+    Only used from the thread running the requests.
+    """
+    def __init__(self, mldir, applydir=dgbkeys.inlinestr, isfake=False, maxmodels=4, memorybudget=0, warmup=2):
+        self.mldir = os.path.realpath(mldir)
+        self.applydir = applydir
+        self.isfake = isfake
+        self.warmup = warmup
+        self.maxmodels = maxmodels
+        self.memorybudget = memorybudget
+        self.appliers_ = collections.OrderedDict()
+        self.sizes_ = dict()
+        self.outputs_ = dict()
+
+    def resolve(self, model):
+        """Returns the path of a model file of the Machine Learning directory, raises an error for any other file"""
+        modelfnm = os.path.realpath(os.path.join(self.mldir, model))
+        if os.path.commonpath([self.mldir, modelfnm]) != self.mldir or not os.path.isfile(modelfnm):
+            raise ValueError(f'Model "{model}" is not a model file of the Machine Learning directory.')
+        return modelfnm
+
+    def get(self, model):
+        """Returns the applier of a model, creating or reloading it if needed"""
+        modelfnm = self.resolve(model)
+        if modelfnm in self.appliers_:
+            self.appliers_.move_to_end(modelfnm)
+            return self.appliers_[modelfnm]
+        applier = ModelApplier(modelfnm, self.applydir, self.isfake, self.warmup)
+        self.appliers_[modelfnm] = applier
+        self.sizes_[modelfnm] = 0
+        if modelfnm in self.outputs_:
+            self.set_outputs(modelfnm, self.outputs_[modelfnm])
+        return applier
+
+    def set_outputs(self, model, outputs):
+        """Sets the outputs of a model, which loads it. Returns its applier"""
+        applier = self.get(model)
+        modelfnm = self.resolve(model)
+        rss = psutil.Process().memory_info().rss
+        applier.setOutputs(outputs)
+        self.outputs_[modelfnm] = outputs
+        # Estimated from the memory taken by loading, at least the file size
+        filesize = os.path.getsize(modelfnm) if os.path.isfile(modelfnm) else 0
+        self.sizes_[modelfnm] = max(psutil.Process().memory_info().rss-rss, filesize)
+        self._evict(modelfnm)
+        return applier
+
+    def _evict(self, keepmodelfnm):
+        while len(self.appliers_) > 1:
+            overbudget = self.memorybudget > 0 and sum(self.sizes_.values()) > self.memorybudget
+            if len(self.appliers_) <= self.maxmodels and not overbudget:
+                return
+            modelfnm = next(iter(self.appliers_))
+            if modelfnm == keepmodelfnm:
+                self.appliers_.move_to_end(modelfnm)
+                modelfnm = next(iter(self.appliers_))
+            applier = self.appliers_.pop(modelfnm)
+            self.sizes_.pop(modelfnm)
+            applier.model_ = None
+            del applier
+            gc.collect()
+
+
 class Message:
-    def __init__(self, selector, sock, addr, applier):
+    def __init__(self, selector, sock, addr, applier, pipeline=None, models=None):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self._odheader = bytearray(odheaderlen)
+        self._recv_buffer = None
+        self._recv_view = None
+        self._recv_len = 0
+        self._send_buffers = list()
         self._payload_len = None
         self._reqid = None
         self._subid = None
         self._jsonheader_len = None
         self.jsonheader = None
         self.request = None
+        self.request_error = None
         self.response_created = False
         self.applier = applier
+        self.pipeline = pipeline
+        self.models = models
+        self.model = None
         self.lastmessage = False
+        self.keepalive = False
+        self.nrserved = 0
+        self.sharedmem = False
+        self._shm_in = None
+        self._shm_out = None
+        self.codec = None
+        self._recv_start = None
+        self._send_start = None
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -334,31 +925,77 @@ class Message:
         self.selector.modify(self.sock, events, data=self)
 
     def _read(self):
+        # Receives in place: first the OD header, then the payload of which
+        # the length is then known, never beyond the current message
+        if self._payload_len is None:
+            view = memoryview(self._odheader)[self._recv_len:]
+        else:
+            view = self._recv_view[self._recv_len:]
+        if len(view) < 1:
+            return
         try:
             # Should be ready to read
-            data = self.sock.recv(16777216)
+            nrbytes = self.sock.recv_into(view, min(len(view),recvblocksize))
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
+            if nrbytes:
+                if self._payload_len is None and self._recv_len == 0:
+                    self._recv_start = time.perf_counter()
+                self._recv_len += nrbytes
+            elif self.keepalive and self._payload_len is None and self._recv_len == 0:
+                # Kept-alive connection closed by the client between requests
+                self.close()
             else:
                 raise RuntimeError("Peer closed.")
 
     def _write(self):
-        if self._send_buffer:
+        if self._send_buffers:
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                if hasattr(self.sock, 'sendmsg'):
+                    # Scatter/gather write, straight from the result arrays
+                    sent = self.sock.sendmsg(self._send_buffers[:sendmaxbuffers])
+                else:
+                    sent = self.sock.send(self._send_buffers[0])
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
+                self._consume_send_buffers(sent)
                 # Close when the buffer is drained. The response has been sent.
-                if sent and not self._send_buffer:
-                    self.close()
+                # A kept-alive connection waits for the next request instead
+                if sent and not self._send_buffers:
+                    stats.add_latency('send', time.perf_counter()-self._send_start)
+                    self.nrserved += 1
+                    if self.keepalive and not self.lastmessage:
+                        self._reset()
+                    else:
+                        self.close()
+
+    def _reset(self):
+        """Prepares for the next request on the same connection"""
+        self._recv_len = 0
+        self._payload_len = None
+        self._reqid = None
+        self._subid = None
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self.request = None
+        self.request_error = None
+        self.response_created = False
+        self.sharedmem = False
+        self._set_selector_events_mask("r")
+
+    def _consume_send_buffers(self, sent):
+        while sent > 0 and self._send_buffers:
+            nrbytes = len(self._send_buffers[0])
+            if sent < nrbytes:
+                self._send_buffers[0] = self._send_buffers[0][sent:]
+                return
+            self._send_buffers.pop(0)
+            sent -= nrbytes
 
     def _json_encode(self, obj, encoding):
         json_hdr = json.dumps(obj, ensure_ascii=False).encode(encoding)
@@ -374,44 +1011,89 @@ class Message:
         tiow.close()
         return (json_hdr,obj,json_bytes[hdrlen+json_hdr:])
 
-    def _array_decode(self, arrptr, shapes, dtypes):
+    def _array_decode(self, arrptr, shapes, dtypes, arrnbytes=None):
         offset = 0
         arrs = list()
-        for shape,dtype in zip(shapes,dtypes):
+        for idx,(shape,dtype) in enumerate(zip(shapes,dtypes)):
+          if '+' in dtype:
+            # Compressed: 'dtype+codec', the sizes are in the header
+            (dtype,codec) = dtype.split('+')
+            nrbytes = arrnbytes[idx]
+            arr = applytransport.decompressArray(arrptr[offset:offset+nrbytes],codec,dtype,shape)
+            offset += nrbytes
+            arrs.append( arr )
+            continue
           nrsamples = np.prod(shape,dtype=np.int64)
           arr = np.frombuffer(arrptr,dtype=dtype,count=nrsamples,offset=offset)
           arr = arr.reshape( shape )
-          offset += arr.nbytes
+          offset += arr.nbytes if arrnbytes == None else arrnbytes[idx]
           arrs.append( arr )
         return {
           'action': 'apply',
           'data': arrs
         }
 
+    def _attach_shared(self, shmnames, shapes, dtypes):
+        """Attaches to the shared memory blocks of a client on the same host, the input block must hold the arrays"""
+        if self.sock.family != socket.AF_UNIX:
+            raise ValueError('Shared memory is only accepted from a local client.')
+        if len(shapes) != len(dtypes):
+            raise ValueError('Array shapes and types do not match.')
+        nrbytes = 0
+        for shape,dtype in zip(shapes,dtypes):
+            if min(shape,default=0) < 0:
+                raise ValueError(f'Invalid array shape {shape}.')
+            nrbytes += int(np.prod(shape,dtype=np.int64)) * np.dtype(dtype).itemsize
+        if self._shm_in == None:
+            self._shm_in = applytransport.SharedBuffer()
+            self._shm_out = applytransport.SharedBuffer()
+        self._shm_in.attach(shmnames['input'])
+        self._shm_out.attach(shmnames['output'])
+        if len(self._shm_in.buf) < nrbytes:
+            raise ValueError(f'Shared memory block of {len(self._shm_in.buf)} bytes is too small for {nrbytes} bytes of arrays.')
+        self.sharedmem = True
+        return self._shm_in.buf
+
     def _create_message(
-        self, *, content_bytes, content_type, content_encoding, arrsize
+        self, *, content_bytes, content_type, content_encoding, arrsize, shmname=None,
+        arrnbytes=None
     ):
+        """Returns the message as a list of byte buffers, the content buffers are not copied"""
+        if isinstance(content_bytes, list):
+            content = [memoryview(buf).cast('B') for buf in content_bytes]
+        else:
+            content = [memoryview(content_bytes).cast('B')]
+        content_len = sum([len(buf) for buf in content])
         jsonheader = {
             "byteorder": sys.byteorder,
             "content-type": content_type,
             "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
+            "content-length": content_len,
         }
         if arrsize != None:
           jsonheader.update({ 'array-shape': arrsize })
+        if shmname != None:
+          jsonheader.update({ 'shared-memory': shmname })
+        if arrnbytes != None:
+          jsonheader.update({ 'array-nbytes': arrnbytes })
+        if 'accept-encoding' in self.jsonheader:
+          jsonheader.update({ 'accept-encoding': applytransport.getArrayCodecs() })
+        if self.keepalive:
+          jsonheader.update({ 'keep-alive': True })
         (self,jsonheader) = self._add_debug_str( jsonheader )
         jsonheader_bytes = self._json_encode(jsonheader, 'utf-8')
-        payload = jsonheader_bytes + content_bytes
-        od_hdr =   struct.pack('=i',len(payload)) \
+        od_hdr =   struct.pack('=i',len(jsonheader_bytes)+content_len) \
                  + struct.pack('=i',self._reqid) \
                  + struct.pack('=h',self._subid)
-        return od_hdr + payload
+        return [memoryview(od_hdr + jsonheader_bytes)] + \
+               [buf for buf in content if len(buf) > 0]
 
     def _make_exception_report(self, msg, exc):
         exc_type, exc_obj, exc_tb = sys.exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         stackstr = ''.join(tb.extract_tb(exc_tb,limit=10).format())
-        return f'{msg}:\n{repr(exc)} on line {str(exc_tb.tb_lineno)} of script {fname}\n{stackstr}\n\n{self.applier.debugstr}'
+        debugstr = self.applier.debugstr if self.applier != None else ''
+        return f'{msg}:\n{repr(exc)} on line {str(exc_tb.tb_lineno)} of script {fname}\n{stackstr}\n\n{debugstr}'
 
     def _create_response_json_content(self):
         action = self.request.get('action')
@@ -419,13 +1101,22 @@ class Message:
         if action == 'status':
             content['result'] = 'Server online'
             content['pid'] = psutil.Process().pid
+        elif action == 'stats':
+            content['result'] = stats.report()
+            if self.request.get('reset', False):
+                stats.reset()
         elif action == 'kill':
             content['result'] = 'Kill request received'
             self.lastmessage = True
         elif action == 'outputs':
             try:
-              self.applier.setOutputs( self.request.get('value') )
+              if self.model != None:
+                applier = self.models.set_outputs( self.model, self.request.get('value') )
+              else:
+                applier = self.applier
+                applier.setOutputs( self.request.get('value') )
               content['result'] = 'Output names received'
+              content['warmup'] = applier.warmuptime_
             except Exception as e:
               content = {"result": self._make_exception_report('Start error exception', e)}
         else:
@@ -449,31 +1140,65 @@ class Message:
             else:
                 content = {"result": f'Error: invalid action "{action}".'}
         except Exception as e:
-            content = {'result': self._make_exception_report('Apply error exception', e)}
+            return (self,self.create_error_response(e))
+
+        return (self,self.create_arrays_response(res))
+
+    def is_apply_request(self):
+        return self.jsonheader["content-type"] == 'binary/array' and \
+               self.request.get('action') == 'apply' and len(self.request.get('data')) > 0
+
+    def apply_input(self):
+        """The input block of an apply request, only the last one is applied"""
+        return self.request.get('data')[-1]
+
+    def create_error_response(self, exc):
+        """Reports the exception being handled"""
+        content = {'result': self._make_exception_report('Apply error exception', exc)}
+        if self.applier != None:
             self.applier.debugstr = ''
-            content_encoding = 'utf-8'
-            response = {
-                'content_bytes': self._json_encode(content, content_encoding),
-                'content_type': 'text/json',
-                'content_encoding': content_encoding,
-                'arrsize': None,
-            }
-            return (self,response)
+        content_encoding = 'utf-8'
+        response = {
+            'content_bytes': self._json_encode(content, content_encoding),
+            'content_type': 'text/json',
+            'content_encoding': content_encoding,
+            'arrsize': None,
+        }
+        return response
 
-        ret = bytes()
-        dtypes = list()
-        shapes = list()
+    @timed_stage('encode')
+    def create_arrays_response(self, res):
+        dtypes = [arr.dtype.name for arr in res]
+        shapes = [arr.shape for arr in res]
+        if self.sharedmem and self._shm_out.writeArrays(res):
+            # Written in the output block of the local client, nothing to send
+            return {
+              'content_bytes': b'',
+              'content_type': "binary/array",
+              'content_encoding': dtypes,
+              'arrsize': shapes,
+              'shmname': self._shm_out.name,
+            }
+        if self.codec != None:
+            # Compressed as negotiated with the client
+            ret = [applytransport.compressArray(arr, self.codec) for arr in res]
+            return {
+              'content_bytes': ret,
+              'content_type': "binary/array",
+              'content_encoding': [f'{dtype}+{self.codec}' for dtype in dtypes],
+              'arrsize': shapes,
+              'arrnbytes': [len(buf) for buf in ret],
+            }
+        ret = list()
         for arr in res:
-          ret += arr.tobytes()
-          shapes.append( arr.shape )
-          dtypes.append( arr.dtype.name )
+          ret.append( np.ascontiguousarray(arr) )
         response = {
           'content_bytes': ret,
           'content_type': "binary/array",
           'content_encoding': dtypes,
           'arrsize': shapes,
         }
-        return (self,response)
+        return response
 
     def _create_response_binary_content(self):
         response = {
@@ -502,6 +1227,8 @@ class Message:
 
     def read(self):
         self._read()
+        if self.sock is None:
+            return
 
         if self._payload_len is None:
             self.process_odheader()
@@ -524,6 +1251,9 @@ class Message:
     def close(self):
         try:
             self.selector.unregister(self.sock)
+        except KeyError:
+            # Not registered while the request is in the apply pipeline
+            pass
         except Exception as e:
             print(
                 f"error: selector.unregister() exception for",
@@ -541,54 +1271,116 @@ class Message:
             # Delete reference to socket object for garbage collection
             self.sock = None
 
+        if self._shm_in != None:
+            # The arrays of the request are views on the input block
+            self.request = None
+            self._shm_in.close()
+            self._shm_out.close()
+
     def process_odheader(self):
-        hdrlen = 10
-        if len(self._recv_buffer) >= hdrlen:
-            self._payload_len = struct.unpack('=i',self._recv_buffer[0:4])[0]
-            self._reqid = struct.unpack('=i',self._recv_buffer[4:8])[0]
-            self._subid = struct.unpack('=h',self._recv_buffer[8:hdrlen])[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+        if self._recv_len < odheaderlen:
+            return
+        (self._payload_len,self._reqid,self._subid) = \
+                            struct.unpack('=iih',self._odheader)
+        if self._payload_len < 4:
+            # Not even the length of the JSON header: there is nothing to wait for
+            raise ValueError(f'Invalid payload length {self._payload_len}.')
+        # The payload is received once, in a buffer allocated at its final size,
+        # or in the buffer of a previous request on a kept-alive connection
+        if self._recv_buffer is None or len(self._recv_buffer) < self._payload_len:
+            self._recv_buffer = bytearray(self._payload_len)
+        self._recv_view = memoryview(self._recv_buffer)[:self._payload_len]
+        self._recv_len = 0
 
     def process_jsonheader(self):
-        if len(self._recv_buffer) >= 4:
-            (self._jsonheader_len,self.jsonheader,self._recv_buffer) = \
+        hdrlen = 4
+        if self._recv_len < hdrlen:
+            return
+        jsonheader_len = struct.unpack('=i',self._recv_view[:hdrlen])[0]
+        if jsonheader_len < 0 or hdrlen+jsonheader_len > self._payload_len:
+            raise ValueError(f'Invalid JSON header length {jsonheader_len}.')
+        if self._recv_len < hdrlen+jsonheader_len:
+            return
+        (self._jsonheader_len,self.jsonheader,_) = \
                 self._json_decode(
-                    self._recv_buffer, "utf-8"
+                    bytes(self._recv_view[:hdrlen+jsonheader_len]), "utf-8"
             )
-            for reqhdr in (
-                "byteorder",
-                "content-length",
-                "content-type",
-                "content-encoding",
-            ):
-                if reqhdr not in self.jsonheader:
-                    raise ValueError(f'Missing required header "{reqhdr}".')
+        for reqhdr in (
+            "byteorder",
+            "content-length",
+            "content-type",
+            "content-encoding",
+        ):
+            if reqhdr not in self.jsonheader:
+                raise ValueError(f'Missing required header "{reqhdr}".')
+        self.keepalive = self.jsonheader.get('keep-alive', False) == True
+        if 'model' in self.jsonheader:
+            if self.models == None:
+                # Reported in the response
+                self.request_error = ValueError('This server does not serve several models.')
+            else:
+                # Applies to the next requests on the connection as well
+                self.model = self.jsonheader['model']
+        # Responses are compressed with the first codec accepted by the client
+        accepted = [codec for codec in self.jsonheader.get('accept-encoding', []) \
+                          if codec in applytransport.getArrayCodecs()]
+        self.codec = accepted[0] if accepted else None
 
     def process_request(self):
         content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
+        offset = 4 + self._jsonheader_len
+        if content_len < 0 or offset+content_len > self._payload_len:
+            raise ValueError(f'Invalid content length {content_len}.')
+        if not self._recv_len >= offset+content_len:
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
+        start = time.perf_counter()
+        stats.add_latency('receive', start-self._recv_start)
+        data = self._recv_view[offset:offset+content_len]
         if self.jsonheader["content-type"] == "text/json":
             encoding = self.jsonheader["content-encoding"]
-            (jsonsz,self.request,self._recv_buffer) = \
-                                 self._json_decode(data, encoding)
+            (jsonsz,self.request,_) = \
+                                 self._json_decode(bytes(data), encoding)
         elif self.jsonheader["content-type"] == 'binary/array':
             shapes = self.jsonheader['array-shape']
             dtypes = self.jsonheader['content-encoding']
-            self.request = self._array_decode(data,shapes,dtypes)
+            arrnbytes = self.jsonheader.get('array-nbytes')
+            if 'shared-memory' in self.jsonheader:
+                # Local client: the arrays are in its shared memory, not in the message
+                try:
+                    data = self._attach_shared(self.jsonheader['shared-memory'],shapes,dtypes)
+                except Exception as e:
+                    # Reported in the response, no arrays are read
+                    self.request_error = e
+                    shapes = dtypes = list()
+            # The arrays are views on the receive buffer, not copies, unless compressed
+            self.request = self._array_decode(data,shapes,dtypes,arrnbytes)
         else:
             # Binary or unknown content-type
-            self.request = data
+            self.request = bytes(data)
             print(
                 f'received {self.jsonheader["content-type"]} request from',
                 self.addr,
             )
-        # Set selector to listen for write events, we're done reading.
-        self._set_selector_events_mask("w")
+        stats.add_latency('decode', time.perf_counter()-start)
+        if self.pipeline != None:
+            # Done reading, the response is created by the inference worker
+            self.pipeline.submit(self)
+        else:
+            # Set selector to listen for write events, we're done reading.
+            self._set_selector_events_mask("w")
 
-    def create_response(self):
+    def resolve_applier(self):
+        """Sets the applier of the model requested on this connection, if any"""
+        if self.model != None:
+            self.applier = self.models.get(self.model)
+
+    def create_response_content(self):
+        try:
+            if self.request_error != None:
+                raise self.request_error
+            self.resolve_applier()
+        except Exception as e:
+            return self.create_error_response(e)
         if self.jsonheader["content-type"] == 'text/json':
             response = self._create_response_json_content()
         elif self.jsonheader["content-type"] == 'binary/array':
@@ -596,6 +1388,18 @@ class Message:
         else:
             # Binary or unknown content-type
             response = self._create_response_binary_content()
+        return response
+
+    def create_response(self):
+        self._queue_response(self.create_response_content())
+
+    def response_ready(self, response):
+        """Sends the response created by the pipeline"""
+        self._queue_response(response)
+        self.selector.register(self.sock, selectors.EVENT_WRITE, data=self)
+
+    def _queue_response(self, response):
         message = self._create_message(**response)
         self.response_created = True
-        self._send_buffer += message
+        self._send_buffers += message
+        self._send_start = time.perf_counter()
@@ -0,0 +1,126 @@
+#
+# (C) dGB Beheer B.V.; (LICENSE) http://opendtect.org/OpendTect_license.txt
+# AUTHOR   : A. Huck
+# DATE     : June 2019
+#
+# Deep learning apply server/client array transport
+#
+#
+
+import os
+import numpy as np
+from multiprocessing import shared_memory
+
+sharedpagesize = 65536
+
+class SharedBuffer:
+    """
+    Shared memory block holding consecutive arrays, for the apply requests
+    and responses of a client and a server on the same host. The block
+    is created by the client, and reused for as long as it is large enough.
+    """
+    def __init__(self):
+        self.shm = None
+        self._owner = None
+
+    @property
+    def name(self):
+        return None if self.shm == None else self.shm.name
+
+    @property
+    def buf(self):
+        return None if self.shm == None else self.shm.buf
+
+    def reserve(self, nrbytes):
+        """Ensures an own block of at least nrbytes, a new block is created if needed. Returns its name"""
+        if self.shm == None or self._owner != os.getpid() or self.shm.size < nrbytes:
+            self._release()
+            size = max( -(-nrbytes//sharedpagesize), 1 ) * sharedpagesize
+            self.shm = shared_memory.SharedMemory( create=True, size=size )
+            self._owner = os.getpid()
+        return self.shm.name
+
+    def attach(self, name):
+        """Attaches to the block created by the other process, unless already attached"""
+        if self.shm != None and self._owner == None and self.shm.name.lstrip('/') == name.lstrip('/'):
+            return
+        self._release()
+        try:
+            self.shm = shared_memory.SharedMemory( name=name, track=False )
+        except TypeError:
+            self.shm = shared_memory.SharedMemory( name=name )
+            if os.name == 'posix':
+                # the block is not ours to unlink when this process ends
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister( self.shm._name, 'shared_memory' )
+
+    def writeArrays(self, arrs):
+        """Copies arrays one after the other to the block. Returns False, without writing, if they do not fit"""
+        nrbytes = sum( [arr.nbytes for arr in arrs] )
+        if self.shm == None or self.shm.size < nrbytes:
+            return False
+        offset = 0
+        for arr in arrs:
+            np.ndarray( arr.shape, dtype=arr.dtype, buffer=self.shm.buf, offset=offset )[...] = arr
+            offset += arr.nbytes
+        return True
+
+    def _release(self):
+        if self.shm == None:
+            return
+        if self._owner == os.getpid():
+            self.shm.unlink()
+        self.shm.close()
+        self.shm = None
+        self._owner = None
+
+    def close(self):
+        """Releases the block, it is unlinked if owned. No arrays may still be views on it"""
+        self._release()
+
+arraycodecs = ('shuffle-zstd', 'shuffle-lz4', 'shuffle-zlib')
+availablearraycodecs = None
+
+def getArrayCodec_(codec):
+    # (compress, decompress) functions, None if not available
+    if codec == 'shuffle-zlib':
+        import zlib
+        return (lambda data: zlib.compress(data, 1), zlib.decompress)
+    if codec == 'shuffle-lz4':
+        try:
+            import lz4.frame
+        except ModuleNotFoundError:
+            return None
+        return (lz4.frame.compress, lz4.frame.decompress)
+    if codec == 'shuffle-zstd':
+        try:
+            from compression import zstd
+            return (lambda data: zstd.compress(data, 1), zstd.decompress)
+        except ImportError:
+            pass
+        try:
+            import zstandard
+        except ModuleNotFoundError:
+            return None
+        return (zstandard.ZstdCompressor(level=1).compress, zstandard.ZstdDecompressor().decompress)
+    return None
+
+def getArrayCodecs():
+    """Gets the codecs available for compressing the arrays, fastest first"""
+    global availablearraycodecs
+    if availablearraycodecs == None:
+        availablearraycodecs = [codec for codec in arraycodecs if getArrayCodec_(codec) != None]
+    return availablearraycodecs
+
+def compressArray(arr, codec):
+    """Compresses an array with one of getArrayCodecs(), after shuffling its bytes by significance"""
+    arr = np.ascontiguousarray( arr ).reshape( -1 )
+    shuffled = np.ascontiguousarray( arr.view(np.uint8).reshape((-1,arr.dtype.itemsize)).T )
+    return getArrayCodec_( codec )[0]( shuffled )
+
+def decompressArray(data, codec, dtype, shape):
+    """Decompresses an array compressed with compressArray"""
+    dtype = np.dtype( dtype )
+    shuffled = np.frombuffer( getArrayCodec_(codec)[1](data), dtype=np.uint8 )
+    shuffled = shuffled.reshape( (dtype.itemsize,-1) )
+    return np.ascontiguousarray( shuffled.T ).view( dtype ).reshape( shape )
@@ -29,7 +29,8 @@ try:
   from keras.callbacks import Callback
 except ModuleNotFoundError:
   pass
-from dgbpy.mlio import announceShowTensorboard, announceTrainingFailure, announceTrainingSuccess
+from dgbpy.mlio import announceShowTensorboard, announceTrainingFailure, announceTrainingSuccess, \
+                        TrainingDataPrefetcher, BatchWorkerPool
 
 def hasKeras():
   try:
@@ -86,7 +87,11 @@ keras_dict = {
   'transform': default_transforms,
   'scale': dgbkeys.globalstdtypestr,
   'withtensorboard': withtensorboard,
-  'tofp16': True
+  'tofp16': True,
+  'lazyload': False,
+  'lazycachedir': None,
+  'prefetchmem': 0,
+  'nbworkers': 0
 }
 
 def can_use_gpu():
@@ -131,7 +136,9 @@ def getParams( dodec=keras_dict[dgbkeys.decimkeystr], nbchunk=keras_dict['nbchun
                learnrate=keras_dict['learnrate'],epochdrop=keras_dict['epochdrop'],
                nntype=keras_dict['type'],prefercpu=keras_dict['prefercpu'],transform=keras_dict['transform'],
                validation_split=keras_dict['split'], nbfold=keras_dict['nbfold'], savetype = keras_dict['savetype'],
-               scale = keras_dict['scale'],withtensorboard=keras_dict['withtensorboard'], tofp16=keras_dict['tofp16']):
+               scale = keras_dict['scale'],withtensorboard=keras_dict['withtensorboard'], tofp16=keras_dict['tofp16'],
+               lazyload=keras_dict['lazyload'], lazycachedir=keras_dict['lazycachedir'],
+               prefetchmem=keras_dict['prefetchmem'], nbworkers=keras_dict['nbworkers']):
   ret = {
     dgbkeys.decimkeystr: dodec,
     'nbchunk': nbchunk,
@@ -147,7 +154,11 @@ def getParams( dodec=keras_dict[dgbkeys.decimkeystr], nbchunk=keras_dict['nbchun
     'transform': transform,
     'scale': scale,
     'withtensorboard': withtensorboard,
-    'tofp16': tofp16
+    'tofp16': tofp16,
+    'lazyload': lazyload,
+    'lazycachedir': lazycachedir,
+    'prefetchmem': prefetchmem,
+    'nbworkers': nbworkers
   }
   if prefercpu == None:
     prefercpu = get_cpu_preference()
@@ -468,9 +479,23 @@ def train(model,training,params=keras_dict,trainfile=None,silent=False,cbfn=None
     monitor = 'loss'
   batchsize = params['batch']
   transform, scale = params['transform'], params['scale']
-  train_datagen = TrainingSequence( training, False, model, exfilenm=trainfile, batch_size=batchsize, scale=scale, transform=transform, tempnm=tempnm )
-  validate_datagen = TrainingSequence( training, True, model, exfilenm=trainfile, batch_size=batchsize, scale=scale )
+  lazy, lazycachedir = params.get('lazyload', False), params.get('lazycachedir')
+  train_datagen = TrainingSequence( training, False, model, exfilenm=trainfile, batch_size=batchsize, scale=scale, transform=transform, tempnm=tempnm,
+                                    lazy=lazy, lazycachedir=lazycachedir )
+  validate_datagen = TrainingSequence( training, True, model, exfilenm=trainfile, batch_size=batchsize, scale=scale,
+                                       lazy=lazy, lazycachedir=lazycachedir )
   nbchunks = len( infos[dgbkeys.trainseldicstr] )
+  prefetcher = None
+  if not lazy and (nbchunks > 1 or dgbhdf5.isCrossValidation(infos)):
+    prefetcher = TrainingDataPrefetcher( infos, maxmemory=params.get('prefetchmem') )
+    train_datagen.set_prefetcher( prefetcher )
+    validate_datagen.set_prefetcher( prefetcher )
+  pool = None
+  nbworkers = params.get('nbworkers', 0)
+  if not lazy and nbworkers and nbworkers > 0:
+    pool = BatchWorkerPool( nbworkers )
+    train_datagen.set_workers( pool )
+    validate_datagen.set_workers( pool )
 
   for ichunk in range(nbchunks):
     log_msg('Starting training iteration',str(ichunk+1)+'/'+str(nbchunks))
@@ -520,6 +545,13 @@ def train(model,training,params=keras_dict,trainfile=None,silent=False,cbfn=None
 
     restore_stdout()
 
+  if prefetcher != None:
+    prefetcher.close()
+  if pool != None:
+    train_datagen.set_workers( None )
+    validate_datagen.set_workers( None )
+    pool.close()
+
   try:
     keras.utils.print_summary( model, print_fn=log_msg )
   except:
@@ -682,6 +714,10 @@ def apply( model, info, samples, isclassification, withpred, withprobs, \
   img2img = dgbhdf5.isImg2Img(info)
   if img2img:
     samples = adaptToModel_img2img(model, samples, sample_data_format=data_format)
+  elif not samples.flags.c_contiguous:
+    adapter = getModelAdapter( model, inp_shape[1:], dictinpshape, sample_data_format=data_format )
+    samples = kc.ApplySequence( samples, adapter, batch_size=batch_size )
+    batch_size = None
   else:
     samples = adaptToModel( model, samples, dictinpshape, sample_data_format=data_format )
 
@@ -928,6 +964,72 @@ def adaptToModel( model, samples, dictinpshape=None, sample_data_format='channel
       return ret
   return samples
 
+def getModelAdapter( model, sampleshape, dictinpshape=None, sample_data_format='channels_first' ):
+  """ Precomputes the adaptation done by adaptToModel, for batches of samples
+      of a given shape
+
+  Parameters:
+    * model (keras.Model): model the samples are to be given to
+    * sampleshape (tuple): shape of a single sample (without the batch dimension)
+    * dictinpshape (tuple): input shape from the example file, used if the model
+                            has no fixed input shape
+    * sample_data_format (str): 'channels_first' or 'channels_last'
+
+  Returns:
+    * function: returns a batch of samples of that shape in the layout expected by the model,
+                equivalent to adaptToModel
+  """
+
+  nrdims = len( model.input_shape ) - 2
+  samples_nrdims = len(sampleshape) + 1
+  model_data_format = get_data_format( model )
+  modelcubeszs = getCubeletShape( model )
+  if not hasValidCubeletShape(modelcubeszs) and dictinpshape != None:
+    modelcubeszs = dictinpshape
+  if not hasValidCubeletShape(modelcubeszs):
+    raise Exception("Invalid input shape found")
+  if sample_data_format == 'channels_first':
+    nrattribs = sampleshape[0]
+    cube_shape = sampleshape[1:]
+  else:
+    nrattribs = sampleshape[-1]
+    cube_shape = sampleshape[:-1]
+  shapelims = ()
+  idx = 0
+  shrinked = False
+  for i in cube_shape:
+    if i == 1:
+      dimsz = 1
+    else:
+      dimsz = min(i,modelcubeszs[idx])
+      if dimsz < i:
+        shrinked = True
+      idx += 1
+    shapelims += (dimsz,)
+  cube_shape = np.squeeze( np.empty( shapelims, dtype='uint8' ) ).shape
+  datadims = len(cube_shape)
+  if len(cube_shape) < 1:
+    cube_shape = (1,)
+  switchedattribs = model_data_format != sample_data_format
+  doadapt = switchedattribs or nrdims != datadims or shrinked or datadims < len(shapelims)
+  if not doadapt or not nrdims in (1,2,3) or not samples_nrdims in (3,4,5):
+    return lambda samples: samples
+
+  crop = (slice(None),)
+  if sample_data_format == 'channels_first':
+    crop += (slice(None),)
+  crop += tuple( [slice(0,lim) for lim in shapelims] )
+  def adapt( samples ):
+    ret = samples[crop]
+    if sample_data_format == 'channels_last':
+      ret = np.moveaxis( ret, -1, 1 )
+    ret = np.reshape( ret, (len(samples),nrattribs)+cube_shape )
+    if model_data_format == 'channels_last':
+      ret = np.moveaxis( ret, 1, -1 )
+    return np.ascontiguousarray( ret )
+
+  return adapt
+
 def adaptFromModel( model, samples, inp_shape, ret_data_format ):
   nrdims = len( model.output_shape )
   if nrdims == 2:
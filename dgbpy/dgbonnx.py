@@ -1,11 +1,19 @@
 import numpy as np
 import onnx
 import onnxruntime as rt
+try:
+    from onnxruntime.capi.onnxruntime_pybind11_state import InvalidArgument
+except ImportError:
+    # Not a public module of onnxruntime, the error is then recognized by its message
+    InvalidArgument = None
+from odpy.common import log_msg
 import dgbpy.keystr as dgbkeys
 import dgbpy.hdf5 as dgbhdf5
 import odpy.hdf5 as odhdf5
 import dgbpy.onnx_classes as oc
 
+defbatchsz = 32
+
 def get_model_shape( shape, nrattribs, attribfirst=True ):
     ret = ()
     if attribfirst:
@@ -65,6 +73,8 @@ class OnnxModel():
         self.onnx_mdl = onnx.load(self.name)
         self.metadata = {x.key: x.value for x in self.onnx_mdl.metadata_props}
         inshape = self.input_shape()
+        # A batch axis declared without a fixed size, like the torch exporter dynamic_axes
+        self.dynamic_batch = len(inshape) > 0 and inshape[0] == 0
         self.data_format = self.metadata.get('data_format', oc.dataformat(self.onnx_mdl))
         providers = [dgbkeys.onnxcudastr, dgbkeys.onnxcpustr]
         try:
@@ -122,20 +132,48 @@ class OnnxModel():
     def num_inputs(self):
         return len(self.onnx_mdl.graph.input)
 
-def apply( model, infos, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, dictinpshape, dictoutshape, nroutputs):
+def isInvalidArgument( exc ):
+    """ Whether an exception of a session run is an onnxruntime invalid argument error """
+    if InvalidArgument != None:
+        return isinstance(exc, InvalidArgument)
+    return 'INVALID_ARGUMENT' in str(exc)
+
+def _predict_batches( model, samples, batch_size ):
+    nrsamples = len(samples)
+    predictions = np.empty((0,))
+    for start in range(0, nrsamples, batch_size):
+        pred = model(samples[start:start+batch_size])
+        if start == 0:
+            predictions = np.empty((nrsamples,)+pred.shape[1:], dtype=pred.dtype)
+        predictions[start:start+len(pred)] = pred
+    return predictions
+
+def predict( model, samples, batch_size=None ):
+    """ Runs the model on the samples, with one session run per batch along
+    the dynamic batch axis of the model. Models without a dynamic batch axis,
+    or rejecting the batches as invalid arguments, are run one sample at a time.
+    Returns the predictions of all samples in a single array
+    """
+    if not model.dynamic_batch:
+        return _predict_batches(model, samples, 1)
+    if batch_size == None:
+        batch_size = defbatchsz
+    try:
+        return _predict_batches(model, samples, batch_size)
+    except Exception as e:
+        if batch_size == 1 or not isInvalidArgument(e):
+            raise
+        log_msg( 'ONNX model does not accept batches of', batch_size, 'samples, applying one sample at a time:', e )
+        model.dynamic_batch = False
+        return _predict_batches(model, samples, 1)
+
+def apply( model, infos, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, dictinpshape, dictoutshape, nroutputs, batch_size=None):
     ret = {}
     res = None
     img2img = dgbhdf5.isImg2Img(infos)
     nroutputs = dgbhdf5.getNrOutputs(infos)
 
-    predictions = []
-    for input in samples:
-        input = np.expand_dims(input, axis=0)
-        pred = model(input)
-        for _ in pred:
-            predictions.append(_)
-
-    predictions = np.array(predictions)
+    predictions = predict(model, samples, batch_size)
     if withpred:
         if isclassification:
             if not (doprobabilities or withconfidence):
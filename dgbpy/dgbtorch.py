@@ -110,6 +110,10 @@ torch_dict = {
     'transform':default_transforms,
     'withtensorboard': withtensorboard,
     'tofp16': True,
+    'lazyload': False,
+    'lazycachedir': None,
+    'prefetchmem': 0,
+    'nbworkers': 0,
 }
 
 def getMLPlatform():
@@ -178,7 +182,11 @@ def getParams(
     transform=torch_dict['transform'],
     withtensorboard=torch_dict['withtensorboard'],
     savetype = defsavetype,
-    tofp16=torch_dict['tofp16']):
+    tofp16=torch_dict['tofp16'],
+    lazyload=torch_dict['lazyload'],
+    lazycachedir=torch_dict['lazycachedir'],
+    prefetchmem=torch_dict['prefetchmem'],
+    nbworkers=torch_dict['nbworkers']):
   ret = {
     dgbkeys.decimkeystr: dodec,
     'type': nntype,
@@ -196,6 +204,10 @@ def getParams(
     'savetype': savetype,
     'withtensorboard': withtensorboard,
     'tofp16': tofp16,
+    'lazyload': lazyload,
+    'lazycachedir': lazycachedir,
+    'prefetchmem': prefetchmem,
+    'nbworkers': nbworkers,
   }
   if prefercpu == None:
     prefercpu = not can_use_gpu()
@@ -444,7 +456,9 @@ def save( model, outfnm, infos, params=torch_dict ):
 
 def train(model, imgdp, params, cbfn=None, logdir=None, silent=False, metrics=False):
     from dgbpy.torch_classes import Trainer, AdaptiveLR
-    trainloader, testloader = DataGenerator(imgdp,batchsize=params['batch'],scaler=params['scale'],transform=params['transform'])
+    trainloader, testloader = DataGenerator(imgdp,batchsize=params['batch'],scaler=params['scale'],transform=params['transform'],
+                                            lazy=params.get('lazyload',False),lazycachedir=params.get('lazycachedir'),
+                                            prefetchmem=params.get('prefetchmem'),nbworkers=params.get('nbworkers',0))
     info = imgdp[dgbkeys.infodictstr]
     criterion = get_criterion(info, params)
     optimizer = torch.optim.Adam(model.parameters(), lr=params['learnrate'])
@@ -474,6 +488,9 @@ def train(model, imgdp, params, cbfn=None, logdir=None, silent=False, metrics=Fa
         tofp16=params['tofp16']
     )
     model = trainer.fit(cbs = cbfn)
+    for dataset in (trainloader.dataset, testloader.dataset):
+        if dataset.shared != None:
+            dataset.shared.close()
     return model
 
 def transfer(model, info=None ):
@@ -645,9 +662,12 @@ class ChunkedDataLoader(DataLoader):
         for batch in super().__iter__():
             yield batch
 
-def getDataLoaders(traindataset, testdataset, batchsize=torch_dict['batch']):
-    trainloader = ChunkedDataLoader(dataset=traindataset, batch_size=batchsize, shuffle=False, drop_last=True)
-    testloader= ChunkedDataLoader(dataset=testdataset, batch_size=batchsize, shuffle=False, drop_last=True)
+def getDataLoaders(traindataset, testdataset, batchsize=torch_dict['batch'], nbworkers=0):
+    workerpars = {}
+    if nbworkers and nbworkers > 0: # workers persist across epochs, and chunks through the shared arrays
+        workerpars = {'num_workers': nbworkers, 'persistent_workers': True}
+    trainloader = ChunkedDataLoader(dataset=traindataset, batch_size=batchsize, shuffle=False, drop_last=True, **workerpars)
+    testloader= ChunkedDataLoader(dataset=testdataset, batch_size=batchsize, shuffle=False, drop_last=True, **workerpars)
     return trainloader, testloader
 
 def getDatasetPars(imgdp, _forvalid):
@@ -659,15 +679,29 @@ def getDatasetPars(imgdp, _forvalid):
       x_data = imgdp[dgbkeys.xtraindictstr]
       y_data = imgdp[dgbkeys.ytraindictstr]
     inp_ch = x_data.shape[1]
+    ndims = getNrDims(info)
+    return x_data, y_data, info, inp_ch, ndims
+
+def getNrDims(info):
     attribs = dgbhdf5.getNrAttribs(info)
     model_shape = get_model_shape(info[dgbkeys.inpshapedictstr], attribs, True)
-    ndims = getModelDims(model_shape, True)
-    return x_data, y_data, info, inp_ch, ndims
+    return getModelDims(model_shape, True)
 
-def DataGenerator(imgdp, batchsize, scaler=None, transform=list()):
+def DataGenerator(imgdp, batchsize, scaler=None, transform=list(), lazy=False, lazycachedir=None, prefetchmem=None, nbworkers=0):
     from dgbpy.torch_classes import TrainDatasetClass, TestDatasetClass
-    train_dataset = TrainDatasetClass(imgdp, scaler, transform=transform)
-    test_dataset = TestDatasetClass(imgdp, scaler)
-
-    trainloader, testloader = getDataLoaders(train_dataset, test_dataset, batchsize)
+    from dgbpy.mlio import TrainingDataPrefetcher, SharedArrays
+    train_dataset = TrainDatasetClass(imgdp, scaler, transform=transform, lazy=lazy, lazycachedir=lazycachedir)
+    test_dataset = TestDatasetClass(imgdp, scaler, lazy=lazy, lazycachedir=lazycachedir)
+    info = imgdp[dgbkeys.infodictstr]
+    if not lazy and (len(info[dgbkeys.trainseldicstr]) > 1 or dgbhdf5.isCrossValidation(info)):
+        prefetcher = TrainingDataPrefetcher(info, maxmemory=prefetchmem)
+        train_dataset.prefetcher = prefetcher
+        test_dataset.prefetcher = prefetcher
+    if lazy:
+        nbworkers = 0
+    if nbworkers and nbworkers > 0:
+        train_dataset.shared = SharedArrays()
+        test_dataset.shared = SharedArrays()
+
+    trainloader, testloader = getDataLoaders(train_dataset, test_dataset, batchsize, nbworkers)
     return trainloader, testloader
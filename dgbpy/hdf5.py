@@ -9,6 +9,9 @@ import os
 import random
 import json
 import ast
+import copy
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from enum import Enum
 
@@ -30,37 +33,75 @@ def dictAddIfNew( newset, toadd ):
   return ret
 
 def getCubeLetNames( info ):
+  """ Gets the dataset indices of all collections of all example groups,
+      in a single pass over the example file
+
+  Parameters:
+    * info (dict): information about example file
+
+  Returns:
+    * dict: {groupnm: {collnm: indices array}}
+  """
+
   examples = info[exampledictstr]
   ret = {}
+  h5file = odhdf5.openFile( info[filedictstr], 'r' )
   for groupnm in examples:
     example = examples[groupnm]
-    ret.update({groupnm: getCubeLetNamesByGroup(info,groupnm,example)} )
+    ret.update({groupnm: getCubeLetIndicesByGroup(h5file,groupnm,example[collectdictstr])} )
+  h5file.close()
   return ret
 
 def getCubeLetNamesByGroup( info, groupnm, example ):
-  collection = example[collectdictstr]
-  ret = {}
-  for collnm in collection:
-    itmidx = collection[collnm][iddictstr]
-    ret.update({collnm: getCubeLetNamesByGroupByItem(info,groupnm,collnm,itmidx)})
+  h5file = odhdf5.openFile( info[filedictstr], 'r' )
+  ret = getCubeLetIndicesByGroup( h5file, groupnm, example[collectdictstr] )
+  h5file.close()
   return ret
 
 def getCubeLetNamesByGroupByItem( info, groupnm, collnm, idx ):
   h5file = odhdf5.openFile( info[filedictstr], 'r' )
+  ret = getCubeLetIndicesByGroup( h5file, groupnm, {collnm: {iddictstr: idx}} )
+  h5file.close()
+  return ret[collnm]
+
+def getIndexArray( nrpts ):
+  if nrpts <= np.iinfo(np.int32).max:
+    return np.arange( nrpts, dtype=np.int32 )
+  return np.arange( nrpts, dtype=np.int64 )
+
+def getCubeLetIndicesByGroup( h5file, groupnm, collection ):
+  """ Gets the dataset indices of the collections of one example group
+
+  Parameters:
+    * h5file (h5py.File): opened example file
+    * groupnm (str): example group name
+    * collection (dict): collections of that group, from the example info
+
+  Returns:
+    * dict: {collnm: indices array}, dataset names for older files
+  """
+
   if not groupnm in h5file:
-    return {}
+    return {collnm: {} for collnm in collection}
   group = h5file[groupnm]
   dsetnms = list(group.keys())
-  if collnm in dsetnms:
-    ret = np.arange(len(group[collnm][xdatadictstr]))
-  elif len(dsetnms)==1 and collnm in dsetnms[0].split('`'):  # img2img multi-target
-    ret = np.arange(len(group[dsetnms[0]][xdatadictstr]))
-  else:
-    dsetnms = list(map(str, dsetnms))
-    dsetwithinp = np.chararray.startswith( dsetnms, str(idx)+':' )
-    ret = np.extract( dsetwithinp, dsetnms )
-  h5file.close()
-  return np.ndarray.tolist(ret)
+  alldsetnms = set( dsetnms )
+  dsetnmsbyidx = None
+  ret = {}
+  for collnm in collection:
+    if collnm in alldsetnms:
+      ret.update({collnm: getIndexArray(group[collnm][xdatadictstr].shape[0])})
+    elif len(dsetnms)==1 and collnm in dsetnms[0].split('`'):  # img2img multi-target
+      ret.update({collnm: getIndexArray(group[dsetnms[0]][xdatadictstr].shape[0])})
+    else:
+      if dsetnmsbyidx is None:
+        dsetnmsbyidx = {}
+        for dsetnm in map(str, dsetnms):
+          if ':' in dsetnm:
+            dsetnmsbyidx.setdefault( dsetnm.split(':')[0], [] ).append( dsetnm )
+      itmidx = str(collection[collnm][iddictstr])
+      ret.update({collnm: np.array(dsetnmsbyidx.get(itmidx,[]), dtype=str)})
+  return ret
 
 def getGroupSize( filenm, groupnm ):
   h5file = odhdf5.openFile( filenm, 'r' )
@@ -344,6 +385,208 @@ def getOutdType( classinfo, hasunlabels ):
     else:
       return np.uint64
 
+def getContiguousRuns( idxs ):
+  """ Sorts dataset indices and coalesces them into contiguous runs
+
+  Parameters:
+    * idxs (iterable of int): dataset indices
+
+  Returns:
+    * tuple: (sorted indices, start positions, stop positions) of each run
+             within the sorted indices
+  """
+
+  sortedidxs = np.sort( np.asarray(idxs, dtype=np.int64) )
+  if len(sortedidxs) < 1:
+    return (sortedidxs, sortedidxs, sortedidxs)
+  breaks = np.flatnonzero( np.diff(sortedidxs) != 1 ) + 1
+  starts = np.concatenate( ([0], breaks) )
+  stops = np.concatenate( (breaks, [len(sortedidxs)]) )
+  return (sortedidxs, starts, stops)
+
+def readDatasetRuns( dset, idxs, out ):
+  """ Reads a selection of rows of an HDF5 dataset into a preallocated array,
+      with a single read per contiguous run of indices.
+      Rows are stored in ascending index order.
+
+  Parameters:
+    * dset (h5py.Dataset): dataset with one row per example
+    * idxs (iterable of int): selected rows
+    * out (ndarray): C-contiguous output array of len(idxs) rows
+
+  Returns:
+    * bool: False if the selection could not be read that way, in which
+            case out is left untouched
+  """
+
+  idxs = np.asarray( idxs )
+  if not np.issubdtype(idxs.dtype, np.integer) or not out.flags.c_contiguous:
+    return False
+  rowshape = dset.shape[1:]
+  if np.prod(rowshape, dtype=np.int64) != np.prod(out.shape[1:], dtype=np.int64):
+    return False
+  dest = out.reshape( (len(out),)+rowshape )
+  (sortedidxs,starts,stops) = getContiguousRuns( idxs )
+  for start,stop in zip(starts,stops):
+    first = sortedidxs[start]
+    dset.read_direct( dest, np.s_[first:first+stop-start], np.s_[start:stop] )
+  return True
+
+def readDatasetRows( dset, idxs, out ):
+  """ Reads a selection of rows of an HDF5 dataset into a preallocated array,
+      in ascending index order. Uses readDatasetRuns when possible,
+      and reads row by row otherwise.
+  """
+
+  if readDatasetRuns( dset, idxs, out ):
+    return
+  for idx,dsetnm in enumerate(np.sort(idxs)):
+    out[idx] = np.resize( dset[dsetnm], out[idx].shape )
+
+statsblocksize = 1024
+statsversion = 1
+statssidecarext = '.stats.hdf5'
+
+def getExampleStats_( x_data, nrattribs ):
+  """ Gets per example statistics of input examples
+
+  Parameters:
+    * x_data (ndarray): input examples
+    * nrattribs (int): number of input attributes
+
+  Returns:
+    * ndarray: float64 array of shape (nrexamples,nrattribs,4) with the mean,
+               sum of squared deviations (M2), minimum and maximum of each attribute
+               of each example
+  """
+
+  x_data = np.reshape( np.asarray(x_data,dtype=np.float32), (len(x_data),nrattribs,-1) )
+  x_data = x_data.astype( np.float64 )
+  mean = np.mean( x_data, axis=2 )
+  m2 = np.sum( np.square(x_data-mean[:,:,np.newaxis]), axis=2 )
+  return np.stack( (mean, m2, np.min(x_data,axis=2), np.max(x_data,axis=2)), axis=2 )
+
+def getStatsSidecarName( filenm ):
+  return filenm + statssidecarext
+
+def writeExampleStats( infos, force=False, blocksize=statsblocksize ):
+  """ Stores the statistics of all input examples in a sidecar file next to the
+      example file (see getExampleStats_), which is not modified. Scalers can then
+      be computed from these statistics, for any selection of examples.
+      The statistics are only used while the example file is unchanged.
+
+  Parameters:
+    * infos (dict): information about example file
+    * force (bool): recompute the statistics if already present
+    * blocksize (int): maximum number of examples read at once
+
+  Returns:
+    * int: number of datasets for which statistics were written
+  """
+
+  filenm = infos[filedictstr]
+  if not force:
+    statsfile = openExampleStats( filenm )
+    if statsfile != None:
+      statsfile.close()
+      return 0
+
+  key = getInfoCacheKey( filenm )
+  sidecarfnm = getStatsSidecarName( filenm )
+  tmpfnm = sidecarfnm + '.' + str(os.getpid()) + '.tmp'
+  nrattribs = getNrAttribs( infos )
+  nrwritten = 0
+  h5file = odhdf5.openFile( filenm, 'r' )
+  statsfile = odhdf5.openFile( tmpfnm, 'w' )
+  try:
+    for groupnm in h5file:
+      group = h5file[groupnm]
+      if not hasattr(group,'keys'):
+        continue
+      for collnm in group:
+        grp = group[collnm]
+        if not hasattr(grp,'keys') or not xdatadictstr in grp:
+          continue
+        x_data = grp[xdatadictstr]
+        nrpts = len(x_data)
+        if nrpts < 1:
+          continue
+        statsgrp = statsfile.require_group( groupnm ).require_group( collnm )
+        stats = statsgrp.create_dataset( xstatsdictstr, (nrpts,nrattribs,4), dtype=np.float64 )
+        for start in range( 0, nrpts, blocksize ):
+          stop = min( start+blocksize, nrpts )
+          stats[start:stop] = getExampleStats_( x_data[start:stop], nrattribs )
+        stats.attrs['Count'] = np.prod( x_data.shape[1:], dtype=np.int64 ) // nrattribs
+        nrwritten += 1
+    statsfile.attrs['Version'] = statsversion
+    statsfile.attrs['Size'] = key[1]
+    statsfile.attrs['MTimeNs'] = key[2]
+  except Exception:
+    statsfile.close()
+    os.remove( tmpfnm )
+    raise
+  finally:
+    h5file.close()
+  statsfile.close()
+  os.replace( tmpfnm, sidecarfnm )
+  return nrwritten
+
+def openExampleStats( filenm ):
+  """ Opens the statistics sidecar file of an example file (see writeExampleStats)
+
+  Returns:
+    * h5py.File: opened statistics file, or None if missing or out of date
+  """
+
+  sidecarfnm = getStatsSidecarName( filenm )
+  key = getInfoCacheKey( filenm )
+  if key == None or not os.path.isfile( sidecarfnm ):
+    return None
+  try:
+    statsfile = odhdf5.openFile( sidecarfnm, 'r' )
+  except OSError:
+    return None
+  attrs = statsfile.attrs
+  if attrs.get('Version') != statsversion or attrs.get('Size') != key[1] or \
+     attrs.get('MTimeNs') != key[2]:
+    statsfile.close()
+    return None
+  return statsfile
+
+def getExampleStats( statsfile, groupnm, collnm, idxs=None ):
+  """ Gets the statistics of a selection of input examples (see writeExampleStats),
+      without reading the input examples
+
+  Parameters:
+    * statsfile (h5py.File): opened statistics file (see openExampleStats)
+    * groupnm (str): group name
+    * collnm (str): dataset name within that group
+    * idxs (iterable of int): selected examples, all examples if None
+
+  Returns:
+    * tuple: count, mean, M2, minimum and maximum arrays of each attribute
+             of each selected example, or None if no statistics are available
+  """
+
+  if not groupnm in statsfile or not collnm in statsfile[groupnm]:
+    return None
+  grp = statsfile[groupnm][collnm]
+  if not xstatsdictstr in grp:
+    return None
+  stats = grp[xstatsdictstr]
+  if idxs is None:
+    values = stats[()]
+  else:
+    idxs = np.asarray( idxs )
+    if not np.issubdtype(idxs.dtype, np.integer):
+      return None
+    values = np.empty( (len(idxs),)+stats.shape[1:], dtype=np.float64 )
+    readDatasetRows( stats, idxs, values )
+  if len(values) < 1:
+    return None
+  count = np.full( values.shape[:2], stats.attrs['Count'], dtype=np.float64 )
+  return ( count, values[:,:,0], values[:,:,1], values[:,:,2], values[:,:,3] )
+
 def getCubeLets_img2img_multitarget( infos, collection, groupnm ):
   inpnrattribs = getNrAttribs( infos )
   outnrattribs = getNrOutputs( infos )
@@ -374,11 +617,14 @@ def getCubeLets_img2img_multitarget( infos, collection, groupnm ):
   else:
     inputs = np.empty( inparrshape, np.float32 )
     outputs = np.empty( outarrshape, outdtype )
-    for idx,dsetnm in zip(range(len(dsetnms)),dsetnms):
-      dset = x_data[dsetnm]
-      odset = y_data[dsetnm]
-      inputs[idx] = np.resize( dset, inputs[idx].shape )
-      outputs[idx] = np.resize( odset, outputs[idx].shape )
+    bulkread = readDatasetRuns( x_data, dsetnms, inputs ) and \
+               readDatasetRuns( y_data, dsetnms, outputs )
+    if not bulkread:
+      for idx,dsetnm in zip(range(len(dsetnms)),dsetnms):
+        dset = x_data[dsetnm]
+        odset = y_data[dsetnm]
+        inputs[idx] = np.resize( dset, inputs[idx].shape )
+        outputs[idx] = np.resize( odset, outputs[idx].shape )
 
   hasdata = len(inputs)>0 and len(outputs)>0
   h5file.close()
@@ -451,17 +697,20 @@ def getCubeLets( infos, collection, groupnm ):
         output = np.empty( outarrshape, outdtype )
       else:
         output = np.empty( (nrpts,nroutputs), outdtype )
-      for idx,dsetnm in zip(range(len(dsetnms)),dsetnms):
-        dset = x_data[dsetnm]
-        if hasydata:
-          odset = y_data[dsetnm]
-
-        cubelets[idx] = np.resize( dset, cubelets[idx].shape )
-        if hasydata:
-          if img2img:
-            output[idx] = np.resize( odset, output[idx].shape )
-          else:
-            output[idx] = np.asarray( odset )
+      bulkread = readDatasetRuns( x_data, dsetnms, cubelets ) and \
+                 (not hasydata or readDatasetRuns( y_data, dsetnms, output ))
+      if not bulkread:
+        for idx,dsetnm in zip(range(len(dsetnms)),dsetnms):
+          dset = x_data[dsetnm]
+          if hasydata:
+            odset = y_data[dsetnm]
+
+          cubelets[idx] = np.resize( dset, cubelets[idx].shape )
+          if hasydata:
+            if img2img:
+              output[idx] = np.resize( odset, output[idx].shape )
+            else:
+              output[idx] = np.asarray( odset )
 
     allcubelets.append( cubelets )
     alloutputs.append( output )
@@ -533,7 +782,165 @@ def validInfo( info ):
     return False
   return True
 
+infocachesize = 16
+infocacheversion = 1
+infosidecarext = '.info.json'
+infocache = OrderedDict()
+infocachelock = threading.Lock()
+
+def useInfoSidecar():
+  if 'ML_INFO_SIDECAR' in os.environ:
+    return not ( os.environ['ML_INFO_SIDECAR'] == False or \
+                 os.environ['ML_INFO_SIDECAR'] == 'No' )
+  return False
+
+def getInfoCacheKey( filenm ):
+  try:
+    stat = os.stat( filenm )
+  except (OSError, TypeError, ValueError):
+    return None
+  return (os.path.abspath(filenm), stat.st_size, stat.st_mtime_ns)
+
+def clearInfoCache():
+  with infocachelock:
+    infocache.clear()
+
+def encodeInfoItem( obj ):
+  """ Converts an info object to plain JSON types, tagging the objects
+      that JSON cannot represent. Scalers are stored as plain arrays.
+  """
+
+  if isinstance(obj, dict):
+    if all([isinstance(key,str) for key in obj]):
+      return {key: encodeInfoItem(obj[key]) for key in obj}
+    return {'__dict__': [[encodeInfoItem(key), encodeInfoItem(obj[key])] for key in obj]}
+  if isinstance(obj, list):
+    return [encodeInfoItem(itm) for itm in obj]
+  if isinstance(obj, tuple):
+    return {'__tuple__': [encodeInfoItem(itm) for itm in obj]}
+  if isinstance(obj, np.ndarray):
+    return {'__ndarray__': obj.tolist(), 'dtype': obj.dtype.str}
+  if isinstance(obj, np.generic):
+    return {'__npscalar__': obj.item(), 'dtype': obj.dtype.str}
+  if type(obj).__name__ == 'StandardScaler':
+    return {'__scaler__': {'mean': np.asarray(obj.mean_).tolist(),
+                           'scale': np.asarray(obj.scale_).tolist()}}
+  if obj is None or isinstance(obj, (str,bool,int,float)):
+    return obj
+  raise TypeError( 'Cannot store info item of type '+type(obj).__name__ )
+
+def decodeInfoItem( obj ):
+  if isinstance(obj, list):
+    return [decodeInfoItem(itm) for itm in obj]
+  if not isinstance(obj, dict):
+    return obj
+  if '__dict__' in obj:
+    return {decodeInfoItem(key): decodeInfoItem(val) for key,val in obj['__dict__']}
+  if '__tuple__' in obj:
+    return tuple( decodeInfoItem(itm) for itm in obj['__tuple__'] )
+  if '__ndarray__' in obj:
+    return np.array( obj['__ndarray__'], dtype=np.dtype(obj['dtype']) )
+  if '__npscalar__' in obj:
+    return np.dtype(obj['dtype']).type( obj['__npscalar__'] )
+  if '__scaler__' in obj:
+    from dgbpy import dgbscikit
+    scaler = obj['__scaler__']
+    return dgbscikit.getNewScaler( scaler['mean'], scaler['scale'] )
+  return {key: decodeInfoItem(obj[key]) for key in obj}
+
+def getInfoSidecarName( filenm ):
+  return filenm + infosidecarext
+
+def readInfoSidecar( key, quick ):
+  sidecarfnm = getInfoSidecarName( key[0] )
+  if not os.path.isfile( sidecarfnm ):
+    return None
+  try:
+    with open( sidecarfnm, 'r' ) as fp:
+      sidecar = json.load( fp )
+    if sidecar['version'] != infocacheversion or sidecar['size'] != key[1] or \
+       sidecar['mtime_ns'] != key[2]:
+      return None
+    entry = sidecar['infos'].get( str(bool(quick)) )
+    if entry == None:
+      return None
+    return decodeInfoItem( entry )
+  except Exception:
+    return None
+
+def writeInfoSidecar( key, quick, info ):
+  sidecarfnm = getInfoSidecarName( key[0] )
+  sidecar = None
+  try:
+    with open( sidecarfnm, 'r' ) as fp:
+      sidecar = json.load( fp )
+    if sidecar['version'] != infocacheversion or sidecar['size'] != key[1] or \
+       sidecar['mtime_ns'] != key[2]:
+      sidecar = None
+  except Exception:
+    sidecar = None
+  if sidecar == None:
+    sidecar = {
+      'version': infocacheversion,
+      'size': key[1],
+      'mtime_ns': key[2],
+      'infos': {}
+    }
+  tmpfnm = sidecarfnm + '.' + str(os.getpid()) + '.tmp'
+  try:
+    sidecar['infos'][str(bool(quick))] = encodeInfoItem( info )
+    with open( tmpfnm, 'w' ) as fp:
+      json.dump( sidecar, fp )
+    os.replace( tmpfnm, sidecarfnm )
+  except Exception as e:
+    log_msg( '[Warning] Could not write the info sidecar file:', e )
+    if os.path.exists( tmpfnm ):
+      os.remove( tmpfnm )
+
+def getCachedInfo( key, quick ):
+  with infocachelock:
+    info = infocache.get( key+(quick,) )
+    if info != None:
+      infocache.move_to_end( key+(quick,) )
+  if info == None and useInfoSidecar():
+    info = readInfoSidecar( key, quick )
+    if info != None:
+      addCachedInfo( key, quick, info, tosidecar=False )
+  if info == None:
+    return None
+  return copy.deepcopy( info )
+
+def addCachedInfo( key, quick, info, tosidecar=True ):
+  if infocachesize < 1 or len(info) < 1:
+    return
+  with infocachelock:
+    infocache[key+(quick,)] = copy.deepcopy( info )
+    infocache.move_to_end( key+(quick,) )
+    while len(infocache) > infocachesize:
+      infocache.popitem( last=False )
+  if tosidecar and useInfoSidecar():
+    writeInfoSidecar( key, quick, info )
+
 def getInfo( filenm, quick ):
+  """ Gets the information from an example or model file.
+      Results are cached by file path, size and modification time, in memory
+      and optionally in a sidecar file next to the hdf5 file (ML_INFO_SIDECAR=Yes).
+  """
+
+  quick = bool(quick)
+  key = getInfoCacheKey( filenm )
+  if key != None:
+    info = getCachedInfo( key, quick )
+    if info != None:
+      info[filedictstr] = filenm
+      return info
+  info = getInfo_( filenm, quick )
+  key = getInfoCacheKey( filenm )
+  if key != None:
+    addCachedInfo( key, quick, info )
+  return info
+
+def getInfo_( filenm, quick ):
   h5file = odhdf5.openFile( filenm, 'r' )
   info = odhdf5.getInfoDataSet( h5file )
   if not validInfo( info ):
@@ -55,9 +55,18 @@ def model_info_dict( keras_model ):
 
 class TrainingSequence(Sequence):
   def __init__(self,trainbatch,forvalidation,model,exfilenm=None,batch_size=1,\
-               scale=None,transform=list(),transform_copy=True,tempnm=None):
+               scale=None,transform=list(),transform_copy=True,tempnm=None,\
+               lazy=False,lazycachedir=None):
       from dgbpy.dgbkeras import get_data_format
       self._trainbatch = trainbatch
+      self._lazy = lazy
+      self._lazycachedir = lazycachedir
+      self._lazydata = None
+      self._prefetcher = None
+      self._pool = None
+      self._shared = None
+      self._pending = {}
+      self._adapters = {}
       self._forvalid = forvalidation
       self._model = model
       self._nrdone = -1
@@ -109,18 +118,48 @@ class TrainingSequence(Sequence):
     if not isinstance(self.transform, list) and self.transform_seed and not self._forvalid:
       self.transform_seed+=1
       self.transform.set_uniform_generator_seed(self.transform_seed, len(self._data_IDs))
+      if self._shared != None:
+        self._shared.publishObject( 'transform', self.transform )
+        self._shared.publish( seed=int(self.transform_seed) )
 
   def set_chunk(self,ichunk):
       infos = self._infos
       nbchunks = len(infos[dgbkeys.trainseldicstr])
-      if nbchunks > 1 or dgbhdf5.isCrossValidation(infos):
+      if nbchunks > 1 or dgbhdf5.isCrossValidation(infos) or self._lazy:
         return self.set_fold(ichunk, 1) #set first fold initially for each chunk
       else:
           trainbatch = self._trainbatch
       return self.get_data(trainbatch)
 
+  def set_prefetcher(self,prefetcher):
+    self._prefetcher = prefetcher
+
+  def set_workers(self,pool):
+    """ Assembles the batches in the processes of a dgbpy.mlio.BatchWorkerPool,
+        from the chunk arrays copied to shared memory. Not used in lazy mode.
+        Releases the shared memory if pool is None
+    """
+    from dgbpy import mlio as dgbmlio
+    self._clearPending()
+    if self._shared != None:
+      self._shared.close()
+      self._shared = None
+    self._pool = pool if not self._lazy else None
+    if self._pool != None:
+      self._shared = dgbmlio.SharedArrays()
+
+  def _clearPending(self):
+    for future in self._pending.values():
+      future.cancel()
+    self._pending = {}
+
   def set_fold(self,ichunk,ifold):
     infos = self._infos
+    if self._lazy:
+      return self.set_lazy_data(ichunk, ifold)
+    if self._prefetcher != None:
+      trainbatch = self._prefetcher.get( ichunk, ifold, scale=self.isDefScaler )
+      return self.get_data(trainbatch)
     from dgbpy import mlapply as dgbmlapply
     trainbatch = dgbmlapply.getScaledTrainingDataByInfo( infos,
                                               flatten=False,
@@ -140,10 +179,30 @@ class TrainingSequence(Sequence):
             return False
         self._x_data = trainbatch[dgbkeys.xtraindictstr]
         self._y_data = trainbatch[dgbkeys.ytraindictstr]
+    if self._shared != None:
+      self._clearPending()
+      seed = int(self.transform_seed) if self.transform_seed else None
+      shared = self._shared.publish( {'x': self._x_data, 'y': self._y_data}, seed=seed )
+      self._x_data, self._y_data = shared['x'], shared['y']
+      self._shared.publishObject( 'transform', self.transform )
     self._data_IDs = range((len(self._x_data)*len(self.transform_multiplier)))
     self.on_epoch_end()
     return True
 
+  def set_lazy_data(self, ichunk, ifold):
+    from dgbpy import mlio as dgbmlio
+    if self._lazydata != None:
+      self._lazydata.close()
+    self._lazydata = dgbmlio.getLazyTrainingData( self._infos, ichunk, ifold,
+                                                  forvalid=self._forvalid,
+                                                  scale=self.isDefScaler,
+                                                  cachedir=self._lazycachedir )
+    if len(self._lazydata) < 1:
+      return False
+    self._data_IDs = range(len(self._lazydata)*len(self.transform_multiplier))
+    self.on_epoch_end()
+    return True
+
   def on_epoch_end(self):
       self._nrdone = self._nrdone+1
       if self._tempnm != None and self._nrdone > 0:
@@ -152,44 +211,91 @@ class TrainingSequence(Sequence):
               from dgbpy import dgbkeras
               dgbkeras.save( self._model, self._tempnm )
               self._lastsaved = now
+      self._clearPending()
       self._indexes = np.arange(len(self._data_IDs))
       if self._doshuffle and not self._forvalid:
         np.random.shuffle(self._indexes)
+      if self._lazydata != None:
+        nrsteps = len(self.transform_multiplier)
+        self._lazydata.set_batches( [np.divmod(self._batch_IDs(index), nrsteps)[0] \
+                                      for index in range(len(self))] )
 
-  def __getitem__(self, index):
+  def _batch_IDs(self, index):
       islast = index==(len(self)-1)
       bsize = self._batch_size
       if islast:
         indexes = self._indexes[index*bsize:]
       else:
         indexes = self._indexes[index*bsize:(index+1)*bsize]
-      data_IDs_temp = [self._data_IDs[k] for k in indexes]
+      return [self._data_IDs[k] for k in indexes]
+
+  def __getitem__(self, index):
+      data_IDs_temp = self._batch_IDs(index)
+      if self._lazydata != None:
+        return self.__data_generation(data_IDs_temp, self._lazydata.get_batch(index))
+      if self._pool != None:
+        return self._getPooledItem(index)
       return self.__data_generation(data_IDs_temp)
 
-  def __data_generation(self, data_IDs_temp):
-      from dgbpy import dgbkeras
-      x_data = self._x_data
-      y_data = self._y_data
-      inp_shape = x_data.shape[1:]
-      out_shape = y_data.shape[1:]
+  def _getPooledItem(self, index):
+      nrsteps = len(self.transform_multiplier)
+      for ibatch in range(index, min(index+self._pool.nrahead, len(self))):
+        if not ibatch in self._pending:
+          self._pending[ibatch] = self._pool.submit( self._shared, self._batch_IDs(ibatch), nrsteps )
+      X, Y = self._pending.pop(index).result()
+      return self._adaptBatch(X, Y)
+
+  def _adaptToModel(self, samples):
+      sampleshape = samples.shape[1:]
+      if not sampleshape in self._adapters:
+        from dgbpy import dgbkeras
+        dictinpshape = self._infos[dgbkeys.inpshapedictstr]
+        dictinpshape = tuple( dictinpshape ) if not isinstance(dictinpshape, int) else (dictinpshape,)
+        self._adapters[sampleshape] = dgbkeras.getModelAdapter( self._model, sampleshape, dictinpshape )
+      return self._adapters[sampleshape]( samples )
+
+  def __data_generation(self, data_IDs_temp, lazybatch=None):
       nrpts = len(data_IDs_temp)
-      X = np.empty( (nrpts,*inp_shape), dtype=x_data.dtype )
-      Y = np.empty( (nrpts,*out_shape), dtype=y_data.dtype )
       idx, rem = np.divmod(data_IDs_temp, len(self.transform_multiplier))
-      for i, (ID, _ID) in enumerate(zip(idx, data_IDs_temp)):
-        if self.transform:
-            X[i,], Y[i,] = self.transform(x_data[ID], y_data[ID], _ID, transform_idx=rem[i])
-        else:
-            X[i,], Y[i,] = x_data[ID], y_data[ID]
-      dictinpshape = self._infos[dgbkeys.inpshapedictstr]
-      dictinpshape = tuple( dictinpshape ) if not isinstance(dictinpshape, int) else (dictinpshape,)
-      X = dgbkeras.adaptToModel( self._model, X, dictinpshape )
+      if lazybatch != None:
+        x_data, y_data = lazybatch
+        idx = np.arange(nrpts)
+      else:
+        x_data = self._x_data
+        y_data = self._y_data
+      X = np.take( x_data, idx, axis=0 )
+      Y = np.take( y_data, idx, axis=0 )
+      if self.transform and len(self.transform.transforms) > 0:
+        X, Y = self.transform.transform_batch( X, Y, np.asarray(data_IDs_temp), transform_idxs=rem )
+      return self._adaptBatch(X, Y)
+
+  def _adaptBatch(self, X, Y):
+      X = self._adaptToModel( X )
       if len(Y.shape) > 2:
-          Y = dgbkeras.adaptToModel( self._model, Y, dictinpshape )
+          Y = self._adaptToModel( Y )
       if self._nrclasses > 0:
           Y = to_categorical(Y,self._nrclasses)
       return (X, Y)
 
+class ApplySequence(Sequence):
+  """ Feeds samples to Model.predict batch by batch
+
+  The samples may be a strided (non-contiguous) view on the input data:
+  only one batch at a time is copied in the layout expected by the model.
+  """
+  def __init__(self,samples,adapter,batch_size=1):
+      super().__init__()
+      self._samples = samples
+      self._adapter = adapter
+      self.batch_size = batch_size
+
+  def __len__(self):
+      return int(np.ceil(len(self._samples)/float(self.batch_size)))
+
+  def __getitem__(self, index):
+      start = index*self.batch_size
+      return self._adapter( self._samples[start:start+self.batch_size] )
+
 import importlib
 import pkgutil
 import inspect
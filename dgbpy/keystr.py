@@ -63,6 +63,7 @@ validdictstr = 'validation'
 versiondictstr = 'version'
 withunlabeleddictstr = 'withunlabeled'
 xdatadictstr = 'x_data'
+xstatsdictstr = 'x_stats'
 xtraindictstr = 'x_train'
 xvaliddictstr = 'x_validate'
 ydatadictstr = 'y_data'
@@ -21,80 +21,306 @@ from dgbpy.transforms import all_scalers
 
 TrainType = Enum( 'TrainType', 'New Resume Transfer', module=__name__ )
 
-def computeScaler_( datasets, infos, scalebyattrib ):
+scalerblocksize = 1024
+
+def getScalerNrWorkers():
+  if 'ML_SCALER_WORKERS' in os.environ:
+    try:
+      return max( 1, int(os.environ['ML_SCALER_WORKERS']) )
+    except ValueError:
+      pass
+  return 1
+
+def useExampleStats():
+  if 'ML_EXAMPLE_STATS' in os.environ:
+    return not ( os.environ['ML_EXAMPLE_STATS'] == False or \
+                 os.environ['ML_EXAMPLE_STATS'] == 'No' )
+  return False
+
+def ensureExampleStats( infos ):
+  """ Stores the input statistics in a sidecar file of the example file if requested
+      by the ML_EXAMPLE_STATS environment variable, for faster scaler computations
+  """
+
+  if not useExampleStats():
+    return
+  try:
+    nrwritten = dgbhdf5.writeExampleStats( infos )
+  except (OSError, KeyError) as e:
+    log_msg( f'Cannot store the example statistics: {e}' )
+    return
+  if nrwritten > 0:
+    log_msg( f'Stored the input statistics of {nrwritten} dataset(s) next to the example file' )
+
+def getScalerSelection_( infos, datasets, groupnm=None ):
+  """ Gets the union of all example indices used by a training selection
+
+  Parameters:
+    * infos (dict): information about example file
+    * datasets (dict or list): train/validation selection, folds of such selections,
+                               or a list of those (one per chunk)
+    * groupnm (str): only return the indices of this group if set
+
+  Returns:
+    * list: (groupnm, dataset name, sorted unique indices) tuples, where the dataset name
+            is the collection name, or the joined target names for multi-target image
+            to image examples
+  """
+
+  sel = dgbmlio.getSelectionUnion( datasets )
+  if groupnm != None:
+    sel = {groupnm: sel[groupnm]} if groupnm in sel else {}
+  multitarget = dgbhdf5.isImg2Img(infos) and dgbhdf5.getNrOutputs(infos) > 1
+  ret = list()
+  for grpnm in sel:
+    collection = sel[grpnm]
+    if multitarget:
+      targetnm = '`'.join([collnm for collnm in collection])
+      collection = {targetnm: next(iter(collection.values()))}
+    for collnm in collection:
+      ret.append( (grpnm, collnm, collection[collnm]) )
+  return ret
+
+def getMoments( x_data, byattrib=True ):
+  """ Gets the count, mean, sum of squared deviations and range of examples
+
+  Parameters:
+    * x_data (ndarray): examples, with the attributes along the second axis
+    * byattrib (bool): compute the moments per attribute if True, globally otherwise
+
+  Returns:
+    * tuple: count, mean, M2, minimum and maximum arrays of float64
+             (one value per attribute, or a single value)
+  """
+
+  if byattrib:
+    axes = tuple( [0] + list(range(2,x_data.ndim)) )
+    count = np.full( x_data.shape[1], x_data.size // max(1,x_data.shape[1]), dtype=np.float64 )
+  else:
+    axes = None
+    count = np.full( 1, x_data.size, dtype=np.float64 )
+  if x_data.size < 1:
+    return (np.zeros_like(count), np.zeros_like(count), np.zeros_like(count),
+            np.full_like(count,np.inf), np.full_like(count,-np.inf))
+  mean = np.mean( x_data, axis=axes, dtype=np.float64 )
+  m2 = np.var( x_data, axis=axes, dtype=np.float64 ) * count
+  minval = np.min( x_data, axis=axes ).astype( np.float64 )
+  maxval = np.max( x_data, axis=axes ).astype( np.float64 )
+  return (count, np.atleast_1d(mean), np.atleast_1d(m2),
+          np.atleast_1d(minval), np.atleast_1d(maxval))
+
+def mergeMoments( moments, other ):
+  """ Merges two sets of moments exactly (Chan et al. parallel algorithm)
+
+  Parameters:
+    * moments (tuple): count, mean, M2, minimum and maximum arrays (see getMoments), or None
+    * other (tuple): count, mean, M2, minimum and maximum arrays, or None
+
+  Returns:
+    * tuple: count, mean, M2, minimum and maximum of the union of both sets of examples
+  """
+
+  if moments == None:
+    return other
+  if other == None:
+    return moments
+  (na, meana, m2a, mina, maxa) = moments
+  (nb, meanb, m2b, minb, maxb) = other
+  count = na + nb
+  with np.errstate( divide='ignore', invalid='ignore' ):
+    delta = meanb - meana
+    mean = np.where( count > 0, meana + delta * nb / count, 0 )
+    m2 = np.where( count > 0, m2a + m2b + np.square(delta) * na * nb / count, 0 )
+  return (count, mean, m2, np.minimum(mina,minb), np.maximum(maxa,maxb))
+
+def reduceMoments( moments ):
+  """ Merges moments given along the first axis of their arrays, pairwise
+      with mergeMoments
+
+  Parameters:
+    * moments (tuple): count, mean, M2, minimum and maximum arrays
+
+  Returns:
+    * tuple: moments of the union of all sets, without the first axis
+  """
+
+  while len(moments[0]) > 1:
+    half = len(moments[0]) // 2
+    merged = mergeMoments( tuple([arr[:half] for arr in moments]),
+                           tuple([arr[half:2*half] for arr in moments]) )
+    moments = tuple([np.concatenate((arr,rest[2*half:])) for arr,rest in zip(merged,moments)])
+  return tuple([arr[0] for arr in moments])
+
+def getStatsMoments( stats, byattrib=True ):
+  """ Gets the moments of examples from their stored statistics
+
+  Parameters:
+    * stats (tuple): count, mean, M2, minimum and maximum of each attribute
+                     of each example (see dgbpy.hdf5.getExampleStats)
+    * byattrib (bool): moments per attribute if True, global otherwise
+
+  Returns:
+    * tuple: count, mean, M2, minimum and maximum arrays (see getMoments)
+  """
+
+  moments = reduceMoments( stats )
+  if not byattrib:
+    moments = tuple([np.atleast_1d(arr) for arr in reduceMoments(moments)])
+  return moments
+
+def computeMoments_( filenm, inpshape, nrattribs, groupnm, collnm, idxs, byattrib,
+                     blocksize=scalerblocksize ):
+  """ Computes the moments of the input examples of a single dataset, streaming
+      from the example file block by block
+
+  Parameters:
+    * filenm (str): path to the example file
+    * inpshape (int or list): input shape of the examples
+    * nrattribs (int): number of input attributes
+    * groupnm (str): group name
+    * collnm (str): dataset name within that group
+    * idxs (ndarray): sorted example indices
+    * byattrib (bool): compute the moments per attribute if True, globally otherwise
+    * blocksize (int): maximum number of examples read at once
+
+  Returns:
+    * tuple: count, mean, M2, minimum and maximum arrays (see getMoments),
+             or None if there is no data
+  """
+
+  import odpy.hdf5 as odhdf5
+  moments = None
+  h5file = odhdf5.openFile( filenm, 'r' )
+  try:
+    x_data = h5file[groupnm][collnm][dgbkeys.xdatadictstr]
+    block = np.empty( dgbhdf5.get_np_shape(inpshape,min(blocksize,len(idxs)),nrattribs),
+                      dtype=np.float32 )
+    for start in range( 0, len(idxs), blocksize ):
+      blockidxs = idxs[start:start+blocksize]
+      out = block[:len(blockidxs)]
+      dgbhdf5.readDatasetRows( x_data, blockidxs, out )
+      moments = mergeMoments( moments, getMoments(out,byattrib) )
+  finally:
+    h5file.close()
+  return moments
+
+def computeScalerMoments_( infos, datasets, scalebyattrib, groupnm=None, nrworkers=None ):
+  """ Computes the moments of all input examples of a training selection.
+      The statistics stored next to the example file are used when available
+      (see dgbpy.hdf5.writeExampleStats), the examples are read otherwise
+
+  Parameters:
+    * infos (dict): information about example file
+    * datasets (dict or list): training selection (see getScalerSelection_)
+    * scalebyattrib (bool): compute the moments per attribute if True, globally otherwise
+    * groupnm (str): only use the examples of this group if set
+    * nrworkers (int): number of worker processes, defaults to the value of the
+                       ML_SCALER_WORKERS environment variable (1 if not set)
+
+  Returns:
+    * tuple: count, mean, M2, minimum and maximum arrays (see getMoments),
+             or None if there is no data
+  """
+
+  import odpy.hdf5 as odhdf5
+  if nrworkers == None:
+    nrworkers = getScalerNrWorkers()
+  filenm = infos[dgbkeys.filedictstr]
+  inpshape = infos[dgbkeys.inpshapedictstr]
+  nrattribs = dgbhdf5.getNrAttribs( infos )
+  iscluster = dgbhdf5.isSegmentation( infos )
+  tasks = list()
+  moments = None
+  h5file = odhdf5.openFile( filenm, 'r' )
+  statsfile = dgbhdf5.openExampleStats( filenm )
+  for (grpnm,collnm,idxs) in getScalerSelection_( infos, datasets, groupnm ):
+    if not grpnm in h5file or not collnm in h5file[grpnm]:
+      continue
+    grp = h5file[grpnm][collnm]
+    if not dgbkeys.xdatadictstr in grp:
+      continue
+    if not iscluster and not dgbkeys.ydatadictstr in grp:
+      continue
+    if statsfile != None:
+      stats = dgbhdf5.getExampleStats( statsfile, grpnm, collnm, idxs )
+      if stats != None:
+        moments = mergeMoments( moments, getStatsMoments(stats,scalebyattrib) )
+        continue
+    nrparts = min( nrworkers, int(np.ceil(len(idxs)/scalerblocksize)) )
+    for partidxs in np.array_split( idxs, max(1,nrparts) ):
+      tasks.append( (filenm, inpshape, nrattribs, grpnm, collnm, partidxs, scalebyattrib) )
+  h5file.close()
+  if statsfile != None:
+    statsfile.close()
+
+  if nrworkers > 1 and len(tasks) > 1:
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor( max_workers=min(nrworkers,len(tasks)) ) as executor:
+      results = list( executor.map(computeMoments_, *zip(*tasks)) )
+  else:
+    results = [computeMoments_(*task) for task in tasks]
+  for result in results:
+    moments = mergeMoments( moments, result )
+  return moments
+
+def getScalerFromMoments( moments ):
+  """ Gets a standardization scaler from moments
+
+  Parameters:
+    * moments (tuple): count, mean and M2 arrays (see getMoments)
+
+  Returns:
+    * object: StandardScaler object, or None if there is no data
+  """
+
+  if moments == None or not np.any( moments[0] > 0 ):
+    return None
+  (count, mean, m2, minval, maxval) = moments
+  with np.errstate( divide='ignore', invalid='ignore' ):
+    var = np.where( count > 0, m2 / count, 0 )
+  return getNewScaler( mean, np.sqrt(var) )
+
+def computeScaler_( datasets, infos, scalebyattrib, nrworkers=None ):
   """ Computes scaler
 
   Parameters:
     * datasets (dict): dataset
     * infos (dict): information about example file
     * scalebyattrib (bool):
+    * nrworkers (int): number of worker processes reading the examples
   """
 
-  ret = dgbmlio.getTrainingDataByInfo( infos, datasets )
-  allx = list()
-  if dgbkeys.xtraindictstr in ret:
-    if len(ret[dgbkeys.xtraindictstr]) > 0:
-      allx.append( ret[dgbkeys.xtraindictstr] )
-  if dgbkeys.xvaliddictstr in ret:
-    if len(ret[dgbkeys.xvaliddictstr]) > 0:
-      allx.append( ret[dgbkeys.xvaliddictstr] )
-  if len(allx) > 0:
-    x_data = np.concatenate( allx )
-    return getScaler( x_data, byattrib=scalebyattrib )
-  return None
-
-def computeChunkedScaler_(datasets,infos,groupnm,scalebyattrib):
-  chunknb = len(datasets)
-  chunkmean = list()
-  chunkstd = list()
-  chunklen = list()
-  for dataset in datasets:
-    datasetchunk = dgbmlio.getDatasetsByGroup( dataset, groupnm )
-    chunksize = 0
-    for keynm in datasetchunk:
-      data = datasetchunk[keynm]
-      if groupnm in data:
-        dsets = data[groupnm]
-        for subgroupnm in dsets:
-          chunksize += len(dsets[subgroupnm])
-    chunklen.append(chunksize)
-    scaleronechunk = computeScaler_( datasetchunk, infos, scalebyattrib )
-    if scaleronechunk == None:
-      chunkmean.append(0)
-      chunkstd.append(0)
-    else:
-      chunkmean.append(scaleronechunk.mean_)
-      chunkstd.append(scaleronechunk.scale_)
+  moments = computeScalerMoments_( infos, datasets, scalebyattrib, nrworkers=nrworkers )
+  return getScalerFromMoments( moments )
 
-  if chunknb < 2:
-    return getNewScaler( chunkmean[0], chunkstd[0] )
-  if scalebyattrib:
-    attrnb = dgbhdf5.getNrAttribs(infos)
-  else:
-    attrnb = 1
-  #Calculate Mean and Var
-  totalmean = list()
-  totalstd = list()
-  for attr in range(attrnb):
-    attrmeansum = 0
-    attrstdsum = 0
-    attrsize = 0
-    for ichunk in range(chunknb):
-      attrchunksize = chunklen[ichunk]
-      if attrchunksize > 0:
-        attrmeansum += chunkmean[ichunk][attr] * attrchunksize
-        attrstdsum += chunkstd[ichunk][attr] * attrchunksize
-      attrsize += attrchunksize
-    if attrsize > 0:
-      attrmeansum /= attrsize
-      attrstdsum /= attrsize
-      totalmean.append( attrmeansum )
-      totalstd.append( attrstdsum )
-  return getNewScaler( totalmean, totalstd )
+def computeChunkedScaler_(datasets,infos,groupnm,scalebyattrib,nrworkers=None):
+  """ Computes the scaler of a group over all chunks
+
+  Parameters:
+    * datasets (list): training selection of each chunk
+    * infos (dict): information about example file
+    * groupnm (str): group name
+    * scalebyattrib (bool):
+    * nrworkers (int): number of worker processes reading the examples
+
+  Notes:
+    * The examples are streamed block by block and the moments are merged exactly,
+      hence the result does not depend on the number of chunks
+  """
+
+  moments = computeScalerMoments_( infos, datasets, scalebyattrib, groupnm=groupnm,
+                                   nrworkers=nrworkers )
+  scaler = getScalerFromMoments( moments )
+  if scaler == None:
+    nrattribs = dgbhdf5.getNrAttribs(infos) if scalebyattrib else 1
+    return getNewScaler( np.zeros(nrattribs), np.zeros(nrattribs) )
+  return scaler
 
 def computeScaler( infos, scalebyattrib, force=False ):
   datasets = infos[dgbkeys.trainseldicstr]
   inp = infos[dgbkeys.inputdictstr]
+  if force or not dgbmlio.hasScaler(infos):
+    ensureExampleStats( infos )
   if infos[dgbkeys.learntypedictstr] == dgbkeys.loglogtypestr:
     if not dgbmlio.hasScaler(infos) or force:
       printProcessTime( 'Scaler computation', True, print_fn=log_msg )
@@ -113,7 +339,7 @@ def computeScaler( infos, scalebyattrib, force=False ):
   return infos
 
 def getScaledTrainingData( filenm, flatten=False, scaler=dgbkeys.globalstdtypestr, force=False, 
-                           nbchunks=1, split=1, nbfolds=5, seed=None ):
+                           nbchunks=1, split=1, nbfolds=5, seed=None, lazy=False ):
   """ Gets scaled training data
 
   Parameters:
@@ -122,6 +348,8 @@ def getScaledTrainingData( filenm, flatten=False, scaler=dgbkeys.globalstdtypest
     * scale (bool or iter):
     * nbchunks (int): number of data chunks to be created
     * split (float): size of validation data (between 0-1)
+    * lazy (bool): only prepare the training selection and scalers, the examples
+                   are then read on demand (see dgbpy.mlio.LazyTrainingData)
   """
 
   infos = dgbmlio.getInfo( filenm )
@@ -139,8 +367,8 @@ def getScaledTrainingData( filenm, flatten=False, scaler=dgbkeys.globalstdtypest
   infos = dgbhdf5.updateScaleInfo(scaler, infos)
   if doscale:
     infos = computeScaler( infos, scalebyattrib, force )
-  #Decimate and cross validation, only need to return the updated info
-  if nbchunks > 1 or dgbhdf5.isCrossValidation(infos): 
+  #Decimate, cross validation and lazy loading, only need to return the updated info
+  if nbchunks > 1 or dgbhdf5.isCrossValidation(infos) or lazy:
     return {dgbkeys.infodictstr: infos}
   return getScaledTrainingDataByInfo( infos, flatten=flatten, scale=doscale )
 
@@ -159,6 +387,22 @@ def getInputList( datasets ):
     dgbhdf5.dictAddIfNew( datasets[keynm], ret )
   return ret.keys()
 
+def getTrainingSelection( infos, ichunk=0, ifold=None ):
+  """ Gets the train and validation datasets of a chunk
+
+  Parameters:
+    * infos (dict): information about example file
+    * ichunk (int): chunk index
+    * ifold (int): fold number, only used for cross-validation
+
+  Returns:
+    * dict: train and validation datasets
+  """
+
+  if ifold and dgbhdf5.isCrossValidation( infos ):
+    return infos[dgbkeys.trainseldicstr][ichunk][dgbkeys.foldstr+f'{ifold}']
+  return infos[dgbkeys.trainseldicstr][ichunk]
+
 def getScaledTrainingDataByInfo( infos, flatten=False, scale=True, ichunk=0, ifold=None ):
   """ Gets scaled training data
 
@@ -173,50 +417,8 @@ def getScaledTrainingDataByInfo( infos, flatten=False, scale=True, ichunk=0, ifo
   """
 
   printProcessTime( 'Data pre-loading', True, print_fn=log_msg )
-  x_train = list()
-  y_train = list()
-  x_validate = list()
-  y_validate = list()
-  if ifold and dgbhdf5.isCrossValidation( infos ):
-    datasets = infos[dgbkeys.trainseldicstr][ichunk][dgbkeys.foldstr+f'{ifold}']
-  else:
-    datasets = infos[dgbkeys.trainseldicstr][ichunk]
-  groups = getInputList( datasets )
-  for groupnm in groups:
-    dsets = dgbmlio.getDatasetsByGroup( datasets, groupnm )
-    ret = dgbmlio.getTrainingDataByInfo( infos, dsets )
-    if scale and groupnm in infos[dgbkeys.inputdictstr]:
-      scaler = infos[dgbkeys.inputdictstr][groupnm][dgbkeys.scaledictstr]
-      if dgbkeys.xtraindictstr in ret:
-        transform( ret[dgbkeys.xtraindictstr], scaler )
-      if dgbkeys.xvaliddictstr in ret:
-        transform( ret[dgbkeys.xvaliddictstr], scaler )
-    if dgbkeys.xtraindictstr in ret:
-      if len(ret[dgbkeys.xtraindictstr]) > 0:
-        x_train.append( ret[dgbkeys.xtraindictstr] )
-    if dgbkeys.xvaliddictstr in ret:
-      if len(ret[dgbkeys.xvaliddictstr]) > 0:
-        x_validate.append( ret[dgbkeys.xvaliddictstr] )
-    if dgbkeys.ytraindictstr in ret:
-      if len(ret[dgbkeys.ytraindictstr]) > 0:
-        y_train.append( ret[dgbkeys.ytraindictstr] )
-    if dgbkeys.yvaliddictstr in ret:
-      if len(ret[dgbkeys.yvaliddictstr]) > 0:
-        y_validate.append( ret[dgbkeys.yvaliddictstr] )
-  nrexamples = 0
-  if len(x_train)>0:
-    x_train = np.concatenate(x_train)
-    nrexamples += len(x_train)
-    ret.update({dgbkeys.xtraindictstr: x_train })
-  if len(y_train)>0:
-    ret.update({dgbkeys.ytraindictstr: np.concatenate(y_train) })
-  if len(x_validate)>0:
-    x_validate = np.concatenate(x_validate)
-    nrexamples += len(x_validate)
-    ret.update({dgbkeys.xvaliddictstr: x_validate })
-  if len(y_validate)>0:
-    ret.update({dgbkeys.yvaliddictstr: np.concatenate(y_validate) })
-
+  datasets = getTrainingSelection( infos, ichunk, ifold )
+  ret = dgbmlio.getScaledExamples( infos, datasets, scale=scale )
   printProcessTime( 'Data pre-loading', False, print_fn=log_msg, withprocline=False )
 
   import copy
@@ -266,17 +468,27 @@ def getNewScaler( mean, scale ):
   return dgbscikit.getNewScaler( mean, scale )
 
 def transform(x_train,scaler):
+  """ Applies a standardization scaler in place, per attribute or globally
+      (if the scaler has a single attribute)
+
+  Parameters:
+    * x_train (ndarray): examples, with the attributes along the second axis
+    * scaler (object): StandardScaler object
+  """
+
   nrattribs = scaler.n_samples_seen_
-  if nrattribs > 0:
-    for iattr in range(nrattribs):
-      if nrattribs == 1:
-        inp = x_train
-      else:
-        inp = x_train[:,iattr]
-      inp -= scaler.mean_[iattr]
-      doscale = np.flatnonzero( scaler.scale_ )
-      if (doscale == iattr)[iattr]:
-        inp /= scaler.scale_[iattr]
+  if nrattribs < 1:
+    return
+  mean = np.asarray( scaler.mean_, dtype=np.float64 )[:nrattribs]
+  scale = np.asarray( scaler.scale_, dtype=np.float64 )[:nrattribs]
+  scale = np.where( scale != 0, scale, 1 )
+  if nrattribs == 1:
+    x_train -= mean[0]
+    x_train /= scale[0]
+    return
+  shape = (1,nrattribs) + (1,) * (x_train.ndim-2)
+  x_train -= mean.reshape( shape )
+  x_train /= scale.reshape( shape )
 
 
 def doTrain( examplefilenm, platform=dgbkeys.kerasplfnm, type=TrainType.New,
@@ -329,7 +541,8 @@ def doTrain( examplefilenm, platform=dgbkeys.kerasplfnm, type=TrainType.New,
                                           scaler=params[dgbkeys.scaledictstr],
                                           force=False,
                                           nbchunks=params['nbchunk'],
-                                          split=params['split'],nbfolds=params['nbfold'] )
+                                          split=params['split'],nbfolds=params['nbfold'],
+                                          lazy=params.get('lazyload',False) )
       tblogdir=None
       if 'withtensorboard' in params and params['withtensorboard']:
         tblogdir = dgbhdf5.getLogDir(dgbkeras.withtensorboard, examplefilenm, platform, logdir, clearlogs, args )
@@ -375,7 +588,8 @@ def doTrain( examplefilenm, platform=dgbkeys.kerasplfnm, type=TrainType.New,
                                           scaler=params[dgbkeys.scaledictstr],
                                           nbchunks=params['nbchunk'],
                                           force=False,
-                                          split=params['split'],nbfolds=params['nbfold'] )
+                                          split=params['split'],nbfolds=params['nbfold'],
+                                          lazy=params.get('lazyload',False) )
       hasunlabels = dgbhdf5.hasUnlabeled(dgbmlio.getInfo(examplefilenm))
       if type != TrainType.New and dgbkeys.trainconfigdictstr in infos and hasunlabels:
         params[dgbkeys.criteriondictstr] = 'DiceLoss'
@@ -522,7 +736,7 @@ def doApply( model, info, samples, scaler=None, applyinfo=None, batchsize=None )
   elif platform == dgbkeys.onnxplfnm:
     import dgbpy.dgbonnx as dgbonnx
     res = dgbonnx.apply( model, info, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, \
-                        dictinpshape, dictoutshape, nroutputs )
+                        dictinpshape, dictoutshape, nroutputs, batchsize )
   else:
     log_msg( 'Unsupported machine learning platform' )
     raise AttributeError
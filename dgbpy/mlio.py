@@ -9,6 +9,9 @@
 #
 
 import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
 
 import dgbpy.keystr as dgbkeys
@@ -239,19 +242,17 @@ def getSomeDatasets( dslist, decim=None ):
     for groupnm in dset:
       group = dset[groupnm]
       setgrp = {}
-      if len(group) > 0 and isinstance(group[0],int):
+      if not isinstance(group,dict):
         dsetnms = group.copy()
         nrpts = int(len(dsetnms)*decim)
         np.random.shuffle( dsetnms )
-        del dsetnms[nrpts:]
-        sret[groupnm] = dsetnms
+        sret[groupnm] = dsetnms[:nrpts]
       else:
         for inp in group:
           dsetnms = group[inp].copy()
           nrpts = int(len(dsetnms)*decim)
           np.random.shuffle( dsetnms )
-          del dsetnms[nrpts:]
-          setgrp[inp] = dsetnms
+          setgrp[inp] = dsetnms[:nrpts]
         sret[groupnm] = setgrp
     ret[dsetnm] = sret
   return ret
@@ -274,6 +275,887 @@ def getTrainingData( filenm, decim=False ):
 
   return getTrainingDataByInfo( infos, dsetsel=dsets )
 
+lazyreadahead = 4
+lazyblocksize = 256
+
+class LazyTrainingData:
+  """ Train or validation examples read on demand from the example file,
+      instead of being loaded in memory all at once
+
+  Parameters:
+    * infos (dict): information about example file
+    * datasets (dict): selection of examples by group and collection
+    * scale (bool): apply the scaler of the input group to the examples
+    * cachedir (str): if set, the scaled examples are first copied block by block
+                      to memory-mapped arrays in a temporary folder of that directory,
+                      and read from there afterwards
+    * readahead (int): number of batches read in advance in a background thread
+    * blocksize (int): number of examples per block when accessed sample by sample
+
+  Notes:
+    * Examples are numbered per collection, in ascending dataset index order
+  """
+
+  def __init__( self, infos, datasets, scale=True, cachedir=None,
+                readahead=lazyreadahead, blocksize=lazyblocksize ):
+    self.infos = infos
+    self.readahead = readahead
+    self.blocksize = max( 1, blocksize )
+    img2img = dgbhdf5.isImg2Img( infos )
+    nroutputs = dgbhdf5.getNrOutputs( infos )
+    multitarget = img2img and nroutputs > 1
+    self.inpshape = dgbhdf5.get_np_shape( infos[dgbkeys.inpshapedictstr],
+                                          nrattribs=dgbhdf5.getNrAttribs(infos) )
+    if img2img:
+      self.outshape = dgbhdf5.get_np_shape( infos[dgbkeys.outshapedictstr],
+                                            nrattribs=nroutputs if multitarget else 1 )
+    else:
+      self.outshape = (nroutputs,)
+    self.outdtype = np.float32
+    self.classes = None
+    if infos[dgbkeys.classdictstr] and not multitarget:
+      self.outdtype = dgbhdf5.getOutdType( np.array(infos[dgbkeys.classesdictstr]),
+                                           dgbhdf5.hasUnlabeled(infos) )
+    if dgbkeys.classdictstr in infos and infos[dgbkeys.classdictstr] and \
+       dgbkeys.classesdictstr in infos:
+      self.classes = infos[dgbkeys.classesdictstr]
+
+    self._h5file = None
+    self._pid = None
+    self._lock = threading.RLock()
+    self._executor = None
+    self._pending = {}
+    self._batches = None
+    self._current = (None,None)
+    self._cachedir = None
+    self._xcache = None
+    self._ycache = None
+    self._sources = list()
+    srcids = list()
+    rows = list()
+    iscluster = dgbhdf5.isSegmentation( infos )
+    inputs = infos[dgbkeys.inputdictstr]
+    h5file = self._getFile()
+    for groupnm in datasets:
+      collection = datasets[groupnm]
+      if len(collection) < 1 or not groupnm in h5file:
+        continue
+      scaler = None
+      if scale and groupnm in inputs:
+        scaler = inputs[groupnm].get( dgbkeys.scaledictstr )
+      if multitarget:
+        targetnm = '`'.join([collnm for collnm in collection])
+        collsel = {targetnm: next(iter(collection.values()))}
+      else:
+        collsel = collection
+      group = h5file[groupnm]
+      for collnm in collsel:
+        idxs = np.asarray( collsel[collnm] )
+        if len(idxs) < 1 or not collnm in group or not dgbkeys.xdatadictstr in group[collnm]:
+          continue
+        hasydata = dgbkeys.ydatadictstr in group[collnm]
+        if not hasydata and not iscluster:
+          continue
+        srcids.append( np.full(len(idxs), len(self._sources), dtype=np.int32) )
+        rows.append( np.sort(idxs) )
+        self._sources.append( (groupnm, collnm, scaler, hasydata) )
+    self._srcids = np.concatenate( srcids ) if len(srcids) > 0 else np.empty(0, np.int32)
+    self._rows = np.concatenate( rows ) if len(rows) > 0 else np.empty(0, np.int64)
+    if cachedir != None and len(self) > 0:
+      self._createCache( cachedir )
+
+  def __len__( self ):
+    return len(self._srcids)
+
+  def __del__( self ):
+    try:
+      self.close()
+    except Exception:
+      pass
+
+  def __getstate__( self ):
+    state = self.__dict__.copy()
+    state.update({
+      '_h5file': None,
+      '_pid': None,
+      '_lock': None,
+      '_executor': None,
+      '_pending': {},
+      '_current': (None,None),
+      '_cachedir': None,
+    })
+    return state
+
+  def __setstate__( self, state ):
+    self.__dict__.update( state )
+    self._lock = threading.RLock()
+
+  def _getFile( self ):
+    if self._h5file == None or self._pid != os.getpid():
+      import odpy.hdf5 as odhdf5
+      self._h5file = odhdf5.openFile( self.infos[dgbkeys.filedictstr], 'r' )
+      self._pid = os.getpid()
+    return self._h5file
+
+  def _createCache( self, cachedir ):
+    self._cachedir = tempfile.mkdtemp( prefix='dgbpy_lazy_', dir=cachedir )
+    nrpts = len(self)
+    xcache = np.lib.format.open_memmap( os.path.join(self._cachedir,'x.npy'), mode='w+',
+                                        dtype=np.float32, shape=(nrpts,)+self.inpshape )
+    ycache = np.lib.format.open_memmap( os.path.join(self._cachedir,'y.npy'), mode='w+',
+                                        dtype=self.outdtype, shape=(nrpts,)+self.outshape )
+    for start in range( 0, nrpts, self.blocksize ):
+      stop = min( start+self.blocksize, nrpts )
+      (xcache[start:stop], ycache[start:stop]) = self.read( np.arange(start,stop) )
+    xcache.flush()
+    ycache.flush()
+    self._xcache = xcache
+    self._ycache = ycache
+
+  def close( self ):
+    """ Releases the example file, the read-ahead thread and the cache files """
+
+    self._cancelReadAhead()
+    if self._executor != None:
+      self._executor.shutdown( wait=True )
+      self._executor = None
+    if self._h5file != None and self._pid == os.getpid():
+      self._h5file.close()
+    self._h5file = None
+    self._xcache = None
+    self._ycache = None
+    if self._cachedir != None:
+      import shutil
+      shutil.rmtree( self._cachedir, ignore_errors=True )
+      self._cachedir = None
+
+  def read( self, ids ):
+    """ Reads examples
+
+    Parameters:
+      * ids (array of int): example numbers, in any order and possibly repeated
+
+    Returns:
+      * tuple: (x, y) arrays, with one row per requested example
+    """
+
+    ids = np.asarray( ids, dtype=np.int64 )
+    nrpts = len(ids)
+    x_data = np.empty( (nrpts,)+self.inpshape, np.float32 )
+    y_data = np.zeros( (nrpts,)+self.outshape, self.outdtype )
+    if self._xcache is not None:
+      order = np.argsort( ids, kind='stable' )
+      x_data[order] = self._xcache[ids[order]]
+      y_data[order] = self._ycache[ids[order]]
+      return (x_data, y_data)
+
+    from dgbpy.mlapply import transform
+    with self._lock:
+      h5file = self._getFile()
+      srcids = self._srcids[ids]
+      for isrc in np.unique( srcids ):
+        pos = np.flatnonzero( srcids == isrc )
+        rows = self._rows[ids[pos]]
+        order = np.argsort( rows, kind='stable' )
+        pos = pos[order]
+        rows = rows[order]
+        (groupnm,collnm,scaler,hasydata) = self._sources[isrc]
+        grp = h5file[groupnm][collnm]
+        inputs = np.empty( (len(rows),)+self.inpshape, np.float32 )
+        dgbhdf5.readDatasetRows( grp[dgbkeys.xdatadictstr], rows, inputs )
+        if scaler != None:
+          transform( inputs, scaler )
+        x_data[pos] = inputs
+        if hasydata:
+          outputs = np.empty( (len(rows),)+self.outshape, self.outdtype )
+          dgbhdf5.readDatasetRows( grp[dgbkeys.ydatadictstr], rows, outputs )
+          y_data[pos] = outputs
+    if self.classes is not None:
+      normalize_class_vector( y_data, self.classes )
+    return (x_data, y_data)
+
+  def getExampleNumbers( self, datasets ):
+    """ Gets the example numbers of a subset of the examples
+
+    Parameters:
+      * datasets (dict): selection by group and collection, within the examples of this object
+
+    Returns:
+      * ndarray: example numbers, in the order the examples would have if that
+                 selection was read on its own
+    """
+
+    multitarget = dgbhdf5.isImg2Img( self.infos ) and dgbhdf5.getNrOutputs( self.infos ) > 1
+    srcidxs = {(src[0],src[1]): isrc for isrc,src in enumerate(self._sources)}
+    bounds = np.searchsorted( self._srcids, np.arange(len(self._sources)+1) )
+    ret = list()
+    for groupnm in datasets:
+      collection = datasets[groupnm]
+      if len(collection) < 1:
+        continue
+      if multitarget:
+        targetnm = '`'.join([collnm for collnm in collection])
+        collection = {targetnm: next(iter(collection.values()))}
+      for collnm in collection:
+        isrc = srcidxs.get( (groupnm,collnm) )
+        if isrc == None or len(collection[collnm]) < 1:
+          continue
+        (start,stop) = (bounds[isrc], bounds[isrc+1])
+        rows = np.sort( np.asarray(collection[collnm]) )
+        ret.append( start + np.searchsorted(self._rows[start:stop], rows) )
+    if len(ret) < 1:
+      return np.empty( 0, np.int64 )
+    return np.concatenate( ret )
+
+  def load( self, x_data=None, y_data=None ):
+    """ Reads all examples at once, each dataset directly into its slice of the
+        output arrays. The input examples are scaled in place
+
+    Parameters:
+      * x_data (ndarray): preallocated input array, allocated if None
+      * y_data (ndarray): preallocated output array, allocated if None
+
+    Returns:
+      * tuple: (x, y) arrays of all examples, in example number order
+    """
+
+    nrpts = len(self)
+    if x_data is None:
+      x_data = np.empty( (nrpts,)+self.inpshape, np.float32 )
+    if y_data is None:
+      y_data = np.zeros( (nrpts,)+self.outshape, self.outdtype )
+    if self._xcache is not None:
+      x_data[:] = self._xcache
+      y_data[:] = self._ycache
+      return (x_data, y_data)
+
+    from dgbpy.mlapply import transform
+    bounds = np.searchsorted( self._srcids, np.arange(len(self._sources)+1) )
+    with self._lock:
+      h5file = self._getFile()
+      for isrc,(groupnm,collnm,scaler,hasydata) in enumerate(self._sources):
+        (start,stop) = (bounds[isrc], bounds[isrc+1])
+        grp = h5file[groupnm][collnm]
+        inputs = x_data[start:stop]
+        dgbhdf5.readDatasetRows( grp[dgbkeys.xdatadictstr], self._rows[start:stop], inputs )
+        if scaler != None:
+          transform( inputs, scaler )
+        if hasydata:
+          dgbhdf5.readDatasetRows( grp[dgbkeys.ydatadictstr], self._rows[start:stop],
+                                   y_data[start:stop] )
+    if self.classes is not None:
+      normalize_class_vector( y_data, self.classes )
+    return (x_data, y_data)
+
+  def set_batches( self, batches=None ):
+    """ Sets the order in which batches will be requested, for the read-ahead
+
+    Parameters:
+      * batches (list of arrays): example numbers of each batch. When None,
+                                  consecutive blocks of blocksize examples are used
+    """
+
+    self._cancelReadAhead()
+    if batches == None:
+      nrpts = len(self)
+      batches = [np.arange(start,min(start+self.blocksize,nrpts)) \
+                    for start in range(0,nrpts,self.blocksize)]
+    self._batches = batches
+    self._current = (None,None)
+
+  def nrBatches( self ):
+    if self._batches == None:
+      return 0
+    return len(self._batches)
+
+  def get_batch( self, ibatch ):
+    """ Gets the examples of a batch set by set_batches,
+        and starts reading the next batches in the background
+    """
+
+    if self._batches == None:
+      self.set_batches()
+    if self._current[0] == ibatch:
+      return self._current[1]
+    future = self._pending.pop( ibatch, None )
+    if future != None:
+      data = future.result()
+    else:
+      data = self.read( self._batches[ibatch] )
+    self._current = (ibatch, data)
+    nrbatches = len(self._batches)
+    nextbatches = [(ibatch+i) % nrbatches for i in range(1,min(self.readahead,nrbatches-1)+1)]
+    for jbatch in [jbatch for jbatch in self._pending if not jbatch in nextbatches]:
+      self._pending.pop( jbatch ).cancel()
+    if len(nextbatches) > 0:
+      if self._executor == None:
+        self._executor = ThreadPoolExecutor( max_workers=1 )
+      for jbatch in nextbatches:
+        if not jbatch in self._pending:
+          self._pending[jbatch] = self._executor.submit( self.read, self._batches[jbatch] )
+    return data
+
+  def get_sample( self, idx ):
+    """ Gets a single example, when the batches are consecutive blocks
+
+    Returns:
+      * tuple: (x, y) arrays of that example
+    """
+
+    (x_data,y_data) = self.get_batch( idx // self.blocksize )
+    return (x_data[idx % self.blocksize], y_data[idx % self.blocksize])
+
+  def _cancelReadAhead( self ):
+    for jbatch in list(self._pending):
+      self._pending.pop( jbatch ).cancel()
+    self._current = (None,None)
+
+def getLazyTrainingData( infos, ichunk=0, ifold=None, forvalid=False, scale=True, cachedir=None ):
+  """ Gets the lazy train or validation examples of a chunk/fold
+
+  Parameters:
+    * infos (dict): information about example file, with a training selection
+    * ichunk (int): chunk index
+    * ifold (int): fold number, for cross-validation
+    * forvalid (bool): validation instead of train examples
+    * scale (bool): apply the input scalers
+    * cachedir (str): directory for a memory-mapped cache, or None
+
+  Returns:
+    * LazyTrainingData
+  """
+
+  from dgbpy.mlapply import getTrainingSelection
+  datasets = getTrainingSelection( infos, ichunk, ifold )
+  if forvalid:
+    datasets = datasets.get( dgbkeys.validdictstr, {} )
+  elif dgbkeys.traindictstr in datasets:
+    datasets = datasets[dgbkeys.traindictstr]
+  return LazyTrainingData( infos, datasets, scale=scale, cachedir=cachedir )
+
+def getSelectionUnion( datasets ):
+  """ Gets the union of the examples of a selection
+
+  Parameters:
+    * datasets (dict or list): train/validation selection, folds of such selections,
+                               or a list of those (one per chunk)
+
+  Returns:
+    * dict: sorted unique example indices by group and collection
+  """
+
+  sel = {}
+  def addSelection( dsets ):
+    if isinstance( dsets, (list,tuple) ):
+      for dset in dsets:
+        addSelection( dset )
+      return
+    for keynm in dsets:
+      if keynm == dgbkeys.traindictstr or keynm == dgbkeys.validdictstr or \
+         keynm.startswith( dgbkeys.foldstr ):
+        addSelection( dsets[keynm] )
+        continue
+      for collnm in dsets[keynm]:
+        idxs = dsets[keynm][collnm]
+        if len(idxs) > 0:
+          sel.setdefault( keynm, {} ).setdefault( collnm, [] ).append( np.asarray(idxs) )
+
+  addSelection( datasets )
+  for groupnm in sel:
+    for collnm in sel[groupnm]:
+      sel[groupnm][collnm] = np.unique( np.concatenate(sel[groupnm][collnm]) )
+  return sel
+
+def getNrExamples( datasets ):
+  """ Gets the number of examples of a selection
+
+  Parameters:
+    * datasets (dict): selection by group and collection, possibly split
+                       in train and validation or folds
+
+  Returns:
+    * int: number of selected examples
+  """
+
+  nrpts = 0
+  for keynm in datasets:
+    dsets = datasets[keynm]
+    if isinstance( dsets, dict ):
+      nrpts += getNrExamples( dsets )
+    else:
+      nrpts += len(dsets)
+  return nrpts
+
+def getEstimatedSize( infos, datasets ):
+  """ Gets the estimated memory size of a selection of examples once loaded (in bytes) """
+
+  nrtotal = getNrExamples( infos[dgbkeys.datasetdictstr] )
+  if nrtotal < 1 or not dgbkeys.estimatedsizedictstr in infos:
+    return 0
+  return int( infos[dgbkeys.estimatedsizedictstr] * getNrExamples(datasets) / nrtotal )
+
+prefetchmemory = 0
+
+class TrainingDataPrefetcher:
+  """ Provides the scaled training data of each chunk/fold, the data of the next
+      chunk being read in a background thread while the current one is used.
+      The loaded arrays are handed over as is, without any copy.
+      Requests for the current chunk/fold with the same scaling, i.e. from the
+      train and validation sequences, share the same data.
+      With cross-validation the union of the examples of all folds of a chunk is
+      read once, the examples of each fold are then taken from those arrays.
+      Those are copies, unless contiguous: the sequences, datasets and shared
+      arrays of the batch workers all expect the arrays of the fold examples.
+      Only the fold in use is kept, the peak memory is the chunk and one fold
+
+  Parameters:
+    * infos (dict): information about example file, with a training selection
+    * maxmemory (float): memory budget (in MB) for the current and the prefetched data,
+                         no data is read in advance if 0 or None
+  """
+
+  def __init__( self, infos, maxmemory=prefetchmemory ):
+    self.infos = infos
+    self.maxmemory = maxmemory
+    self._iscrossval = dgbhdf5.isCrossValidation( infos )
+    self._nbchunks = len( infos[dgbkeys.trainseldicstr] )
+    self._items = {}
+    self._folds = {}
+    self._sizes = {}
+    self._lock = threading.Lock()
+    self._executor = None
+
+  def __del__( self ):
+    try:
+      self.close()
+    except Exception:
+      pass
+
+  def _getSize( self, ichunk ):
+    if not ichunk in self._sizes:
+      datasets = self.infos[dgbkeys.trainseldicstr][ichunk]
+      if self._iscrossval:
+        datasets = getSelectionUnion( datasets )
+      self._sizes[ichunk] = getEstimatedSize( self.infos, datasets )
+    return self._sizes[ichunk]
+
+  def _load( self, ichunk, scale ):
+    if not self._iscrossval:
+      from dgbpy.mlapply import getScaledTrainingDataByInfo
+      return getScaledTrainingDataByInfo( self.infos, flatten=False, scale=scale, ichunk=ichunk )
+    datasets = getSelectionUnion( self.infos[dgbkeys.trainseldicstr][ichunk] )
+    data = LazyTrainingData( self.infos, datasets, scale=scale )
+    (x_data, y_data) = data.load()
+    data.close()
+    setClasses_( self.infos, [y_data] )
+    return (data, x_data, y_data)
+
+  def _getFold( self, ichunk, ifold, scale, chunkdata ):
+    from dgbpy.mlapply import getTrainingSelection
+    if not ifold:
+      ifold = 1
+    key = (ichunk,ifold,scale)
+    if key in self._folds:
+      return self._folds[key]
+    (data, x_data, y_data) = chunkdata
+    datasets = getTrainingSelection( self.infos, ichunk, ifold )
+    ret = {}
+    parts = ( (dgbkeys.traindictstr, dgbkeys.xtraindictstr, dgbkeys.ytraindictstr),
+              (dgbkeys.validdictstr, dgbkeys.xvaliddictstr, dgbkeys.yvaliddictstr) )
+    for (partnm,xkey,ykey) in parts:
+      if not partnm in datasets:
+        continue
+      ids = data.getExampleNumbers( datasets[partnm] )
+      if len(ids) < 1:
+        continue
+      if ids[-1]-ids[0]+1 == len(ids) and np.all( np.diff(ids) == 1 ):
+        (ret[xkey], ret[ykey]) = ( x_data[ids[0]:ids[-1]+1], y_data[ids[0]:ids[-1]+1] )
+      else:
+        # Copy of the fold examples, released when another fold is requested
+        (ret[xkey], ret[ykey]) = ( np.take(x_data,ids,axis=0), np.take(y_data,ids,axis=0) )
+    import copy
+    decinfos = copy.deepcopy( self.infos )
+    decinfos[dgbkeys.trainseldicstr] = [datasets]
+    ret.update({dgbkeys.infodictstr: decinfos})
+    # The train and validation sequences may use different scalings of the same fold
+    self._folds = {foldkey: fold for foldkey,fold in self._folds.items() if foldkey[:2] == key[:2]}
+    self._folds[key] = ret
+    return ret
+
+  def get( self, ichunk, ifold=None, scale=True ):
+    """ Gets the scaled training data of a chunk/fold
+
+    Parameters:
+      * ichunk (int): chunk index
+      * ifold (int): fold number, only used for cross-validation
+      * scale (bool): apply the input scalers
+
+    Returns:
+      * dict: as returned by dgbpy.mlapply.getScaledTrainingDataByInfo
+    """
+
+    with self._lock:
+      future = self._items.get( (ichunk,scale) )
+    if future != None:
+      ret = future.result()
+    else:
+      ret = self._load( ichunk, scale )
+    nextchunk = ichunk+1 if ichunk+1 < self._nbchunks else None
+    with self._lock:
+      for itemkey in [itemkey for itemkey in self._items if itemkey[0] != ichunk and itemkey[0] != nextchunk]:
+        self._items.pop( itemkey ).cancel()
+      if future == None:
+        future = Future()
+        future.set_result( ret )
+        self._items[(ichunk,scale)] = future
+    if nextchunk != None:
+      self._prefetch( nextchunk, scale )
+    if self._iscrossval:
+      return self._getFold( ichunk, ifold, scale, ret )
+    return ret
+
+  def _prefetch( self, ichunk, scale ):
+    if not self.maxmemory or self.maxmemory <= 0:
+      return
+    with self._lock:
+      if (ichunk,scale) in self._items:
+        return
+      nrbytes = sum( [self._getSize(itemkey[0]) for itemkey in self._items] )
+      nrbytes += self._getSize( ichunk )
+      if nrbytes > self.maxmemory * 1024 * 1024:
+        from odpy.common import log_msg
+        log_msg( 'Not enough memory budget to read the next training data in advance' )
+        return
+      if self._executor == None:
+        self._executor = ThreadPoolExecutor( max_workers=1 )
+      self._items[(ichunk,scale)] = self._executor.submit( self._load, ichunk, scale )
+
+  def close( self ):
+    """ Releases the data and stops the background thread """
+
+    with self._lock:
+      for itemkey in list(self._items):
+        self._items.pop( itemkey ).cancel()
+      self._folds = {}
+    if self._executor != None:
+      self._executor.shutdown( wait=True )
+      self._executor = None
+
+sharedarrays = {}
+sharedpagesize = 65536
+
+def attachSharedMemory_( name ):
+  from multiprocessing import shared_memory
+  try:
+    return shared_memory.SharedMemory( name=name, track=False )
+  except TypeError:
+    return shared_memory.SharedMemory( name=name )
+
+def getSharedArrays( name ):
+  """ Gets the SharedArrays object of a descriptor, attached once per process """
+
+  if not name in sharedarrays:
+    sharedarrays[name] = SharedArrays( name=name )
+  return sharedarrays[name]
+
+class SharedArrays:
+  """ Arrays in shared memory, for worker processes of a training run.
+      The arrays are listed in a descriptor block with a fixed name, that is
+      the only thing passed (pickled) to the workers: a worker attaches to the
+      arrays on first access, and again whenever they are published anew,
+      i.e. for each chunk/fold. Workers therefore persist across chunks.
+
+  Parameters:
+    * name (str): name of an existing descriptor block, to attach to.
+                  A new descriptor is created if None
+
+  Notes:
+    * Publishing replaces the arrays for the given keys only, the other
+      arrays and the extra values are kept
+    * Only the process that created the descriptor publishes, and only when
+      the workers are idle
+  """
+
+  def __init__( self, name=None ):
+    self._owner = os.getpid() if name == None else None
+    if self._owner:
+      from multiprocessing import shared_memory
+      self._desc = shared_memory.SharedMemory( create=True, size=sharedpagesize )
+      self._desc.buf[:16] = bytes(16)
+    else:
+      self._desc = attachSharedMemory_( name )
+    self.name = self._desc.name
+    self._version = 0
+    self._meta = {}
+    self._extra = {}
+    self._blocks = {}
+    self._arrays = {}
+    self._objects = {}
+    self._released = []
+    sharedarrays[self.name] = self
+
+  def __reduce__( self ):
+    return (getSharedArrays, (self.name,))
+
+  def _isOwner( self ):
+    # not in forked worker processes
+    return self._owner == os.getpid()
+
+  def _readVersion( self ):
+    return int.from_bytes( self._desc.buf[:8], 'little' )
+
+  def _writeDescriptor( self, version ):
+    import json
+    payload = json.dumps( {'version': version, 'arrays': self._meta, 'extra': self._extra} ).encode()
+    if len(payload)+16 > self._desc.size:
+      raise ValueError( 'Too many shared arrays' )
+    self._desc.buf[16:16+len(payload)] = payload
+    self._desc.buf[8:16] = len(payload).to_bytes( 8, 'little' )
+    self._desc.buf[:8] = version.to_bytes( 8, 'little' )
+
+  def publish( self, arrays=None, **extra ):
+    """ Copies arrays to new shared memory blocks and lists them in the descriptor
+
+    Parameters:
+      * arrays (dict): arrays by key
+      * extra: additional values made available to the workers, must be serializable to JSON
+
+    Returns:
+      * dict: the shared arrays by key, to be used instead of the input arrays
+    """
+
+    from multiprocessing import shared_memory
+    ret = {}
+    if arrays != None:
+      for key, arr in arrays.items():
+        arr = np.asarray( arr )
+        shm = shared_memory.SharedMemory( create=True, size=max(arr.nbytes,1) )
+        ret[key] = np.ndarray( arr.shape, dtype=arr.dtype, buffer=shm.buf )
+        ret[key][...] = arr
+        self._releaseBlock( key )
+        self._blocks[key] = shm
+        self._arrays[key] = ret[key]
+        self._meta[key] = (shm.name, list(arr.shape), arr.dtype.str)
+    self._extra.update( extra )
+    self._version = self._readVersion()+1
+    self._writeDescriptor( self._version )
+    self._closeReleased()
+    return ret
+
+  def publishObject( self, key, obj ):
+    """ Publishes a picklable object as a shared array of bytes """
+
+    import pickle
+    self._objects.pop( key, None )
+    self.publish( {key: np.frombuffer(pickle.dumps(obj), dtype=np.uint8)} )
+
+  def get( self ):
+    """ Gets the current arrays, attaching to the published ones if needed
+
+    Returns:
+      * tuple: (dict of arrays by key, dict of extra values)
+    """
+
+    version = self._readVersion()
+    if version == self._version:
+      return (self._arrays, self._extra)
+    import json
+    while True:
+      nrbytes = int.from_bytes( self._desc.buf[8:16], 'little' )
+      payload = bytes( self._desc.buf[16:16+nrbytes] )
+      try:
+        desc = json.loads( payload )
+      except ValueError:
+        desc = None
+      if desc != None and desc['version'] == version and self._readVersion() == version:
+        break
+      version = self._readVersion()
+    for key in [key for key in self._meta if not key in desc['arrays']]:
+      self._releaseBlock( key )
+    for key, (shmnm, shape, dtype) in desc['arrays'].items():
+      if key in self._blocks and self._blocks[key].name.lstrip('/') == shmnm.lstrip('/'):
+        continue
+      self._releaseBlock( key )
+      shm = attachSharedMemory_( shmnm )
+      self._blocks[key] = shm
+      self._arrays[key] = np.ndarray( tuple(shape), dtype=np.dtype(dtype), buffer=shm.buf )
+    self._meta = desc['arrays']
+    self._extra = desc['extra']
+    self._version = version
+    self._closeReleased()
+    return (self._arrays, self._extra)
+
+  def getObject( self, key, onload=None ):
+    """ Gets an object published with publishObject, None if there is none.
+        The optional onload function is called once for each new object
+    """
+
+    (arrays, extra) = self.get()
+    if not key in arrays:
+      return None
+    shmnm = self._blocks[key].name
+    if not key in self._objects or self._objects[key][0] != shmnm:
+      import pickle
+      self._objects[key] = (shmnm, pickle.loads(arrays[key].tobytes()))
+      if onload != None:
+        onload( self._objects[key][1] )
+    return self._objects[key][1]
+
+  def _releaseBlock( self, key ):
+    self._arrays.pop( key, None )
+    self._meta.pop( key, None )
+    shm = self._blocks.pop( key, None )
+    if shm == None:
+      return
+    if self._isOwner():
+      shm.unlink()
+    self._released.append( shm )
+
+  def _closeReleased( self ):
+    # blocks still referenced by arrays in use are closed later
+    stillused = []
+    for shm in self._released:
+      try:
+        shm.close()
+      except BufferError:
+        stillused.append( shm )
+    self._released = stillused
+
+  def close( self ):
+    """ Releases all arrays, and the descriptor if owned """
+
+    for key in list(self._blocks):
+      self._releaseBlock( key )
+    self._objects = {}
+    self._closeReleased()
+    sharedarrays.pop( self.name, None )
+    try:
+      self._desc.close()
+    except BufferError:
+      pass
+    if self._isOwner():
+      self._desc.unlink()
+
+def getSharedBatch( shared, ids, nrsteps ):
+  """ Gets the examples of a training batch from shared arrays, with the
+      augmentation transforms applied. Runs in a BatchWorkerPool process.
+
+  Parameters:
+    * shared (SharedArrays): with the 'x' and 'y' arrays, and optionally a 'transform' object
+    * ids (list): sample numbers, in the range of the number of examples times nrsteps
+    * nrsteps (int): number of transform steps per example
+
+  Returns:
+    * tuple: (x, y) arrays of the batch
+  """
+
+  (arrays, extra) = shared.get()
+  ids = np.asarray( ids )
+  idx, rem = np.divmod( ids, nrsteps )
+  x_data = np.take( arrays['x'], idx, axis=0 )
+  y_data = np.take( arrays['y'], idx, axis=0 )
+  transform = shared.getObject( 'transform', onload=reseedTransforms_ )
+  if transform != None and len(transform.transforms) > 0:
+    seedBatchTransforms_( transform, extra.get('seed'), ids )
+    (x_data, y_data) = transform.transform_batch( x_data, y_data, ids, transform_idxs=rem )
+  return (x_data, y_data)
+
+def reseedTransforms_( transform ):
+  # each worker draws its own random transform parameters
+  for transform_i in transform.transforms:
+    transform_i.rng = np.random.default_rng()
+
+def seedBatchTransforms_( transform, seed, ids ):
+  # With a transform seed, the random parameters of a batch derive from the seed
+  # and the batch samples, whatever worker assembles it: reproducible with a pool
+  if not seed:
+    return
+  for itrans,transform_i in enumerate(transform.transforms):
+    transform_i.rng = np.random.default_rng( [seed, int(ids[0]), len(ids), itrans] )
+
+def initBatchWorker_():
+  global sharedarrays
+  sharedarrays = {}
+
+class BatchWorkerPool:
+  """ Worker processes assembling the training batches from arrays in shared
+      memory, including the augmentation transforms. The processes are started
+      once and serve all sequences, epochs and chunks of a training run.
+      They are spawned, not forked: the training process may hold a GPU context
+      and runs the read-ahead and prefetch threads.
+
+  Parameters:
+    * nrworkers (int): number of worker processes
+    * depth (int): number of batches requested in advance, per worker
+  """
+
+  def __init__( self, nrworkers, depth=2 ):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    self.nrworkers = nrworkers
+    self.nrahead = max( nrworkers*depth, 1 )
+    self._executor = ProcessPoolExecutor( max_workers=nrworkers, initializer=initBatchWorker_,
+                                          mp_context=multiprocessing.get_context('spawn') )
+
+  def submit( self, shared, ids, nrsteps ):
+    """ Requests a batch, see getSharedBatch
+
+    Returns:
+      * concurrent.futures.Future: with the (x, y) arrays of the batch
+    """
+
+    return self._executor.submit( getSharedBatch, shared, list(ids), nrsteps )
+
+  def close( self ):
+    """ Stops the worker processes """
+
+    if self._executor != None:
+      self._executor.shutdown( wait=True, cancel_futures=True )
+      self._executor = None
+
+def getScaledExamples( infos, datasets, scale=True ):
+  """ Reads the train and validation examples of a selection, with a single
+      allocation of the returned arrays and the scaling applied in place
+
+  Parameters:
+    * infos (dict): information about example file
+    * datasets (dict): train and validation selection
+    * scale (bool): apply the input scalers
+
+  Returns:
+    * dict: x_train, y_train, x_validate, y_validate arrays (when not empty)
+  """
+
+  ret = {}
+  parts = ( (dgbkeys.traindictstr, dgbkeys.xtraindictstr, dgbkeys.ytraindictstr),
+            (dgbkeys.validdictstr, dgbkeys.xvaliddictstr, dgbkeys.yvaliddictstr) )
+  for (partnm,xkey,ykey) in parts:
+    if partnm in datasets:
+      dsets = datasets[partnm]
+    elif partnm == dgbkeys.traindictstr:
+      dsets = datasets
+    else:
+      continue
+    data = LazyTrainingData( infos, dsets, scale=scale )
+    if len(data) > 0:
+      (ret[xkey], ret[ykey]) = data.load()
+    data.close()
+  y_examples = [ret[ykey] for ykey in (dgbkeys.ytraindictstr,dgbkeys.yvaliddictstr) if ykey in ret]
+  setClasses_( infos, y_examples )
+  return ret
+
+def setClasses_( infos, y_examples ):
+  """ Sets the classes from the outputs if not known yet, and normalizes
+      these outputs (when the classes are known they are normalized on read)
+  """
+
+  if dgbkeys.classdictstr in infos and infos[dgbkeys.classdictstr] and \
+     not dgbkeys.classesdictstr in infos:
+    getClasses( infos, y_examples )
+    if dgbkeys.classesdictstr in infos:
+      for y_vec in y_examples:
+        normalize_class_vector( y_vec, infos[dgbkeys.classesdictstr] )
+
 def getTrainingDataByInfo( info, dsetsel=None ):
   """ Gets training data from file info
 
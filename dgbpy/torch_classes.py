@@ -1328,7 +1328,7 @@ class UNet_VGG19(nn.Module):
 
 
 class TrainDatasetClass(Dataset):
-    def __init__(self, imgdp, scale, transform=list(), transform_copy = False):
+    def __init__(self, imgdp, scale, transform=list(), transform_copy = False, lazy = False, lazycachedir = None):
         """
         Details:
             imgdp : HDF5 Dataset
@@ -1337,9 +1337,17 @@ class TrainDatasetClass(Dataset):
             transform_copy : If True, the number of samples is multiplied by the number of transforms.
                              If False, the number of samples remains the same.
                                 But samples receives different transforms at each call.
+            lazy : If True, the samples are read on demand from the example file
+            lazycachedir : Directory of the memory-mapped cache used in lazy mode, if any
         """
         from dgbpy import transforms as T
         self.imgdp = imgdp
+        self.lazy = lazy
+        self.lazycachedir = lazycachedir
+        self.lazydata = None
+        self.prefetcher = None
+        self.shared = None
+        self._seedstate = None
         self._data_IDs = []
         self.scale, self.isDefScaler = dgbhdf5.isDefaultScaler(scale, imgdp[dgbkeys.infodictstr])
         self.transform = dgbkeys.listify(transform)
@@ -1357,25 +1365,55 @@ class TrainDatasetClass(Dataset):
                     - using the expected multiplied number of samples by the trfm_multiplier
         """
         sample, transform_idx = np.divmod(idx, len(self.trfm_multiplier))
+        X, Y = self._get_sample(sample)
         if self.ndims < 2:
-            X, Y = self._adaptShape(self.X[sample], self.y[sample])
+            X, Y = self._adaptShape(X, Y)
             return X, Y
         if self.transformer:
-            X, Y = self.transformer(self.X[sample], self.y[sample], idx, transform_idx = transform_idx)
+            X, Y = self.transformer(X, Y, idx, transform_idx = transform_idx)
             X, Y = self._adaptShape(X, Y)
             return X, Y
         else:
-            X, Y = self.X[sample], self.y[sample]
             X, Y = self._adaptShape(X, Y)
             return X, Y
 
+    def _get_sample(self, sample):
+        if self.lazydata != None:
+            X, Y = self.lazydata.get_sample(sample)
+            return X, Y.astype('float32')
+        if self.shared != None:
+            self._sync_shared()
+        return self.X[sample], self.y[sample]
+
+    def _sync_shared(self):
+        """
+            Attach to the shared arrays of the current chunk, and apply the
+            transform seed of the current epoch (in the worker processes)
+        """
+        arrays, extra = self.shared.get()
+        self.X, self.y = arrays['x'], arrays['y']
+        seed = extra.get('seed')
+        if seed != None and seed != self._seedstate:
+            self.transformer.set_uniform_generator_seed(*seed)
+            self._seedstate = seed
+
+    def __getstate__(self):
+        """
+            The worker processes get the arrays from shared memory, not pickled
+        """
+        state = self.__dict__.copy()
+        if self.shared != None:
+            for key in ('imgdp', 'X', 'y', 'prefetcher'):
+                state.pop(key, None)
+        return state
+
     def set_chunk(self, ichunk):
         """
             Set the chunk to be used for training
         """
         self.info = self.imgdp[dgbkeys.infodictstr]
         nbchunks = len(self.info[dgbkeys.trainseldicstr])
-        if nbchunks > 1 or dgbhdf5.isCrossValidation(self.info):
+        if nbchunks > 1 or dgbhdf5.isCrossValidation(self.info) or self.lazy:
             return self.set_fold(ichunk, 1)
         else:
             return self.get_data(self.imgdp, ichunk)
@@ -1384,6 +1422,10 @@ class TrainDatasetClass(Dataset):
         """
             Set the fold for a particular chunk to be used for training
         """
+        if self.lazy:
+            return self.set_lazy_data(ichunk, ifold)
+        if self.prefetcher != None:
+            return self.get_data(self.prefetcher.get(ichunk, ifold, scale=self.isDefScaler), ichunk)
         from dgbpy import mlapply as dgbmlapply
         trainchunk  = dgbmlapply.getScaledTrainingDataByInfo( self.info,
                                                 flatten=False,
@@ -1397,6 +1439,9 @@ class TrainDatasetClass(Dataset):
         if self.transform_seed:
             self.transform_seed+=1
         self.transformer.set_uniform_generator_seed(self.transform_seed, len(self))
+        if self.shared != None:
+            self._seedstate = [self.transform_seed, len(self)]
+            self.shared.publish(seed=self._seedstate)
 
     def get_data(self, trainchunk, ichunk):
         """
@@ -1404,14 +1449,33 @@ class TrainDatasetClass(Dataset):
         """
         from dgbpy import dgbtorch
         X, y, info, im_ch, self.ndims = dgbtorch.getDatasetPars(trainchunk, False)
-        self.X = X.astype('float32')
-        self.y = y.astype('float32')
+        self.X = X.astype('float32', copy=False)
+        self.y = y.astype('float32', copy=False)
+        if self.shared != None:
+            arrays = self.shared.publish({'x': self.X, 'y': self.y})
+            self.X, self.y = arrays['x'], arrays['y']
 
         if ichunk == 0: # initialise transforms on first chunk only
             self.set_transforms(info)
         self._data_IDs = range(len(self.X)*(len(self.trfm_multiplier)))
         return True
 
+    def set_lazy_data(self, ichunk, ifold):
+        """
+            Set up on demand reading of the samples of a chunk/fold
+        """
+        from dgbpy import dgbtorch
+        from dgbpy import mlio as dgbmlio
+        if self.lazydata != None:
+            self.lazydata.close()
+        self.lazydata = dgbmlio.getLazyTrainingData(self.info, ichunk, ifold, forvalid=False,
+                                                    scale=self.isDefScaler, cachedir=self.lazycachedir)
+        self.ndims = dgbtorch.getNrDims(self.info)
+        if not self.transformer:
+            self.set_transforms(self.info)
+        self._data_IDs = range(len(self.lazydata)*(len(self.trfm_multiplier)))
+        return len(self.lazydata) > 0
+
     def set_transforms(self, info):
         """
             Set the transforms to be applied to the data
@@ -1476,14 +1540,31 @@ class TrainDatasetClass(Dataset):
         return data, label
 
 class TestDatasetClass(Dataset):
-    def __init__(self, imgdp, scale):
+    def __init__(self, imgdp, scale, lazy = False, lazycachedir = None):
         self.imgdp = imgdp
         self.scale, self.isDefScaler=dgbhdf5.isDefaultScaler(scale, imgdp[dgbkeys.infodictstr])
         self.transform = []
+        self.lazy = lazy
+        self.lazycachedir = lazycachedir
+        self.lazydata = None
+        self.prefetcher = None
+        self.shared = None
 
     def __len__(self):
+        if self.lazydata != None:
+            return len(self.lazydata)
         return self.X.shape[0]
 
+    def __getstate__(self):
+        """
+            The worker processes get the arrays from shared memory, not pickled
+        """
+        state = self.__dict__.copy()
+        if self.shared != None:
+            for key in ('imgdp', 'X', 'y', 'prefetcher'):
+                state.pop(key, None)
+        return state
+
     def transformer(self, image, label, index):
         if self.transform:
             return self.transform(image, label, index)
@@ -1492,12 +1573,16 @@ class TestDatasetClass(Dataset):
     def set_chunk(self, ichunk):
         self.info = self.imgdp[dgbkeys.infodictstr]
         nbchunks = len(self.info[dgbkeys.trainseldicstr])
-        if nbchunks > 1 or dgbhdf5.isCrossValidation(self.info):
+        if nbchunks > 1 or dgbhdf5.isCrossValidation(self.info) or self.lazy:
             return self.set_fold(ichunk, 1)
         else:
             return self.get_data(self.imgdp, ichunk)
 
     def set_fold(self, ichunk, ifold):
+        if self.lazy:
+            return self.set_lazy_data(ichunk, ifold)
+        if self.prefetcher != None:
+            return self.get_data(self.prefetcher.get(ichunk, ifold, scale=True), ichunk)
         from dgbpy import mlapply as dgbmlapply
         validchunk  = dgbmlapply.getScaledTrainingDataByInfo( self.info,
                                                 flatten=False,
@@ -1508,62 +1593,88 @@ class TestDatasetClass(Dataset):
         from dgbpy import dgbtorch
         from dgbpy import transforms as T
         X, y, info, im_ch, self.ndims = dgbtorch.getDatasetPars(validchunk, True)
-        self.X = X.astype('float32')
-        self.y = y.astype('float32')
+        self.X = X.astype('float32', copy=False)
+        self.y = y.astype('float32', copy=False)
+        if self.shared != None:
+            arrays = self.shared.publish({'x': self.X, 'y': self.y})
+            self.X, self.y = arrays['x'], arrays['y']
 
         if ichunk == 0:
             if not self.isDefScaler:
                 self.transform = T.TransformCompose(self.scale, info, self.ndims)
         return True
 
+    def set_lazy_data(self, ichunk, ifold):
+        from dgbpy import dgbtorch
+        from dgbpy import mlio as dgbmlio
+        from dgbpy import transforms as T
+        if self.lazydata != None:
+            self.lazydata.close()
+        self.lazydata = dgbmlio.getLazyTrainingData(self.info, ichunk, ifold, forvalid=True,
+                                                    scale=True, cachedir=self.lazycachedir)
+        self.ndims = dgbtorch.getNrDims(self.info)
+        if not self.transform and not self.isDefScaler:
+            self.transform = T.TransformCompose(self.scale, self.info, self.ndims)
+        return len(self.lazydata) > 0
+
     def __getitem__(self,index):
+        if self.lazydata != None:
+            X, y = self.lazydata.get_sample(index)
+            # A sample read on demand goes through the same selection, as a chunk of one
+            return self._get_item(X[np.newaxis], y.astype('float32')[np.newaxis], 0, index)
+        if self.shared != None:
+            arrays, extra = self.shared.get()
+            self.X, self.y = arrays['x'], arrays['y']
+        return self._get_item(self.X, self.y, index, index)
+
+    def _get_item(self, X, y, i, index):
         classification = self.info[dgbkeys.classdictstr]
         if self.ndims == 3:
-            if len(self.X.shape)==len(self.y.shape) and len(self.X.shape)==5 and classification:   #segmentation
-                data = self.X[index, :, :, :, :]
-                label = self.y[index, :, :, :, :]
-            elif len(self.X.shape)>len(self.y.shape) and classification:    #supervised
-                data = self.X[index, :, :, :, :]
-                label = self.y[index, :]
+            if len(X.shape)==len(y.shape) and len(X.shape)==5 and classification:   #segmentation
+                data = X[i, :, :, :, :]
+                label = y[i, :, :, :, :]
+            elif len(X.shape)>len(y.shape) and classification:    #supervised
+                data = X[i, :, :, :, :]
+                label = y[i, :]
             elif not self.info[dgbkeys.classdictstr]:
-                if len(self.X.shape)==len(self.y.shape):
-                    data = self.X[index, :, :, :, :]
-                    label = self.y[index, :, :, :, :]
-                elif len(self.X.shape)>len(self.y.shape):    #supervised regression
-                    data = self.X[index, :, :, :, :]
-                    label = self.y[index, :]
+                if len(X.shape)==len(y.shape):
+                    data = X[i, :, :, :, :]
+                    label = y[i, :, :, :, :]
+                elif len(X.shape)>len(y.shape):    #supervised regression
+                    data = X[i, :, :, :, :]
+                    label = y[i, :]
         elif self.ndims == 2:
-            if len(self.X.shape)==len(self.y.shape) and len(self.X.shape)==5 and classification:   #segmentation
-                data = self.X[index, :, 0, :, :]
-                label = self.y[index, :, 0, :, :]
-            elif len(self.X.shape)>len(self.y.shape) and classification:    #supervised
-                data = self.X[index, :, 0, :, :]
-                label = self.y[index, :]
+            if len(X.shape)==len(y.shape) and len(X.shape)==5 and classification:   #segmentation
+                data = X[i, :, 0, :, :]
+                label = y[i, :, 0, :, :]
+            elif len(X.shape)>len(y.shape) and classification:    #supervised
+                data = X[i, :, 0, :, :]
+                label = y[i, :]
             elif not self.info[dgbkeys.classdictstr]:
-                if len(self.X.shape)==len(self.y.shape):
-                    data = self.X[index, :, 0, :, :]
-                    label = self.y[index, :, 0, :, :]
-                elif len(self.X.shape)>len(self.y.shape):    #supervised regression
-                    data = self.X[index, :, 0, :, :]
-                    label = self.y[index, :]
+                if len(X.shape)==len(y.shape):
+                    data = X[i, :, 0, :, :]
+                    label = y[i, :, 0, :, :]
+                elif len(X.shape)>len(y.shape):    #supervised regression
+                    data = X[i, :, 0, :, :]
+                    label = y[i, :]
         elif self.ndims == 1:
-            if len(self.X.shape)==len(self.y.shape) and len(self.X.shape)==5 and classification:   #segmentation
-                data = self.X[index, :, 0, 0, :]
-                label = self.y[index, :, 0, 0, :]
-            elif len(self.X.shape)>len(self.y.shape) and classification:    #supervised classification
-                data = self.X[index, :, 0, 0, :]
-                label = self.y[index, :]
+            if len(X.shape)==len(y.shape) and len(X.shape)==5 and classification:   #segmentation
+                data = X[i, :, 0, 0, :]
+                label = y[i, :, 0, 0, :]
+            elif len(X.shape)>len(y.shape) and classification:    #supervised classification
+                data = X[i, :, 0, 0, :]
+                label = y[i, :]
             elif not self.info[dgbkeys.classdictstr]:
-                if len(self.X.shape)==len(self.y.shape):
-                    data = self.X[index, :, 0, 0, :]
-                    label = self.y[index, :, 0, 0, :]
-                elif len(self.X.shape)>len(self.y.shape):    #supervised regression
-                    data = self.X[index, :, 0, 0, :]
-                    label = self.y[index, :]
+                if len(X.shape)==len(y.shape):
+                    data = X[i, :, 0, 0, :]
+                    label = y[i, :, 0, 0, :]
+                elif len(X.shape)>len(y.shape):    #supervised regression
+                    data = X[i, :, 0, 0, :]
+                    label = y[i, :]
         elif classification:
-            return self.X[index, :, 0, 0, :], self.y[index, :]
+            return X[i, :, 0, 0, :], y[i, :]
         else:
-            return self.X[index, :, 0, 0, :], self.y[index, :]
+            return X[i, :, 0, 0, :], y[i, :]
 
         return self.transformer(data, label, index)
 
@@ -1572,19 +1683,25 @@ class DatasetApply(Dataset):
         super().__init__()
         self.im_ch = im_ch
         self.ndims = ndims
-        self.X = X.astype('float32')
+        self.X = X.astype('float32', copy=False)
         self.isclassification = isclassification
+        # Strided (windowed) views are read-only: copy per sample, the batch gets
+        # materialized by the collate function
+        self.copy = not self.X.flags.writeable
 
     def __len__(self):
         return self.X.shape[0]
     
     def __getitem__(self,index):
         if self.ndims == 3:
-            return self.X[index, :, :, :, :]
+            sample = self.X[index, :, :, :, :]
         elif self.ndims == 2:
-            return self.X[index, :, 0, :, :]
+            sample = self.X[index, :, 0, :, :]
         elif self.ndims == 1:
-            return self.X[index, :, 0, 0, :]
+            sample = self.X[index, :, 0, 0, :]
+        if self.copy:
+            return np.array(sample)
+        return sample
 
 import importlib
 import pkgutil
@@ -39,6 +39,7 @@ class BaseTransform(ABC):
         self.p = p
         self.uniform_prob = np.random.uniform(0,1)
         self.do_label_transform = False
+        self.rng = np.random.default_rng()
 
     def can_apply(self, info):
         """
@@ -72,6 +73,17 @@ class BaseTransform(ABC):
                 label = self.transform(label)
         return image, label
 
+    def transform_batch(self, arr, labels=None):
+        """
+            Returns the transformed batch of samples, and of labels if given.
+            Transforms one sample at a time by default, override for a vectorised implementation.
+            Random parameters should be drawn from self.rng, once for the batch.
+        """
+        arr = np.stack([self.transform(sample) for sample in arr])
+        if labels is not None:
+            labels = np.stack([self.transform(label) for label in labels])
+        return arr, labels
+
 
 
 class Flip(BaseTransform):
@@ -107,6 +119,29 @@ class Flip(BaseTransform):
             self.transform_pars(arr_shape)
             return np.rot90(arr,self.aug_axis,self.aug_dims).copy()
 
+    def transform_batch(self, arr, labels=None):
+        if self.ndims == 2:
+            arr = np.flip(arr, axis=2)
+            if labels is not None:
+                labels = np.flip(labels, axis=2)
+            return arr, labels
+        self.aug_dims = (1, 2)
+        cubesz = arr.shape[3:5]
+        if cubesz[0] == cubesz[1]:
+            aug_axes = (self.mult_count + 1 + np.arange(len(arr))) % 3
+            self.mult_count += len(arr)
+        else:
+            aug_axes = np.full(len(arr), 2)
+        arr = arr.copy()
+        if labels is not None:
+            labels = labels.copy()
+        for aug_axis in np.unique(aug_axes):
+            sel = aug_axes == aug_axis
+            arr[sel] = np.rot90(arr[sel], aug_axis, (2, 3))
+            if labels is not None:
+                labels[sel] = np.rot90(labels[sel], aug_axis, (2, 3))
+        return arr, labels
+
 class GaussianNoise(BaseTransform):
     def __init__(self, p=0.2, std=0.1):
         super().__init__()
@@ -121,6 +156,11 @@ class GaussianNoise(BaseTransform):
         noise = np.random.normal(loc = 0, scale = self.std, size = arr.shape).astype('float32')
         return arr + noise
 
+    def transform_batch(self, arr, labels=None):
+        noise = self.rng.standard_normal(size = arr.shape, dtype = np.float32)
+        noise *= self.std
+        return arr + noise, labels
+
 def hasOpenCV():
   try:
     import cv2
@@ -128,6 +168,8 @@ def hasOpenCV():
     return False
   return True
 
+cv2maxchannels = 512
+
 class Rotate(BaseTransform):
     def __init__(self, p=0.2, angle=15):
         super().__init__()
@@ -138,6 +180,20 @@ class Rotate(BaseTransform):
             import cv2
             self.cv2 = cv2
 
+    def __getstate__(self):
+        """
+            The OpenCV module is not pickled, but imported again in the worker processes.
+        """
+        state = self.__dict__.copy()
+        state.pop('cv2', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if hasOpenCV():
+            import cv2
+            self.cv2 = cv2
+
     def transform_label(self, info):
         return dgbhdf5.isImg2Img(info)
 
@@ -166,6 +222,37 @@ class Rotate(BaseTransform):
             _arr[attrib,:] = self.cv2.warpAffine( _arr[attrib], M , dst_image , borderMode=self.cv2.BORDER_REFLECT)
         return _arr.copy()
 
+    def transform_batch(self, arr, labels=None):
+        """
+            Samples with the same angle are rotated together, all their attributes
+            being warped as the channels of a single image.
+        """
+        angles = self.rng.integers(-self.angle, self.angle, size=len(arr))
+        arr = arr.copy()
+        if labels is not None:
+            labels = labels.copy()
+        for angle in np.unique(angles):
+            sel = angles == angle
+            arr[sel] = self.warp_batch(arr[sel], angle)
+            if labels is not None:
+                labels[sel] = self.warp_batch(labels[sel], angle)
+        return arr, labels
+
+    def warp_batch(self, arr, angle):
+        planeaxes = (-2, -1) if self.ndims == 2 else (-3, -2)
+        _arr = np.moveaxis(arr, planeaxes, (0, 1))
+        planeshape = _arr.shape[:2]
+        center = ( planeshape[1]//2, planeshape[0]//2 )
+        dst_image = (planeshape[1], planeshape[0])
+        M = self.cv2.getRotationMatrix2D(center, float(angle), 1)
+        channels = np.ascontiguousarray(_arr.reshape((*planeshape, -1)))
+        for start in range(0, channels.shape[-1], cv2maxchannels):
+            stop = min(start+cv2maxchannels, channels.shape[-1])
+            warped = self.cv2.warpAffine( np.ascontiguousarray(channels[..., start:stop]), M, dst_image,
+                                          borderMode=self.cv2.BORDER_REFLECT)
+            channels[..., start:stop] = warped.reshape((*planeshape, stop-start))
+        return np.moveaxis(channels.reshape(_arr.shape), (0, 1), planeaxes)
+
 class Translate(BaseTransform):
     def __init__(self, p = 0.15, percent = 20):
         super().__init__()
@@ -190,6 +277,25 @@ class Translate(BaseTransform):
             transform_axes = (0, *ax)
         return self.shift(arr, transform_axes)
 
+    def transform_batch(self, arr, labels=None):
+        """
+            The shifts are whole numbers of samples, the same for all samples of a batch:
+            the data is moved by slicing and the uncovered part is set to zero
+        """
+        arr = self.shift_batch(arr)
+        if labels is not None:
+            labels = self.shift_batch(labels)
+        return arr, labels
+
+    def shift_batch(self, arr):
+        firstaxis = 3 if self.ndims == 2 else 2
+        shifts = [0] * firstaxis + [int(x*self.percent) for x in arr.shape[firstaxis:]]
+        ret = np.zeros_like(arr)
+        src = tuple( slice(0, dim-shift) for dim, shift in zip(arr.shape, shifts) )
+        dst = tuple( slice(shift, dim) for dim, shift in zip(arr.shape, shifts) )
+        ret[dst] = arr[src]
+        return ret
+
 class FlipPolarity(BaseTransform):
     def __init__(self, p = 0.2):
         """
@@ -217,6 +323,11 @@ class FlipPolarity(BaseTransform):
         transfomed_arr = arr * -1.0
         return transfomed_arr
 
+    def transform_batch(self, arr, labels=None):
+        if labels is not None:
+            labels = -labels
+        return -arr, labels
+
 
 
 class ScaleTransform(BaseTransform):
@@ -329,6 +440,7 @@ class TransformCompose():
             if seed: seed+=1 # set different seed for each transform
             self.randomstate = np.random.RandomState(seed=seed)
             transform_i.all_uniform_prob = self.randomstate.uniform(0, 1, nsamples)
+            transform_i.rng = np.random.default_rng(seed) # random parameters of the batch transforms
 
     def passModuleCheck(self, transform_i):
         """
@@ -399,6 +511,8 @@ class TransformCompose():
                 prob_idx: index of the current sample used to choose the uniform probability when using seed
                 transform_idx: value to be used for mixed transforms
         """
+        if np.ndim(prob_idx) > 0:
+            return self.transform_batch(image, label, prob_idx, transform_idxs=transform_idx)
         copy_prob = self.copy_config(transform_idx)
         for tr_label, transform_i in enumerate(self.transforms):
             if hasattr(transform_i, 'p') and self.use_copy_method(copy_prob):
@@ -408,6 +522,49 @@ class TransformCompose():
             image, label = transform_i(image=image, label=label, ndims=self.ndims, create_copy=self.create_copy)
         return image, label
 
+    def transform_batch(self, images, labels, prob_idxs, transform_idxs=None):
+        """
+            Applies all the transforms to a batch of samples.
+            Each transform is applied at once to all samples selected by its probability,
+            using the same selection rules as for single samples.
+
+            Args:
+                images: batch of samples, transformed in place
+                labels: batch of labels, transformed in place
+                prob_idxs: index of each sample used to choose the uniform probability when using seed
+                transform_idxs: value of each sample to be used for mixed transforms
+        """
+        prob_idxs = np.asarray(prob_idxs)
+        nrsamples = len(images)
+        copy_probs = None
+        if self.create_copy and transform_idxs is not None:
+            copy_probs = np.array([self.copy_config(transform_idx) for transform_idx in transform_idxs])
+        for tr_label, transform_i in enumerate(self.transforms):
+            if copy_probs is not None:
+                p = copy_probs[:, tr_label]
+            else:
+                p = np.full(nrsamples, transform_i.p)
+            if self.use_seed:
+                uniform_prob = transform_i.all_uniform_prob[prob_idxs]
+            else:
+                uniform_prob = np.full(nrsamples, transform_i.uniform_prob)
+            sel = np.flatnonzero(p > uniform_prob)
+            if len(sel) < 1:
+                continue
+            transform_i.ndims = self.ndims
+            transform_i.create_copy = self.create_copy
+            dolabel = transform_i.do_label_transform
+            if len(sel) == nrsamples:
+                images, newlabels = transform_i.transform_batch(images, labels if dolabel else None)
+                if dolabel:
+                    labels = newlabels
+                continue
+            newimages, newlabels = transform_i.transform_batch(images[sel], labels[sel] if dolabel else None)
+            images[sel] = newimages
+            if dolabel:
+                labels[sel] = newlabels
+        return images, labels
+
 
 class TransformMultiplier:
     """
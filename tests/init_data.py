@@ -6,6 +6,7 @@ import dgbpy.hdf5 as dgbhdf5
 import dgbpy.mlapply as dgbml
 import dgbpy.mlio as dgbmlio
 import numpy as np
+import h5py
 
 
 def get_default_examples(nr_inattr=1, nr_outattr=1):
@@ -340,3 +341,34 @@ def get_loglog_classification_data(nrpts=16, nbchunks=1, seed=0, split=0.2, nbfo
         dbk.yvaliddictstr: y_validate,
         dbk.infodictstr: info,
     }
+
+
+def make_loglog_example_file(filenm, nrpts=(40, 25, 33), nr_inattr=2, nrz=16):
+    """Writes a log-log example file of random logs, with one group of examples per well"""
+    with h5py.File(filenm, 'w') as h5file:
+        info = h5file.create_dataset('++info++', data=np.zeros(1)).attrs
+        info['Type'] = dbk.loglogtypestr
+        info['Examples.Size'] = '1'
+        info['Examples.0.Size'] = str(len(nrpts))
+        info['Examples.0.Target'] = 'Density'
+        info['Examples.0.Survey'] = 'Survey'
+        info['Examples.0.Name'] = 'Survey'
+        for iwell, wellnrpts in enumerate(nrpts):
+            info[f'Examples.0.{iwell}.Name'] = f'Well{iwell}'
+            info[f'Examples.0.{iwell}.ID'] = f'100.{iwell}'
+            wellgrp = h5file.create_group(f'Survey/Well{iwell}')
+            wellgrp['x_data'] = np.random.random((wellnrpts, nr_inattr, nrz)) * 10 + 3
+            wellgrp['y_data'] = np.random.random((wellnrpts, 1))
+        info['Input.Size'] = '1'
+        info['Input.0.Size'] = str(nr_inattr)
+        info['Input.0.Survey'] = 'Survey'
+        info['Input.0.Name'] = 'Survey'
+        for iattr in range(nr_inattr):
+            info[f'Input.0.{iattr}.Name'] = f'Log{iattr}'
+        info['Input.Shape'] = f'1`1`{nrz}'
+        info['Output.Shape'] = '1'
+        info['Edge extrapolation'] = 'No'
+        info['Z step'] = '0.1'
+        info['Top marker'] = 'Top'
+        info['Bottom marker'] = 'Bottom'
+    return filenm
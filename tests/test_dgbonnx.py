@@ -71,3 +71,59 @@ def test_onnx_model_one_inattr_one_outattr(data):
 
 
 
+@pytest.mark.parametrize('data',
+                         (get_2d_seismic_imgtoimg_data(nrpts=40, nrclasses=5), get_3d_seismic_imgtoimg_data(nrpts=40, nrclasses=5)),
+                         ids=['2D_seismic_imgtoimg', '3D_seismic_imgto_img'])
+def test_onnx_batched_predict_matches_per_sample_predict(data):
+    info = data[dbk.infodictstr]
+    inpshape = info[dbk.inpshapedictstr]
+    shapepar = inpshape[1:] if 1 in inpshape else inpshape
+    make_onnx_model(shapepar, 1, 1, 'channels_first')
+    modelfn = get_model_filename(shapepar)+'.onnx'
+
+    model = dgbonnx.OnnxModel(modelfn)
+    assert model.dynamic_batch
+
+    samples = data[dbk.xtraindictstr]
+    reference = np.stack([model(samples[idx:idx+1])[0] for idx in range(len(samples))])
+    for batch_size in (None, 1, 3, len(samples)):
+        prediction = dgbonnx.predict(model, samples, batch_size)
+        assert prediction.shape == reference.shape
+        assert np.allclose(prediction, reference)
+    assert model.dynamic_batch
+
+    model.dynamic_batch = False
+    assert np.allclose(dgbonnx.predict(model, samples), reference)
+
+    os.remove(modelfn)
+
+class FixedBatchModel:
+    # Rejects more than one sample per run, as a model without a dynamic batch axis
+    def __init__(self, error):
+        self.dynamic_batch = True
+        self.error = error
+        self.runs = []
+
+    def __call__(self, inputs):
+        self.runs.append(len(inputs))
+        if len(inputs) > 1:
+            raise self.error
+        return inputs * 2
+
+@pytest.mark.parametrize('privatemodule', (True, False), ids=['exception_type', 'message'])
+def test_onnx_predict_falls_back_on_invalid_arguments_only(monkeypatch, privatemodule):
+    error = RuntimeError('[ONNXRuntimeError] : 2 : INVALID_ARGUMENT : Got invalid dimensions for input')
+    if privatemodule and dgbonnx.InvalidArgument != None:
+        error = dgbonnx.InvalidArgument(str(error))
+    else:
+        monkeypatch.setattr(dgbonnx, 'InvalidArgument', None)
+    samples = np.arange(10, dtype=np.float32).reshape(5, 1, 2)
+    model = FixedBatchModel(error)
+    assert np.array_equal(dgbonnx.predict(model, samples, 4), samples*2)
+    assert not model.dynamic_batch
+    assert model.runs == [4, 1, 1, 1, 1, 1]
+
+    model = FixedBatchModel(MemoryError('out of memory'))
+    with pytest.raises(MemoryError):
+        dgbonnx.predict(model, samples, 4)
+    assert model.dynamic_batch
@@ -502,3 +502,51 @@ def test_train_and_apply_multiple_in_and_out_attributes(data):
     assert prediction.shape == yvalid.shape, 'prediction shape should be the same as the target shape'
 
 
+
+@pytest.mark.parametrize('cached', (False, True), ids=['lazy', 'lazy_cached'])
+def test_lazy_datasets_match_loaded_datasets(tmp_path, cached):
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    imgdp = dgbml.getScaledTrainingData(examplefilenm, split=0.2, nbfolds=0, seed=3)
+    lazyimgdp = {dbk.infodictstr: imgdp[dbk.infodictstr]}
+    lazycachedir = str(tmp_path) if cached else None
+    for datasetclass, kwargs in ((tc.TrainDatasetClass, {'transform': []}), (tc.TestDatasetClass, {})):
+        dataset = datasetclass(imgdp, dbk.globalstdtypestr, **kwargs)
+        lazydataset = datasetclass(lazyimgdp, dbk.globalstdtypestr, lazy=True, lazycachedir=lazycachedir, **kwargs)
+        assert dataset.set_chunk(0) and lazydataset.set_chunk(0)
+        assert len(lazydataset) == len(dataset)
+        for idx in range(len(dataset)):
+            X, Y = dataset[idx]
+            lazyX, lazyY = lazydataset[idx]
+            assert np.allclose(lazyX, X)
+            assert np.array_equal(lazyY, Y)
+
+@pytest.mark.parametrize('create_copy', (False, True), ids=['inplace', 'copy'])
+@pytest.mark.parametrize('seed', (None, 5), ids=['unseeded', 'seeded'])
+@pytest.mark.parametrize('transform, ndims, inpshape', (
+    ('FlipPolarity', 2, [1,16,16]),
+    ('Translate', 2, [1,16,16]),
+    ('Translate', 3, [16,16,16]),
+    ('Flip', 2, [16,1,16]),
+))
+def test_transform_batch_matches_per_sample_transforms(transform, ndims, inpshape, seed, create_copy):
+    from dgbpy.transforms import TransformCompose
+    info = get_seismic_imgtoimg_info(nrclasses=1, inpshape=inpshape, outshape=inpshape)
+    compose = TransformCompose([transform], info, ndims, create_copy=create_copy)
+    nrpts = 12
+    rng = np.random.default_rng(0)
+    X = rng.random((nrpts, 2, *inpshape), dtype=np.float32)
+    Y = rng.random((nrpts, 2, *inpshape), dtype=np.float32)
+    ids = np.arange(nrpts)
+    transform_idxs = ids % len(compose.multiplier)
+    if seed != None:
+        compose.set_uniform_generator_seed(seed, 100)
+    for tr in compose.transforms:
+        tr.p = 0.6
+    samplecompose = copy.deepcopy(compose)
+    sampleX, sampleY = X.copy(), Y.copy()
+    for idx in range(nrpts):
+        sampleX[idx], sampleY[idx] = samplecompose(X[idx].copy(), Y[idx].copy(), ids[idx], transform_idx=transform_idxs[idx])
+    batchX, batchY = compose(X.copy(), Y.copy(), ids, transform_idx=transform_idxs)
+    assert np.allclose(batchX, sampleX)
+    assert np.allclose(batchY, sampleY)
+    assert not np.allclose(batchX, X)
@@ -425,3 +425,33 @@ def test_train_and_apply_multiple_in_and_out_attributes(data):
     assert prediction.shape == yvalid.shape, 'prediction shape should be the same as the target shape'
 
     os.remove(filename)
+
+class ModelInput:
+    def __init__(self, input_shape, data_format):
+        self.input_shape = input_shape
+        self.data_format = data_format
+
+def model_adapter_cases():
+    cases = []
+    for data_format in ('channels_first', 'channels_last'):
+        for nrattribs in (1, 3):
+            for cubeshape, modelcubeshape in (((1, 1, 16), (16,)), ((1, 1, 16), (12,)), ((1, 8, 8), (8, 8)),
+                                              ((8, 8, 8), (8, 8, 8)), ((8, 8, 8), (6, 6, 6)), ((1, 8, 8), (6, 8)),
+                                              ((1, 1, 16), (None,))):
+                if data_format == 'channels_first':
+                    input_shape = (None, nrattribs) + modelcubeshape
+                else:
+                    input_shape = (None,) + modelcubeshape + (nrattribs,)
+                cases.append(((nrattribs,)+cubeshape, ModelInput(input_shape, data_format)))
+    return cases
+
+@pytest.mark.parametrize('sampleshape,model', model_adapter_cases())
+def test_getModelAdapter_matches_adaptToModel(sampleshape, model, monkeypatch):
+    monkeypatch.setattr(dgbkeras, 'get_data_format', lambda model: model.data_format)
+    adapter = dgbkeras.getModelAdapter(model, sampleshape, dictinpshape=sampleshape[1:])
+    for nrsamples in (1, 5):
+        samples = np.random.random((nrsamples, *sampleshape)).astype(np.float32)
+        expected = dgbkeras.adaptToModel(model, samples, dictinpshape=sampleshape[1:])
+        adapted = adapter(samples)
+        assert adapted.shape == expected.shape
+        assert np.array_equal(adapted, expected)
@@ -3,6 +3,7 @@ sys.path.insert(0, '..')
 
 import os
 import fnmatch, pytest
+import h5py
 import dgbpy.keystr as dbk
 import dgbpy.mlapply as dgbml
 from init_data import *
@@ -168,3 +169,793 @@ def cleanup_after_tests(request):
     request.addfinalizer(finalizer)
 
 
+
+def test_getContiguousRuns():
+    sortedidxs, starts, stops = dgbhdf5.getContiguousRuns([7, 3, 4, 5, 20, 21, 49])
+    assert sortedidxs.tolist() == [3, 4, 5, 7, 20, 21, 49]
+    runs = [sortedidxs[start:stop].tolist() for start, stop in zip(starts, stops)]
+    assert runs == [[3, 4, 5], [7], [20, 21], [49]]
+    sortedidxs, starts, stops = dgbhdf5.getContiguousRuns(np.array([], dtype=np.int32))
+    assert len(sortedidxs) == 0 and len(starts) == 0 and len(stops) == 0
+
+def test_readDatasetRuns(tmp_path):
+    x = np.random.random((50, 2, 1, 1, 16))
+    y = np.arange(50, dtype=np.int32).reshape(50, 1)
+    idxs = [7, 3, 4, 5, 20, 21, 49, 0]
+    with h5py.File(tmp_path / 'runs.h5', 'w') as h5file:
+        h5file['x'] = x
+        h5file['y'] = y
+        xout = np.empty((len(idxs), 2, 1, 1, 16), np.float32)
+        yout = np.empty((len(idxs), 1), np.uint8)
+        assert dgbhdf5.readDatasetRuns(h5file['x'], idxs, xout)
+        assert dgbhdf5.readDatasetRuns(h5file['y'], idxs, yout)
+        # Rows are read in ascending index order, converted to the output type
+        assert np.array_equal(xout, x[sorted(idxs)].astype(np.float32))
+        assert np.array_equal(yout, y[sorted(idxs)].astype(np.uint8))
+        # Selections that cannot be read that way leave the output untouched
+        badout = np.zeros((len(idxs), 31), np.float32)
+        assert not dgbhdf5.readDatasetRuns(h5file['x'], idxs, badout)
+        assert not badout.any()
+        # Empty selections
+        emptyout = np.empty((0, 2, 1, 1, 16), np.float32)
+        assert dgbhdf5.readDatasetRuns(h5file['x'], np.array([], dtype=np.int64), emptyout)
+        dgbhdf5.readDatasetRows(h5file['x'], np.array([], dtype=np.int64), emptyout)
+
+def get_cubelet_names_per_item(h5file, groupnm, collnm, idx):
+    # Former lookup of a single collection, one group listing per item
+    if not groupnm in h5file:
+        return {}
+    group = h5file[groupnm]
+    dsetnms = list(group.keys())
+    if collnm in dsetnms:
+        ret = np.arange(len(group[collnm][dbk.xdatadictstr]))
+    elif len(dsetnms)==1 and collnm in dsetnms[0].split('`'):
+        ret = np.arange(len(group[dsetnms[0]][dbk.xdatadictstr]))
+    else:
+        dsetnms = list(map(str, dsetnms))
+        dsetwithinp = np.char.startswith(dsetnms, str(idx)+':')
+        ret = np.extract(dsetwithinp, dsetnms)
+    return np.ndarray.tolist(ret)
+
+def test_getCubeLetIndicesByGroup_matches_per_item_lookup(tmp_path):
+    collections = {
+        'bycollnm': {'collA': {dbk.iddictstr: 0}, 'collB': {dbk.iddictstr: 1}},
+        'byidx': {'w': {dbk.iddictstr: 3}, 'v': {dbk.iddictstr: 1},
+                  'u': {dbk.iddictstr: 12}, 'missing': {dbk.iddictstr: 7}},
+        'img2img': {'a': {dbk.iddictstr: 0}, 'b': {dbk.iddictstr: 1}},
+        'nogroup': {'a': {dbk.iddictstr: 0}},
+    }
+    with h5py.File(tmp_path / 'cubelets.h5', 'w') as h5file:
+        h5file[f'bycollnm/collA/{dbk.xdatadictstr}'] = np.zeros((5, 2))
+        h5file[f'bycollnm/collB/{dbk.xdatadictstr}'] = np.zeros((3, 2))
+        for dsetnm in ('3:a', '3:b', '12:c', '31:d', '1'):
+            h5file[f'byidx/{dsetnm}/{dbk.xdatadictstr}'] = np.zeros((1, 2))
+        h5file[f'img2img/a`b/{dbk.xdatadictstr}'] = np.zeros((4, 2))
+        for groupnm, collection in collections.items():
+            ret = dgbhdf5.getCubeLetIndicesByGroup(h5file, groupnm, collection)
+            assert list(ret.keys()) == list(collection.keys())
+            for collnm, coll in collection.items():
+                expected = get_cubelet_names_per_item(h5file, groupnm, collnm, coll[dbk.iddictstr])
+                assert list(ret[collnm]) == list(expected)
+        ret = dgbhdf5.getCubeLetIndicesByGroup(h5file, 'byidx', collections['byidx'])
+        assert ret['w'].tolist() == ['3:a', '3:b']
+        assert ret['u'].tolist() == ['12:c']
+        assert ret['v'].tolist() == [] and ret['missing'].tolist() == []
+        ret = dgbhdf5.getCubeLetIndicesByGroup(h5file, 'img2img', collections['img2img'])
+        assert ret['a'].tolist() == ret['b'].tolist() == [0, 1, 2, 3]
+
+def count_info_reads(monkeypatch):
+    reads = []
+    getInfo_ = dgbhdf5.getInfo_
+    def counted_getInfo_(filenm, quick):
+        reads.append(filenm)
+        return getInfo_(filenm, quick)
+    monkeypatch.setattr(dgbhdf5, 'getInfo_', counted_getInfo_)
+    return reads
+
+def test_getInfo_cache(tmp_path, monkeypatch):
+    dgbhdf5.clearInfoCache()
+    reads = count_info_reads(monkeypatch)
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    info = dgbhdf5.getInfo(examplefilenm, False)
+    info[dbk.exampledictstr].clear()
+    cachedinfo = dgbhdf5.getInfo(examplefilenm, False)
+    assert len(reads) == 1
+    # Callers get their own copy
+    assert len(cachedinfo[dbk.exampledictstr]) == 1
+    dgbhdf5.getInfo(examplefilenm, True)
+    assert len(reads) == 2
+
+def test_getInfo_cache_invalidated_by_file_change(tmp_path, monkeypatch):
+    dgbhdf5.clearInfoCache()
+    reads = count_info_reads(monkeypatch)
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'), nrpts=(40, 25))
+    info = dgbhdf5.getInfo(examplefilenm, False)
+    make_loglog_example_file(examplefilenm, nrpts=(40, 25, 33))
+    stat = os.stat(examplefilenm)
+    os.utime(examplefilenm, ns=(stat.st_atime_ns, stat.st_mtime_ns+1000000))
+    newinfo = dgbhdf5.getInfo(examplefilenm, False)
+    assert len(reads) == 2
+    assert dgbhdf5.getTotalSize(newinfo) > dgbhdf5.getTotalSize(info)
+
+def test_getInfo_sidecar(tmp_path, monkeypatch):
+    monkeypatch.setenv('ML_INFO_SIDECAR', 'Yes')
+    dgbhdf5.clearInfoCache()
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    info = dgbhdf5.getInfo(examplefilenm, False)
+    assert os.path.isfile(dgbhdf5.getInfoSidecarName(examplefilenm))
+    dgbhdf5.clearInfoCache()
+    reads = count_info_reads(monkeypatch)
+    sidecarinfo = dgbhdf5.getInfo(examplefilenm, False)
+    assert len(reads) == 0
+    assert sidecarinfo[dbk.exampledictstr] == info[dbk.exampledictstr]
+    for wellnm, idxs in info[dbk.datasetdictstr]['Survey'].items():
+        sidecaridxs = sidecarinfo[dbk.datasetdictstr]['Survey'][wellnm]
+        assert np.array_equal(sidecaridxs, idxs) and sidecaridxs.dtype == idxs.dtype
+    assert sidecarinfo[dbk.inputdictstr] == info[dbk.inputdictstr]
+    assert sidecarinfo[dbk.inpshapedictstr] == info[dbk.inpshapedictstr]
+
+def get_attrib_samples(x_data):
+    return np.moveaxis(x_data, 1, -1).reshape(-1, x_data.shape[1])
+
+def test_mergeMoments_matches_StandardScaler():
+    from sklearn.preprocessing import StandardScaler
+    blocks = [np.random.random((nrpts, 3, 1, 1, 16)) * (iblock+1) for iblock, nrpts in enumerate((7, 1, 30, 12))]
+    moments = None
+    for block in blocks:
+        moments = dgbml.mergeMoments(moments, dgbml.getMoments(block))
+    x_data = np.concatenate(blocks)
+    reference = StandardScaler().fit(get_attrib_samples(x_data))
+    scaler = dgbml.getScalerFromMoments(moments)
+    assert np.allclose(scaler.mean_, reference.mean_)
+    assert np.allclose(scaler.scale_, reference.scale_)
+    assert np.array_equal(moments[0], np.full(3, x_data.size // 3))
+    assert np.array_equal(moments[3], x_data.min(axis=(0, 2, 3, 4)))
+    assert np.array_equal(moments[4], x_data.max(axis=(0, 2, 3, 4)))
+
+    blockmoments = [dgbml.getMoments(block, False) for block in blocks]
+    globalmoments = dgbml.reduceMoments(tuple(np.concatenate(arrs) for arrs in zip(*blockmoments)))
+    reference = StandardScaler().fit(x_data.reshape(-1, 1))
+    assert np.allclose(globalmoments[1], reference.mean_)
+    assert np.allclose(np.sqrt(globalmoments[2]/globalmoments[0]), reference.scale_)
+
+@pytest.mark.parametrize('scalebyattrib', (True, False))
+def test_computeScaler_streaming(tmp_path, monkeypatch, scalebyattrib):
+    monkeypatch.setattr(dgbml, 'scalerblocksize', 7)
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    info = dgbmlio.getInfo(examplefilenm)
+    datasets = dgbmlio.getDatasetNms(info[dbk.datasetdictstr], validation_split=0.2)
+    data = dgbmlio.getTrainingDataByInfo(info, datasets)
+    x_data = np.concatenate((data[dbk.xtraindictstr], data[dbk.xvaliddictstr]))
+    reference = dgbscikit.getScaler(x_data, scalebyattrib)
+    for nrworkers in (1, 2):
+        scaler = dgbml.computeScaler_(datasets, info, scalebyattrib, nrworkers=nrworkers)
+        assert np.allclose(scaler.mean_, reference.mean_)
+        assert np.allclose(scaler.scale_, reference.scale_)
+
+@pytest.mark.parametrize('scalebyattrib', (True, False))
+def test_computeScaler_from_example_stats(tmp_path, monkeypatch, scalebyattrib):
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    info = dgbmlio.getInfo(examplefilenm)
+    datasets = dgbmlio.getDatasetNms(info[dbk.datasetdictstr], validation_split=0.2)
+    reference = dgbml.computeScaler_(datasets, info, scalebyattrib)
+    mtime = os.stat(examplefilenm).st_mtime_ns
+    assert dgbhdf5.writeExampleStats(info, blocksize=7) == 3
+    assert dgbhdf5.writeExampleStats(info) == 0
+    assert os.stat(examplefilenm).st_mtime_ns == mtime
+
+    def no_streaming(*args):
+        raise AssertionError('Examples read despite their stored statistics')
+    monkeypatch.setattr(dgbml, 'computeMoments_', no_streaming)
+    scaler = dgbml.computeScaler_(datasets, info, scalebyattrib, nrworkers=1)
+    assert np.allclose(scaler.mean_, reference.mean_)
+    assert np.allclose(scaler.scale_, reference.scale_)
+
+def test_example_stats_out_of_date(tmp_path):
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    dgbhdf5.writeExampleStats(dgbmlio.getInfo(examplefilenm))
+    statsfile = dgbhdf5.openExampleStats(examplefilenm)
+    assert statsfile != None
+    statsfile.close()
+    stat = os.stat(examplefilenm)
+    os.utime(examplefilenm, ns=(stat.st_atime_ns, stat.st_mtime_ns+1000000))
+    assert dgbhdf5.openExampleStats(examplefilenm) == None
+
+def get_lazy_example_info(examplefilenm, **kwargs):
+    return dgbml.getScaledTrainingData(examplefilenm, split=0.2, seed=3, lazy=True, **kwargs)[dbk.infodictstr]
+
+@pytest.mark.parametrize('cached', (False, True))
+def test_LazyTrainingData_matches_eager_data(tmp_path, cached):
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    info = get_lazy_example_info(examplefilenm, nbfolds=0)
+    eager = dgbml.getScaledTrainingDataByInfo(info)
+    cachedir = str(tmp_path) if cached else None
+    for forvalid, xkey, ykey in ((False, dbk.xtraindictstr, dbk.ytraindictstr),
+                                 (True, dbk.xvaliddictstr, dbk.yvaliddictstr)):
+        lazy = dgbmlio.getLazyTrainingData(info, forvalid=forvalid, cachedir=cachedir)
+        assert len(lazy) == len(eager[xkey])
+        ids = np.random.permutation(len(lazy))
+        x_data, y_data = lazy.read(ids)
+        assert np.allclose(x_data, eager[xkey][ids])
+        assert np.array_equal(y_data, eager[ykey][ids])
+        x_data, y_data = lazy.load()
+        assert np.allclose(x_data, eager[xkey])
+        batches = [ids[:10], ids[10:]]
+        lazy.set_batches(batches)
+        for ibatch in (0, 1, 0):
+            x_data, y_data = lazy.get_batch(ibatch)
+            assert np.allclose(x_data, eager[xkey][batches[ibatch]])
+        lazy.close()
+
+@pytest.mark.parametrize('nbfolds', (0, 3))
+def test_getScaledTrainingDataByInfo_matches_unscaled_data(tmp_path, nbfolds):
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'), nrpts=(40, 25, 33, 12, 20, 31))
+    info = get_lazy_example_info(examplefilenm, nbfolds=nbfolds)
+    ifold = 2 if nbfolds else None
+    scaled = dgbml.getScaledTrainingDataByInfo(info, ifold=ifold)
+    unscaled = dgbmlio.getTrainingDataByInfo(info, dgbml.getTrainingSelection(info, 0, ifold))
+    scaler = info[dbk.inputdictstr]['Survey'][dbk.scaledictstr]
+    shape = (1, -1, 1, 1, 1)
+    for xkey, ykey in ((dbk.xtraindictstr, dbk.ytraindictstr), (dbk.xvaliddictstr, dbk.yvaliddictstr)):
+        expected = (unscaled[xkey] - scaler.mean_.reshape(shape)) / scaler.scale_.reshape(shape)
+        assert scaled[xkey].dtype == np.float32
+        assert np.allclose(scaled[xkey], expected, atol=1e-5)
+        assert np.array_equal(scaled[ykey], unscaled[ykey])
+    flattened = dgbml.getScaledTrainingDataByInfo(info, flatten=True, ifold=ifold)
+    assert np.array_equal(flattened[dbk.xtraindictstr], scaled[dbk.xtraindictstr].reshape(len(scaled[dbk.xtraindictstr]), -1))
+
+def assert_same_training_data(data, reference):
+    for key in (dbk.xtraindictstr, dbk.ytraindictstr, dbk.xvaliddictstr, dbk.yvaliddictstr):
+        assert np.array_equal(data[key], reference[key])
+
+def test_TrainingDataPrefetcher_matches_eager_data(tmp_path, monkeypatch):
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    info = get_lazy_example_info(examplefilenm, nbfolds=0, nbchunks=2)
+    reference = [dgbml.getScaledTrainingDataByInfo(info, ichunk=ichunk, scale=scale) \
+                                for ichunk in (0, 1) for scale in (True, False)]
+    loads = []
+    getScaledTrainingDataByInfo = dgbml.getScaledTrainingDataByInfo
+    def counted_getScaledTrainingDataByInfo(*args, **kwargs):
+        loads.append((kwargs['ichunk'], kwargs['scale']))
+        return getScaledTrainingDataByInfo(*args, **kwargs)
+    monkeypatch.setattr(dgbml, 'getScaledTrainingDataByInfo', counted_getScaledTrainingDataByInfo)
+    prefetcher = dgbmlio.TrainingDataPrefetcher(info, maxmemory=100)
+    for ichunk in (0, 1):
+        data = prefetcher.get(ichunk, scale=True)
+        assert prefetcher.get(ichunk, scale=True) is data
+        assert_same_training_data(data, reference[2*ichunk])
+        assert_same_training_data(prefetcher.get(ichunk, scale=False), reference[2*ichunk+1])
+    prefetcher.close()
+    # The second chunk was read in advance, each chunk/scaling only once
+    assert sorted(loads) == [(0, False), (0, True), (1, False), (1, True)]
+
+def test_TrainingDataPrefetcher_folds_match_eager_data(tmp_path, monkeypatch):
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'), nrpts=(40, 25, 33, 12, 20, 31))
+    info = get_lazy_example_info(examplefilenm, nbfolds=3)
+    assert dgbhdf5.isCrossValidation(info)
+    reference = {(ifold, scale): dgbml.getScaledTrainingDataByInfo(info, ifold=ifold, scale=scale) \
+                                for ifold in (1, 2, 3) for scale in (True, False)}
+    loads = []
+    load = dgbmlio.LazyTrainingData.load
+    def counted_load(self, *args, **kwargs):
+        loads.append(len(self))
+        return load(self, *args, **kwargs)
+    monkeypatch.setattr(dgbmlio.LazyTrainingData, 'load', counted_load)
+    prefetcher = dgbmlio.TrainingDataPrefetcher(info, maxmemory=100)
+    for ifold in (1, 2, 3):
+        data = prefetcher.get(0, ifold)
+        assert_same_training_data(data, reference[(ifold, True)])
+        # Unscaled data of the same fold, as used by the validation sequence
+        assert_same_training_data(prefetcher.get(0, ifold, scale=False), reference[(ifold, False)])
+        assert prefetcher.get(0, ifold) is data
+    prefetcher.close()
+    # The union of the examples of all folds is read once per scaling
+    assert len(loads) == 2
+
+def get_pool_batches(shared, batches, nrsteps, nrworkers):
+    pool = dgbmlio.BatchWorkerPool(nrworkers)
+    try:
+        futures = [pool.submit(shared, ids, nrsteps) for ids in batches]
+        return [future.result() for future in futures]
+    finally:
+        pool.close()
+
+def test_seeded_pool_transforms_are_reproducible():
+    from dgbpy.transforms import TransformCompose
+    info = get_seismic_imgtoimg_info(nrclasses=1, inpshape=[16,1,16], outshape=[16,1,16])
+    transform = TransformCompose(['GaussianNoise', 'FlipPolarity'], info, 2)
+    nrsteps = len(transform.multiplier)
+    rng = np.random.default_rng(0)
+    x_data = rng.random((24, 1, 16, 1, 16), dtype=np.float32)
+    y_data = rng.random((24, 1, 16, 1, 16), dtype=np.float32)
+    transform.set_uniform_generator_seed(7, len(x_data)*nrsteps)
+    for tr in transform.transforms:
+        tr.p = 0.6
+    batches = [range(start, start+8) for start in range(0, len(x_data)*nrsteps, 8)]
+    shared = dgbmlio.SharedArrays()
+    try:
+        shared.publish({'x': x_data, 'y': y_data}, seed=7)
+        shared.publishObject('transform', transform)
+        reference = get_pool_batches(shared, batches, nrsteps, nrworkers=1)
+        for nrworkers in (1, 3):
+            for (x, y), (refx, refy) in zip(get_pool_batches(shared, batches, nrsteps, nrworkers), reference):
+                assert np.array_equal(x, refx)
+                assert np.array_equal(y, refy)
+        assert any(not np.array_equal(x, x_data[np.asarray(ids)//nrsteps]) for (x, y), ids in zip(reference, batches))
+    finally:
+        shared.close()
+
+def get_fake_applier(examplefilenm, inpshape, scaling=dbk.globalstdtypestr, transpose=False, applydir=dbk.inlinestr):
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    from dgbpy import dgbscikit
+    applier = applyserver.ModelApplier(examplefilenm, applydir=applydir, isfake=True, warmup=0)
+    applier.info_[dbk.inpshapedictstr] = inpshape
+    applier.info_[dgbhdf5.inpscalingdictstr] = scaling
+    applier.setOutputs({})
+    applier.needtranspose_ = transpose
+    if scaling == dbk.globalstdtypestr:
+        applier.scaler_ = dgbscikit.getNewScaler([0.5, 0.4], [0.3, 0.2])
+    return applier
+
+def get_copied_windows(inp, inpshape):
+    # Samples as extracted by copying every window
+    vertical = isinstance(inpshape, int)
+    nrz = inpshape if vertical else inpshape[2]
+    nrzoutsamps = inp.shape[-1] - nrz + 1
+    if vertical:
+        samples = np.empty((nrzoutsamps, inp.shape[0], 1, 1, nrz), dtype=inp.dtype)
+        for zidz in range(nrzoutsamps):
+            samples[zidz,:,0,0,:] = inp[:,zidz:zidz+nrz]
+    else:
+        samples = np.empty((nrzoutsamps, inp.shape[0], *inpshape), dtype=inp.dtype)
+        for zidz in range(nrzoutsamps):
+            samples[zidz] = inp[:,:,:,zidz:zidz+nrz]
+    return samples
+
+@pytest.mark.parametrize('transpose', (False, True), ids=['', 'transposed'])
+@pytest.mark.parametrize('scaling', (dbk.globalstdtypestr, dbk.localstdtypestr, dbk.normalizetypestr,
+                                     dbk.minmaxtypestr, dbk.rangestdtypestr, None))
+@pytest.mark.parametrize('inpshape, shape', (
+    (16, (2,100)),
+    ([8,8,16], (2,8,8,100)),
+    ([8,8,16], (2,1,8,100)),
+))
+def test_window_samples_match_copied_samples(tmp_path, inpshape, shape, scaling, transpose):
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    inp = (np.random.default_rng(0).random(shape) * 3).astype(np.float32)
+    applier = get_fake_applier(examplefilenm, inpshape, scaling, transpose)
+    samples = applier.prepareWork(inp.copy())['samples']
+    assert not samples.flags.owndata
+    refapplier = get_fake_applier(examplefilenm, inpshape, scaling, transpose)
+    refsamples = refapplier.preprocess(get_copied_windows(inp, inpshape))
+    assert samples.shape == refsamples.shape
+    assert np.allclose(samples, refsamples, rtol=1e-5, atol=1e-6)
+
+@pytest.mark.parametrize('inpshape', ([1,8,16], [8,1,16]), ids=['inline', 'crossline'])
+def test_flatModelApply_matches_per_slice_apply(tmp_path, monkeypatch, inpshape):
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    applies = []
+    def fake_apply(model, info, samples, scaler=None, applyinfo=None, batchsize=None):
+        applies.append(len(samples))
+        return {dbk.preddictstr: samples[:,:1]*2 + samples.sum(axis=(1,2,3,4))[:,None,None,None,None]}
+    monkeypatch.setattr(dgbml, 'doApply', fake_apply)
+    applier = get_fake_applier(examplefilenm, inpshape, applydir=dbk.averagestr)
+    applier.info_[dbk.learntypedictstr] = dbk.seisimgtoimgtypestr
+    inp = np.random.default_rng(0).random((2,8,8,16), dtype=np.float32)
+    work = applier.prepareWork(inp.copy())
+    assert work['flatapply']
+    samples, samples_shape = work['samples'], work['samples_shape']
+    allsamples = [samples, samples.swapaxes(2, 3)]
+    preds = applier.flatModelApply(work['inp'], allsamples, samples_shape)
+    assert len(applies) == 1
+    # One apply per slice and direction
+    nrslices = max(inpshape[0], inpshape[1])
+    applydata = np.empty(samples_shape, dtype=inp.dtype)
+    for pred, samples in zip(preds, allsamples):
+        refpred = np.zeros_like(pred)
+        for idx in range(nrslices):
+            applydata[:,:,0] = samples[:,:,idx]
+            refpred[0,:,idx] = fake_apply(None, None, applydata)[dbk.preddictstr][:,0]
+        assert np.allclose(pred, refpred)
+
+@pytest.mark.parametrize('dtype', (np.float32, np.float64, np.int16, np.uint8))
+@pytest.mark.parametrize('shape', ((0,), (1,), (3,5,17), (2,0,4)))
+def test_compressArray_roundtrip(shape, dtype):
+    from dgbpy import deeplearning_apply_transport as applytransport
+    codecs = applytransport.getArrayCodecs()
+    assert 'shuffle-zlib' in codecs
+    arr = (np.random.default_rng(0).random(shape) * 100).astype(dtype)
+    for codec in codecs:
+        data = applytransport.compressArray(arr, codec)
+        ret = applytransport.decompressArray(data, codec, arr.dtype.str, arr.shape)
+        assert ret.dtype == arr.dtype
+        assert np.array_equal(ret, arr)
+    # Non-contiguous arrays are compressed in C order
+    if len(shape) == 3:
+        view = arr[:, ::2].transpose()
+        data = applytransport.compressArray(view, codecs[0])
+        assert np.array_equal(applytransport.decompressArray(data, codecs[0], view.dtype, view.shape), view)
+
+def run_apply_server(lsock, applier, pipeline, accepts):
+    # Same event loop as the apply server script, until a kill request
+    import selectors
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    sel = selectors.DefaultSelector()
+    sel.register(lsock, selectors.EVENT_READ, data=None)
+    if pipeline != None:
+        pipeline = pipeline(sel)
+    lastmessage = False
+    cont = True
+    while cont:
+        events = sel.select(timeout=10)
+        if not events:
+            break
+        for key, mask in events:
+            if key.data is None:
+                conn, addr = key.fileobj.accept()
+                conn.setblocking(True)
+                accepts.append(addr)
+                sel.register(conn, selectors.EVENT_READ, data=applyserver.Message(sel, conn, addr, applier, pipeline))
+            elif key.data is pipeline:
+                pipeline.process_events(mask)
+            else:
+                message = key.data
+                try:
+                    message.process_events(mask)
+                except Exception:
+                    message.close()
+                lastmessage = lastmessage or message.lastmessage
+                cont = not lastmessage or len(events) > 1
+    if pipeline != None:
+        pipeline.close()
+    sel.close()
+
+def send_apply_requests(addr, requests, keepalive):
+    import selectors, socket
+    import dgbpy.deeplearning_apply_clientlib as applyclient
+    class ClientMessage(applyclient.Message):
+        def _process_response_array_content(self):
+            self.responses.append([np.array(arr) for arr in self.response['data']])
+        def _process_response_json_content(self):
+            self.responses.append(self.response)
+    sel = selectors.DefaultSelector()
+    sock = socket.create_connection(addr)
+    message = ClientMessage(sel, sock, addr, requests[0], keepalive=keepalive)
+    message.responses = []
+    for request in requests[1:]:
+        message.add_request(request)
+    sel.register(sock, selectors.EVENT_WRITE, data=message)
+    while sel.get_map():
+        for key, mask in sel.select(timeout=10):
+            key.data.process_events(mask)
+    sel.close()
+    return message.responses
+
+@pytest.mark.parametrize('pipelined', (False, True), ids=['', 'pipelined'])
+def test_apply_connection_keepalive(tmp_path, pipelined):
+    import socket, threading
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    applier = get_fake_applier(examplefilenm, 16)
+    pipeline = (lambda sel: applyserver.ApplyPipeline(sel, queuesize=2)) if pipelined else None
+    lsock = socket.create_server(('localhost', 0))
+    addr = lsock.getsockname()
+    accepts = []
+    server = threading.Thread(target=run_apply_server, args=(lsock, applier, pipeline, accepts))
+    server.start()
+    try:
+        rng = np.random.default_rng(0)
+        inps = [rng.random((2, 40+10*idx), dtype=np.float32) for idx in range(4)]
+        requests = [{'type': 'binary/array', 'encoding': [inp.dtype.name], 'content': [inp]} for inp in inps]
+        refapplier = get_fake_applier(examplefilenm, 16)
+        refs = [refapplier.doWork(inp.copy()) for inp in inps]
+        for keepalive, nraccepts in ((True, 1), (False, len(inps))):
+            del accepts[:]
+            responses = send_apply_requests(addr, requests, keepalive)
+            assert len(accepts) == nraccepts
+            assert len(responses) == len(refs)
+            for res, ref in zip(responses, refs):
+                assert len(res) == len(ref)
+                for arr, refarr in zip(res, ref):
+                    assert np.allclose(arr, refarr)
+    finally:
+        kill = {'type': 'text/json', 'encoding': 'utf-8', 'content': {'action': 'kill'}}
+        send_apply_requests(addr, [kill], keepalive=True)
+        server.join()
+        lsock.close()
+
+class FakeApplyMessage:
+    # The interface of the server messages used by the MicroBatcher
+    def __init__(self, applier, inp, model=None):
+        self.applier = applier
+        self.inp = inp
+        self.model = model
+
+    def resolve_applier(self):
+        pass
+
+    def is_apply_request(self):
+        return True
+
+    def apply_input(self):
+        return self.inp
+
+    def create_arrays_response(self, res):
+        return res
+
+    def create_error_response(self, exc):
+        return exc
+
+def test_MicroBatcher_splits_combined_results(tmp_path, monkeypatch):
+    import queue
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    applier = get_fake_applier(examplefilenm, 16)
+    rng = np.random.default_rng(0)
+    inps = [rng.random((2, 40+10*idx), dtype=np.float32) for idx in range(4)]
+    refs = [get_fake_applier(examplefilenm, 16).doWork(inp.copy()) for inp in inps]
+    applies = []
+    doApply = dgbml.doApply
+    def count_apply(*args, **kwargs):
+        applies.append(len(args[2]))
+        return doApply(*args, **kwargs)
+    monkeypatch.setattr(dgbml, 'doApply', count_apply)
+    messages = [FakeApplyMessage(applier, inp) for inp in inps]
+    other = FakeApplyMessage(applier, inps[0], model='other')
+    requests = queue.Queue()
+    for message in messages[1:] + [other]:
+        requests.put(message)
+    pending = []
+    batcher = applyserver.MicroBatcher(nrsamples=100000, maxwait=0.01)
+    responses = batcher.run(messages[0], lambda timeout: requests.get(timeout=timeout), pending)
+    # The request for another model is not combined
+    assert pending == [other]
+    assert applies == [sum([len(ref[0]) for ref in refs])]
+    assert [message for (message, res, error) in responses] == messages
+    for (message, res, error), ref in zip(responses, refs):
+        assert len(res) == len(ref)
+        for arr, refarr in zip(res, ref):
+            assert arr.shape == refarr.shape
+            assert np.allclose(arr, refarr)
+    # A failure of the combined apply is reported to every request, without retry
+    def fail_apply(*args, **kwargs):
+        applies.append(len(args[2]))
+        raise ValueError('apply failed')
+    monkeypatch.setattr(dgbml, 'doApply', fail_apply)
+    del applies[:]
+    for message in messages[1:]:
+        requests.put(message)
+    responses = batcher.run(messages[0], lambda timeout: requests.get(timeout=timeout), pending)
+    assert len(applies) == 1
+    assert len(responses) == len(messages)
+    assert all([isinstance(res, ValueError) for (message, res, error) in responses])
+
+def test_shared_memory_only_from_local_clients():
+    import selectors, socket
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    from dgbpy import deeplearning_apply_transport as applytransport
+    shapes, dtypes = [[3,100]], ['float32']
+    inpbuf, outbuf = applytransport.SharedBuffer(), applytransport.SharedBuffer()
+    shmnames = {'input': inpbuf.reserve(1200), 'output': outbuf.reserve(1200)}
+    sel = selectors.DefaultSelector()
+    try:
+        tcpsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        message = applyserver.Message(sel, tcpsock, None, None)
+        with pytest.raises(ValueError):
+            message._attach_shared(shmnames, shapes, dtypes)
+        message.close()
+        sock, clientsock = socket.socketpair()
+        message = applyserver.Message(sel, sock, None, None)
+        buf = message._attach_shared(shmnames, shapes, dtypes)
+        assert message.sharedmem and len(buf) >= 1200
+        for badshapes, baddtypes in (([[3,100],[2]], dtypes), ([[-3,100]], dtypes), ([[2,applytransport.sharedpagesize]], dtypes)):
+            with pytest.raises(ValueError):
+                message._attach_shared(shmnames, badshapes, baddtypes)
+        with pytest.raises(FileNotFoundError):
+            message._attach_shared({'input': 'dgbpy_missing_block', 'output': shmnames['output']}, shapes, dtypes)
+        message.close()
+        clientsock.close()
+    finally:
+        sel.close()
+        inpbuf.close()
+        outbuf.close()
+
+def test_ModelCache_serves_only_the_Machine_Learning_directory(tmp_path):
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    mldir = tmp_path / 'MachineLearning'
+    mldir.mkdir()
+    examplefilenm = make_loglog_example_file(str(mldir / 'loglog.h5'))
+    outsidefilenm = make_loglog_example_file(str(tmp_path / 'outside.h5'))
+    os.symlink(outsidefilenm, str(mldir / 'link.h5'))
+    models = applyserver.ModelCache(str(mldir), isfake=True, warmup=0)
+    assert models.resolve('loglog.h5') == os.path.realpath(examplefilenm)
+    assert models.resolve(examplefilenm) == os.path.realpath(examplefilenm)
+    for model in ('../outside.h5', outsidefilenm, 'link.h5', 'missing.h5', '.', '/etc/hostname'):
+        with pytest.raises(ValueError):
+            models.resolve(model)
+        with pytest.raises(ValueError):
+            models.get(model)
+    assert models.get('loglog.h5') is models.get(examplefilenm)
+
+def test_warmUp_not_in_server_stats(tmp_path):
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    applier = get_fake_applier(examplefilenm, 16)
+    applier.warmup_ = 2
+    applyserver.stats.reset()
+    assert applier.warmUp() > 0
+    report = applyserver.stats.report()
+    assert report['samples'] == 0
+    assert report['batches']['count'] == 0
+    assert all([latency['count'] == 0 for latency in report['latency'].values()])
+    applier.doWork(np.random.default_rng(0).random((2, 40), dtype=np.float32))
+    report = applyserver.stats.report()
+    assert report['latency']['inference']['count'] == 1
+    applyserver.stats.reset()
+
+def test_outputSampleAxes(tmp_path):
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    applier = get_fake_applier(examplefilenm, 16)
+    assert applier.outputSampleAxes() == {dbk.preddictstr: 0}
+    applier.info_[dbk.plfdictstr] = dbk.kerasplfnm
+    assert applier.outputSampleAxes() == {dbk.preddictstr: 0}
+    applier.info_[dbk.classdictstr] = True
+    assert applier.outputSampleAxes() == None
+    applier.info_[dbk.learntypedictstr] = dbk.seisimgtoimgtypestr
+    assert applier.outputSampleAxes() == {dbk.preddictstr: 0}
+    applier.applyinfo_ = dict(applier.applyinfo_)
+    applier.applyinfo_[dbk.dtypeconf] = 'float32'
+    assert applier.outputSampleAxes() == None
+
+def test_MicroBatcher_applies_unsplittable_requests_once(tmp_path, monkeypatch):
+    import queue
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    applier = get_fake_applier(examplefilenm, 16)
+    monkeypatch.setattr(applier, 'outputSampleAxes', lambda: None)
+    rng = np.random.default_rng(0)
+    inps = [rng.random((2, 40+10*idx), dtype=np.float32) for idx in range(3)]
+    refs = [get_fake_applier(examplefilenm, 16).doWork(inp.copy()) for inp in inps]
+    applies = []
+    doApply = dgbml.doApply
+    def count_apply(*args, **kwargs):
+        applies.append(len(args[2]))
+        return doApply(*args, **kwargs)
+    monkeypatch.setattr(dgbml, 'doApply', count_apply)
+    messages = [FakeApplyMessage(applier, inp) for inp in inps]
+    requests = queue.Queue()
+    for message in messages[1:]:
+        requests.put(message)
+    batcher = applyserver.MicroBatcher(nrsamples=100000, maxwait=0.01)
+    responses = batcher.run(messages[0], lambda timeout: requests.get(timeout=timeout), [])
+    # Applied one by one, without a combined apply first
+    assert applies == [len(ref[0]) for ref in refs]
+    for (message, res, error), ref in zip(responses, refs):
+        assert np.allclose(res[0], ref[0])
+
+def frame_request(request, keepalive=True):
+    import dgbpy.deeplearning_apply_clientlib as applyclient
+    message = applyclient.Message(None, None, None, request, keepalive=keepalive)
+    message.queue_request()
+    return message._send_buffer
+
+def test_apply_request_received_in_reused_buffer():
+    import selectors, socket, struct
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    sel = selectors.DefaultSelector()
+    sock, clientsock = socket.socketpair()
+    sock.settimeout(10)
+    clientsock.settimeout(10)
+    message = applyserver.Message(sel, sock, None, None)
+    sel.register(sock, selectors.EVENT_READ, data=message)
+    buffers = []
+    try:
+        for padsize in (100, 200000, 50):
+            request = {'type': 'text/json', 'encoding': 'utf-8', 'content': {'action': 'status', 'pad': 'x'*padsize}}
+            clientsock.sendall(frame_request(request))
+            while message.request is None:
+                message.read()
+            assert message.request['pad'] == 'x'*padsize
+            buffers.append((message._recv_buffer, len(message._recv_buffer)))
+            while message.request is not None:
+                message.write()
+            assert clientsock.recv(65536)
+        # The buffer grows for a larger payload, and is reused for a smaller one
+        assert buffers[1][1] > 200000 and buffers[1][1] > buffers[0][1]
+        assert buffers[2][0] is buffers[1][0]
+        # A payload too short for the JSON header is rejected, not waited for
+        clientsock.sendall(struct.pack('=iih', 0, 1, -1))
+        with pytest.raises(ValueError):
+            message.read()
+    finally:
+        message.close()
+        clientsock.close()
+        sel.close()
+
+def test_consume_send_buffers():
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    data = bytes(range(256)) * 4
+    sizes = (10, 1, 300, 0, 200, 513)
+    def get_buffers():
+        buffers, start = [], 0
+        for size in sizes:
+            buffers.append(memoryview(data)[start:start+size])
+            start += size
+        return [buf for buf in buffers if len(buf) > 0]
+    total = sum(sizes)
+    # Partial sends ending inside a buffer, on a boundary, and spanning several buffers
+    for steps in ((5, 5, 1, 299, 1, 200, 513), (11, 800, 213), (3, 400, 400, 234), (total,)):
+        message = applyserver.Message(None, None, None, None)
+        message._send_buffers = get_buffers()
+        sent = 0
+        for step in steps:
+            message._consume_send_buffers(step)
+            sent += step
+            assert b''.join([bytes(buf) for buf in message._send_buffers]) == data[sent:total]
+            assert all([len(buf) > 0 for buf in message._send_buffers])
+        assert not message._send_buffers
+
+def test_write_sends_at_most_sendmaxbuffers():
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    class FakeSocket:
+        def __init__(self):
+            self.received = b''
+            self.nrbuffers = []
+        def sendmsg(self, buffers):
+            self.nrbuffers.append(len(buffers))
+            # A partial send, ending inside a buffer
+            nrbytes = max(sum([len(buf) for buf in buffers]) - 3, 1)
+            self.received += b''.join([bytes(buf) for buf in buffers])[:nrbytes]
+            return nrbytes
+    nrbuffers = 2*applyserver.sendmaxbuffers + 10
+    buffers = [memoryview(bytes([idx % 256]) * 7) for idx in range(nrbuffers)]
+    expected = b''.join([bytes(buf) for buf in buffers])
+    message = applyserver.Message(None, FakeSocket(), None, None)
+    message.keepalive = True
+    message._send_buffers = list(buffers)
+    message._send_start = 0
+    message._reset = lambda: None
+    while message._send_buffers:
+        message._write()
+    assert max(message.sock.nrbuffers) == applyserver.sendmaxbuffers
+    assert message.sock.received == expected
+
+def test_apply_server_stats_action(tmp_path):
+    import socket, threading
+    import dgbpy.deeplearning_apply_serverlib as applyserver
+    examplefilenm = make_loglog_example_file(str(tmp_path / 'loglog.h5'))
+    applier = get_fake_applier(examplefilenm, 16)
+    lsock = socket.create_server(('localhost', 0))
+    addr = lsock.getsockname()
+    server = threading.Thread(target=run_apply_server, args=(lsock, applier, None, []))
+    applyserver.stats.reset()
+    server.start()
+    try:
+        rng = np.random.default_rng(0)
+        inps = [rng.random((2, 40+10*idx), dtype=np.float32) for idx in range(3)]
+        requests = [{'type': 'binary/array', 'encoding': [inp.dtype.name], 'content': [inp]} for inp in inps]
+        send_apply_requests(addr, requests, keepalive=True)
+        statsrequest = {'type': 'text/json', 'encoding': 'utf-8', 'content': {'action': 'stats', 'reset': True}}
+        report = send_apply_requests(addr, [statsrequest], keepalive=False)[0]['result']
+        nrsamples = sum([inp.shape[1]-16+1 for inp in inps])
+        assert report['samples'] == nrsamples
+        assert report['batches']['count'] == len(inps)
+        assert report['batches']['max-samples'] == inps[-1].shape[1]-16+1
+        for stage in ('preprocess', 'inference', 'postprocess', 'encode', 'send'):
+            latency = report['latency'][stage]
+            assert latency['count'] == len(inps)
+            assert sum(latency['histogram']) == latency['count']
+            assert latency['max-ms'] >= latency['mean-ms'] > 0
+        # The stats request itself is received and decoded, but not yet sent when reported
+        assert report['latency']['receive']['count'] == len(inps)+1
+        assert report['latency']['decode']['count'] == len(inps)+1
+        # Reset after the report
+        report = send_apply_requests(addr, [statsrequest], keepalive=False)[0]['result']
+        assert report['samples'] == 0
+        assert report['latency']['send']['count'] == 1
+    finally:
+        kill = {'type': 'text/json', 'encoding': 'utf-8', 'content': {'action': 'kill'}}
+        send_apply_requests(addr, [kill], keepalive=True)
+        server.join()
+        lsock.close()
+        applyserver.stats.reset()